@@ -0,0 +1,70 @@
+"""
+compare classifying file paths with the exclude rules, one regex at a time as before,
+with the single compiled regex, and with the cache of ExcludeRules.classify()
+
+the paths are those modified by each commit of a repository, in the order of git log,
+repeated until there are enough of them, so paths recur as often as in real history.
+
+    python -m benchmarks.classifier --repo ~/tmp/repos/some_repo --paths 1000000
+"""
+import argparse
+import re
+import time
+from itertools import cycle, islice
+from typing import Callable, List, Tuple
+
+from pydriller.git import Git
+
+from utils import _IGNORE_PATTERNS_, ExcludeRules, file_type
+
+
+def sample_paths(repo: str, n_paths: int) -> List[str]:
+    output = Git(repo).repo.git.log("--all", "--name-only", "--no-renames", "--format=")
+    paths = [line for line in output.splitlines() if line]
+    return list(islice(cycle(paths), n_paths))
+
+
+def loop_classifier() -> Callable[[str], tuple]:
+    regexes = [re.compile(pattern) for pattern in _IGNORE_PATTERNS_]
+
+    def classify(path: str) -> tuple:
+        for regex in regexes:
+            if regex.match(path):
+                return True, file_type(path)
+        return False, file_type(path)
+
+    return classify
+
+
+def compiled_classifier() -> Callable[[str], tuple]:
+    rules = ExcludeRules.default()
+    return lambda path: (rules.match(path), file_type(path))
+
+
+def run(classify: Callable[[str], tuple], paths: List[str]) -> float:
+    start_t = time.perf_counter()
+    for path in paths:
+        classify(path)
+    return time.perf_counter() - start_t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repo", default=".")
+    parser.add_argument("--paths", type=int, default=1000000)
+    args = parser.parse_args()
+
+    paths = sample_paths(args.repo, args.paths)
+    distinct = sorted(set(paths))
+    print(f"{len(paths):,} paths, {len(distinct):,} distinct")
+
+    expected = [loop_classifier()(path) for path in distinct]
+    classifiers: List[Tuple[str, Callable[[], Callable[[str], tuple]]]] = [
+        ("loop", loop_classifier),
+        ("compiled", compiled_classifier),
+        ("cached", lambda: ExcludeRules.default().classify),
+    ]
+    for name, new_classifier in classifiers:
+        assert [new_classifier()(path) for path in distinct] == expected
+        elapsed = run(new_classifier(), paths)
+        print(f"{name:8}: {elapsed:.2f}s, {len(paths) / elapsed:,.0f} paths/s")
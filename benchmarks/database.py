@@ -0,0 +1,68 @@
+"""
+compare indexing into a database loaded into memory and saved back, as before, with using it in place
+in write-ahead log mode
+
+a database with --existing commits is built first, then in each mode a new process opens a copy,
+writes --commits new ones and closes it. the time includes loading and saving the database, and the
+peak memory is the maximum RSS of the process.
+
+    python -m benchmarks.database --existing 200000 --commits 20000
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+from benchmarks.writer import sample_records
+from indexer import DB_MODES, Indexer
+from indexer.extract import CommitRecord
+from indexer.models import ensure_repository
+
+
+def index(db_file: str, db_mode: str, records: List[CommitRecord], batch_commits: int) -> float:
+    start_t = time.perf_counter()
+    indexer = Indexer(db_file=db_file, db_mode=db_mode, writer="bulk", batch_commits=batch_commits)
+    repo = ensure_repository(indexer.session, f"/tmp/benchmark/{records[0].sha}", "local")
+    indexer._save_records_(repo, {}, records)
+    indexer.close()
+    return time.perf_counter() - start_t
+
+
+def run(db_file: str, db_mode: str, n_existing: int, n_commits: int, batch_commits: int) -> Tuple[float, int]:
+    """runs in a new process, returns the elapsed time and the peak RSS in MB"""
+    records = sample_records(n_existing + n_commits)[n_existing:]
+    elapsed = index(db_file, db_mode, records, batch_commits)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return elapsed, max_rss // (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--existing", type=int, default=200000)
+    parser.add_argument("--commits", type=int, default=20000)
+    parser.add_argument("--batch-commits", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base_db = os.path.join(tmpdir, "base.db")
+        if args.existing:
+            index(base_db, "wal", sample_records(args.existing), args.batch_commits)
+        print(f"{args.existing:,} existing commits, {os.path.getsize(base_db) / 1024 / 1024:,.0f} MB")
+
+        # spawned, so that the peak memory is not inherited from this process
+        context = multiprocessing.get_context("spawn")
+        for db_mode in DB_MODES:
+            db_file = os.path.join(tmpdir, f"{db_mode}.db")
+            shutil.copyfile(base_db, db_file)
+            with context.Pool(1) as pool:
+                elapsed, max_rss = pool.apply(run, (db_file, db_mode, args.existing, args.commits, args.batch_commits))
+            rate = args.commits / elapsed
+            print(
+                f"{db_mode:6}: {args.commits:,} commits in {elapsed:.2f}s, {rate:,.0f} commits/s, peak {max_rss:,} MB"
+            )
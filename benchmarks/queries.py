@@ -0,0 +1,118 @@
+"""
+compare lookups and commit stats queries on a database without the secondary indexes, as before,
+and after upgrade_schema() has created them
+
+a database of --commits commits spread over --repos repositories is built, about 5 files per commit,
+then each query is run with random keys, first without the indexes, then with them.
+
+    python -m benchmarks.queries --commits 1000000 --repos 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Connection
+
+from benchmarks.writer import sample_records
+from indexer import Indexer
+from indexer.models import Base, ensure_repository, upgrade_schema
+from indexer.stats import STATS_BY_SHA_SQL, STATS_SQL
+
+
+def build_db(db_file: str, n_commits: int, n_repos: int, n_authors: int) -> None:
+    indexer = Indexer(db_file=db_file, db_mode="wal", writer="bulk", batch_commits=10000)
+    records = sample_records(n_commits)
+    for i, record in enumerate(records):
+        record.author_email = f"dev{i % n_authors}@example.com"
+
+    per_repo = (n_commits + n_repos - 1) // n_repos
+    for i in range(n_repos):
+        repo = ensure_repository(indexer.session, f"/tmp/benchmark/repo{i}", "local")
+        indexer._save_records_(repo, {}, records[i * per_repo : (i + 1) * per_repo])
+    indexer.close()
+
+
+def queries(conn: Connection, n_repos: int, n_authors: int) -> Dict[str, Callable[[], Any]]:
+    shas = conn.execute(text("select sha from commits")).scalars().all()
+
+    def sample_shas(n_shas: int) -> List[str]:
+        return random.sample(shas, n_shas)
+
+    return {
+        "repository by clone_url": lambda: conn.execute(
+            text("select * from repositories where clone_url = :url"),
+            {"url": f"/tmp/benchmark/repo{random.randrange(n_repos)}"},
+        ).all(),
+        "author by email": lambda: conn.execute(
+            text("select * from authors where email = :email"),
+            {"email": f"dev{random.randrange(n_authors)}@example.com"},
+        ).all(),
+        "commits by real_email, top 100": lambda: conn.execute(
+            text(
+                """select commits.* from commits join authors on authors.id = commits.author_id
+                where authors.real_email = :email order by commits.n_lines_changed desc limit 100"""
+            ),
+            {"email": f"dev{random.randrange(n_authors)}@example.com"},
+        ).all(),
+        "files of a commit": lambda: conn.execute(
+            text("select * from committed_files where commit_id = :sha"), {"sha": sample_shas(1)[0]}
+        ).all(),
+        "repositories of a commit": lambda: conn.execute(
+            text("select repo_id from repo_to_commits where commit_id = :sha"), {"sha": sample_shas(1)[0]}
+        ).all(),
+        "top 100 commits": lambda: conn.execute(
+            text("select sha from commits order by n_lines_changed desc limit 100")
+        ).all(),
+        "stats of 500 commits": lambda: conn.execute(STATS_BY_SHA_SQL, {"shas": sample_shas(500)}),
+        "stats of all commits": lambda: conn.execute(STATS_SQL),
+    }
+
+
+def run(conn: Connection, query: Callable[[], Any], seconds: float) -> float:
+    """average time of a query in ms, repeated for about the given seconds"""
+    n_runs, start_t = 0, time.perf_counter()
+    while n_runs == 0 or time.perf_counter() - start_t < seconds:
+        query()
+        n_runs += 1
+    conn.rollback()
+    return (time.perf_counter() - start_t) / n_runs * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=1000000)
+    parser.add_argument("--repos", type=int, default=5000)
+    parser.add_argument("--authors", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = os.path.join(tmpdir, "benchmark.db")
+        build_db(db_file, args.commits, args.repos, args.authors)
+        engine = create_engine(f"sqlite:///{db_file}")
+
+        # the database as it was before the indexes were added
+        indexes = [index.name for table in Base.metadata.sorted_tables for index in table.indexes]
+        with engine.begin() as conn:
+            for name in indexes:
+                conn.execute(text(f"drop index if exists {name}"))
+            n_files = conn.execute(text("select count(*) from committed_files")).scalar()
+        print(f"{args.commits:,} commits, {n_files:,} files, {os.path.getsize(db_file) / 1024 / 1024:,.0f} MB")
+
+        timings: Dict[str, List[float]] = {}
+        for label in ["without indexes", "with indexes"]:
+            if label == "with indexes":
+                start_t = time.perf_counter()
+                upgrade_schema(engine)
+                print(f"created {len(indexes)} indexes in {time.perf_counter() - start_t:.1f}s")
+            with engine.connect() as conn:
+                for name, query in queries(conn, args.repos, args.authors).items():
+                    timings.setdefault(name, []).append(run(conn, query, args.seconds))
+
+        print(f"{'query':32} {'without':>12} {'with':>12} {'speedup':>8}")
+        for name, (without, with_) in timings.items():
+            print(f"{name:32} {without:10.2f}ms {with_:10.2f}ms {without / with_:7.1f}x")
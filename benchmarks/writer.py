@@ -0,0 +1,63 @@
+"""
+compare the throughput of the orm and bulk writers
+
+the commits of the test repositories are extracted once, then copied with new hashes
+to make up a large repository, so that only the database writes are measured.
+
+    python -m benchmarks.writer --commits 20000
+"""
+import argparse
+import hashlib
+import tempfile
+import time
+import zipfile
+from copy import deepcopy
+from typing import List
+
+from indexer import WRITERS, Indexer
+from indexer.extract import CommitRecord, iter_commits
+from indexer.models import ensure_repository
+
+TEST_REPOS = "tests/data/test_repos.zip"
+
+
+def sample_records(n_commits: int) -> List[CommitRecord]:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with zipfile.ZipFile(TEST_REPOS) as zf:
+            zf.extractall(tmpdir)
+        samples = [r for r in iter_commits(f"{tmpdir}/repo1_clone", {}) if isinstance(r, CommitRecord)]
+
+    records: List[CommitRecord] = []
+    for i in range(n_commits):
+        record = deepcopy(samples[i % len(samples)])
+        record.sha = hashlib.sha1(str(i).encode()).hexdigest()
+        record.parents = [records[-1].sha] if records else []
+        record.author_email = f"dev{i % 50}@example.com"
+        records.append(record)
+    return records
+
+
+def run(writer: str, records: List[CommitRecord], batch_commits: int) -> float:
+    indexer = Indexer(uri="sqlite:///:memory:", writer=writer, batch_commits=batch_commits)
+    repo = ensure_repository(indexer.session, "/tmp/benchmark", "local")
+
+    start_t = time.perf_counter()
+    indexer._save_records_(repo, {}, records)
+    elapsed = time.perf_counter() - start_t
+
+    indexer.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=20000)
+    parser.add_argument("--batch-commits", type=int, default=1000)
+    args = parser.parse_args()
+
+    records = sample_records(args.commits)
+    n_files = sum(len(r.files) for r in records)
+    for writer in WRITERS:
+        elapsed = run(writer, records, args.batch_commits)
+        rate = len(records) / elapsed
+        print(f"{writer:5}: {len(records):,} commits, {n_files:,} files in {elapsed:.2f}s, {rate:,.0f} commits/s")
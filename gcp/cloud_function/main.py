@@ -1,29 +1,53 @@
+import json
 import os
 
-from google.cloud.bigquery import Client, LoadJobConfig, SchemaField, SourceFormat
+from google.cloud import storage  # type: ignore [attr-defined]
+from google.cloud.bigquery import (
+    ArrayQueryParameter,
+    Client,
+    LoadJobConfig,
+    QueryJobConfig,
+    SchemaField,
+    SourceFormat,
+    WriteDisposition,
+)
 
 # Configure your project and BigQuery dataset
 project_id = os.environ.get("BQ_PROJECT_ID")
 dataset_id = "dev1"
 table_id = "all_commit_data"
 
-# Instantiate the BigQuery client
-client = Client(project=project_id)
-
 
 def load_csv_to_bigquery(data, context):
     # Get the file details from the event
-    bucket_name = data["bucket"]
-    file_name = data["name"]
+    load_export(Client(project=project_id), storage.Client(), data["bucket"], data["name"])
+
+
+def load_export(client, storage_client, bucket_name, file_name):
     file_path = f"gs://{bucket_name}/{file_name}"
+    bucket = storage_client.bucket(bucket_name)
 
-    # Skip processing if the file is not named "all_commit_data.csv"
-    if file_name != "all_commit_data.csv":
+    manifest = {"format": "csv", "mode": "full"}
+    if file_name == "all_commit_data.csv":
+        source_uris = [file_path]
+    elif file_name == "all_commit_data.manifest.json":
+        # export split into part files, compressed, in parquet format or of changes only,
+        # the files are uploaded to all_commit_data/ before the manifest
+        manifest = json.loads(bucket.blob(file_name).download_as_text())
+        source_uris = [f"gs://{bucket_name}/all_commit_data/{part['file']}" for part in manifest["parts"]]
+    else:
+        # Skip processing other files
         return
 
-    # Delete all rows in the existing BigQuery table
-    delete_query = f"DELETE FROM `{project_id}.{dataset_id}.{table_id}` WHERE true"
-    client.query(delete_query).result()
+    table = f"{project_id}.{dataset_id}.{table_id}"
+    if manifest.get("mode") == "delta":
+        # merge the changes, rows of the changed commits are replaced by the ones in the export
+        changed_commits = bucket.blob(f"all_commit_data/{manifest['changed_commits']}").download_as_text().split()
+        query_config = QueryJobConfig(query_parameters=[ArrayQueryParameter("shas", "STRING", changed_commits)])
+        client.query(f"DELETE FROM `{table}` WHERE sha IN UNNEST(@shas)", job_config=query_config).result()
+    else:
+        # Delete all rows in the existing BigQuery table
+        client.query(f"DELETE FROM `{table}` WHERE true").result()
 
     # Load the CSV file into BigQuery
     job_config = LoadJobConfig(
@@ -73,13 +97,17 @@ def load_csv_to_bigquery(data, context):
         ],
         skip_leading_rows=1,  # Skip the header row
         source_format=SourceFormat.CSV,
+        write_disposition=WriteDisposition.WRITE_APPEND,
     )
 
-    table_ref = client.dataset(dataset_id).table(table_id)
+    if manifest.get("format") == "parquet":
+        # columns are typed in the parquet files
+        job_config.source_format = SourceFormat.PARQUET
+        job_config.skip_leading_rows = None
 
     # Load the data into BigQuery
     try:
-        load_job = client.load_table_from_uri(file_path, table_ref, job_config=job_config)
+        load_job = client.load_table_from_uri(source_uris, table, job_config=job_config)
         load_job.result()  # Waits for the job to complete
 
         print(f"CSV file {file_path} loaded into BigQuery table {table_id}")
@@ -5,6 +5,7 @@ import warnings
 from dotenv import load_dotenv
 from flask import Flask, flash, redirect, render_template, request, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import selectinload
 from werkzeug.middleware.proxy_fix import ProxyFix
 from wtforms.fields import StringField, SubmitField
 
@@ -19,6 +20,9 @@ with warnings.catch_warnings():
 
 __PAGE_SIZE__ = 50
 
+# the commit list shows the first repository of each commit, load them all with one more query
+__COMMIT_LIST_OPTIONS__ = [selectinload(Commit.repos)]
+
 load_dotenv()
 
 
@@ -77,25 +81,28 @@ def search():
 
     if len(search_term) == 40 and re.match(r"[0-9a-f]{40}", search_term):
         # looks like a git hash
-        commits = db.session.query(Commit).filter(Commit.sha.__eq__(search_term)).all()
+        commits = (
+            db.session.query(Commit).options(*__COMMIT_LIST_OPTIONS__).filter(Commit.sha.__eq__(search_term)).all()
+        )
 
     elif "@" in search_term:
         # extract the email address from the search_term
         match = re.search(r"\b(\S+@\S+)\b", search_term)
         if match:
             search_email = match[0]
-            authors = db.session.query(Author).filter(Author.real_email.__eq__(search_email)).all()
-            if len(authors) > 0:
+            commits = (
+                db.session.query(Commit)
+                .options(*__COMMIT_LIST_OPTIONS__)
+                .join(Commit.author)
+                .filter(Author.real_email.__eq__(search_email))
+                .order_by(Commit.n_lines_changed.desc())
+                .limit(__PAGE_SIZE__)
+                .all()
+            )
+            if len(commits) > 0:
                 title = f"Commits by {search_email}"
-                commits = (
-                    db.session.query(Commit)
-                    .filter(Commit.author_id.in_([a.id for a in authors]))
-                    .order_by(Commit.n_lines_changed.desc())
-                    .limit(__PAGE_SIZE__)
-                    .all()
-                )
             else:
-                flash(f"cannot find any author with the email {search_email}", "danger")
+                flash(f"cannot find any commit by the email {search_email}", "danger")
         else:
             flash("please enter a valid email address", "danger")
 
@@ -106,6 +113,7 @@ def search():
             title = f"Commits in repository {repo.repo_name}"
             commits = (
                 db.session.query(Commit)
+                .options(*__COMMIT_LIST_OPTIONS__)
                 .filter(Commit.repos.any(id=repo.id))
                 .order_by(Commit.n_lines_changed.desc())
                 .limit(__PAGE_SIZE__)
@@ -1,36 +1,169 @@
-import csv
+import multiprocessing
 import os
 import sqlite3
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from flask_sqlalchemy import SQLAlchemy
 from git.exc import GitCommandError
-from pydriller import Repository as PyDrillerRepository
-from pydriller.domain.commit import Commit as PyDrillerCommit
-from sqlalchemy import create_engine
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    create_engine,
+    event,
+    func,
+    insert,
+    inspect,
+    or_,
+    select,
+    text,
+    update,
+)
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import TextClause
 
-from utils import (
-    display_url,
-    log,
-    normalize_branches,
-    patch_ssh_gitlab_url,
-    should_exclude_from_stats,
-)
+from utils import ExcludeRules, display_url, exclude_rules, log, match_any
 
+from .export import PARTITION_ORDER, export_csv, export_parquet
+from .extract import (
+    EXTRACTORS,
+    METRICS_LEVELS,
+    CommitRecord,
+    FileRecord,
+    GitRecord,
+    KnownCommit,
+    RefTips,
+    commit_metrics,
+    extract_repository,
+    init_worker,
+    iter_commits,
+    open_repository,
+    queued_records,
+)
 from .models import (
+    Author,
+    AuthorCache,
     Base,
     Commit,
+    CommitChange,
+    CommitMessage,
     CommittedFile,
-    ensure_author,
+    Path,
+    PathCache,
+    Repository,
+    ShaSet,
+    commit_summary,
     ensure_repository,
-    load_commit,
+    link_commits,
+    load_checkpoint,
+    load_exclude_rules_version,
+    load_export_watermark,
+    load_known_commits,
+    load_ref_tips,
+    load_sha_set,
+    log_commit_changes,
+    repo_to_commit_table,
+    reset_export_watermark,
+    save_checkpoint,
+    save_exclude_rules_version,
+    save_export_watermark,
+    save_ref_tips,
+    update_branches,
+    upgrade_schema,
+)
+from .pipeline import pipeline
+from .stats import (
+    DELETE_COMMIT_DATA_SQL,
+    DELETE_REPO_COMMIT_DATA_SQL,
+    DROP_TABLE_SQL,
+    DROP_VIEW_SQL,
+    INSERT_COMMIT_DATA_SQL,
+    INSERT_REPO_COMMIT_DATA_SQL,
+    MATERIALIZE_SQL,
+    QUERY_SQL,
+    REFRESH_AUTHOR_COMMIT_DATA_SQL,
+    REFRESH_ONE_REPO_COMMIT_DATA_SQL,
+    REFRESH_REPO_COMMIT_DATA_SQL,
+    STATS_BY_SHA_SQL,
+    STATS_SQL,
+    VIEW_SQL,
+    ZERO_STATS_BY_SHA_SQL,
+    ZERO_STATS_SQL,
+)
+
+# how new commits are written to database
+# orm:  through the ORM unit of work, one INSERT per row
+# bulk: plain rows written with executemany, much faster for large repositories
+WRITERS = ["orm", "bulk"]
+
+# how the sqlite database in db_file is used
+# memory: loaded into an in-memory database at start, saved back to the file by close()
+# wal:    used in place in write-ahead log mode, every batch committed is on disk
+DB_MODES = ["memory", "wal"]
+
+# chunks of records of a repository extracted by a worker process that wait to be saved,
+# see extract.extract_repository()
+QUEUED_CHUNKS = 4
+
+# pages copied at a time by snapshots of the memory database, 4MB with the default page size
+SNAPSHOT_PAGES = 1024
+
+# set on every connection to the database in wal mode
+WAL_PRAGMAS = {
+    "journal_mode": "WAL",
+    # fsync at checkpoints only, a crash may lose the last transactions but never corrupts the database
+    "synchronous": "NORMAL",
+    "cache_size": -262144,  # 256MB
+    "mmap_size": 1073741824,  # 1GB
+    "temp_store": "MEMORY",
+    "busy_timeout": 60000,
+}
+
+# paths whose classification changed, used by Indexer.reclassify_files()
+_reclassified_paths_ = Table(
+    "reclassified_paths",
+    MetaData(),
+    Column("path_id", Integer, primary_key=True),
+    Column("excluded", Boolean),
+    prefixes=["TEMPORARY"],
 )
-from .stats import QUERY_SQL, STATS_SQL
+
+
+class ExportChanges(NamedTuple):
+    """commits changed between 2 exports, since is None when everything has to be exported"""
+
+    since: Optional[int]
+    until: int
+    shas: List[str]
+
+
+class CommitRows(NamedTuple):
+    """a new commit converted to plain rows for the bulk writer"""
+
+    record: CommitRecord
+    commit: Dict[str, Any]
+    files: List[Dict[str, Any]]
 
 
 class Indexer:
@@ -40,6 +173,17 @@ class Indexer:
         db_file: str = "",
         echo: bool = False,
         flask_db: Optional[SQLAlchemy] = None,
+        extractor: str = "pydriller",
+        metrics: str = "methods",
+        batch_commits: int = 1000,
+        batch_files: int = 20000,
+        writer: str = "orm",
+        queue_size: int = 0,
+        jobs: int = 1,
+        materialize: bool = False,
+        db_mode: str = "memory",
+        checkpoint_interval: int = 300,
+        snapshot_interval: int = 0,
     ):
         """
         initialize the Indexer object
@@ -52,7 +196,66 @@ class Indexer:
         :param flask_db:    If specified, use this SQLAlchemy object to initialize the indexer, supersedes uri paramter.
                             When sharing database with flask-sqlalchemy, we let it initialize the database first, then
                             pass SQLAlchemy objectto Indexer so that Indexer can use the same database engine
+        :param extractor:   How commits are extracted from git, one of EXTRACTORS.
+                            "pydriller" (default) computes all metrics using PyDriller.
+                            "gitlog" streams a single git log --numstat per repository, which is an order of
+                            magnitude faster.
+        :param metrics:     File metrics to compute for new commits, one of METRICS_LEVELS.
+                            "lines" only keeps the line counts that come with the diff, "loc" adds n_lines_of_code,
+                            "methods" (default) adds n_methods and n_methods_changed. The last 2 levels requires
+                            source code analysis and are much slower. Use backfill_metrics() to compute them later.
+        :param batch_commits: While indexing a repository, commit the transaction after this many new commits,
+                            an interrupted run resumes from the last batch committed.
+        :param batch_files: Also commit the transaction after this many new files.
+        :param writer:      How new commits are written, one of WRITERS. "orm" (default) goes through the
+                            ORM unit of work, "bulk" writes plain rows with executemany.
+        :param queue_size:  When greater than 0, git traversal, building rows for the bulk writer and database
+                            writes run in separate threads connected by queues of this many records.
+                            Only applies when repositories are indexed one at a time.
+        :param jobs:        When greater than 1, diffs and file metrics of the new commits of a repository are
+                            computed in a pool of this many processes, so that one large repository does not
+                            take much longer than everything else.
+        :param materialize: Replace the all_commit_data view with a table, see materialize_commit_data().
+                            Once materialized, the table is kept up to date whether this is set or not.
+        :param db_mode:     How the sqlite database in db_file is used when uri is not given, one of DB_MODES.
+                            "memory" (default) loads it into memory and saves it back when closed, "wal" opens
+                            it in place in write-ahead log mode, so memory usage does not grow with the database
+                            and a crash only loses the batch being written.
+        :param checkpoint_interval: In wal mode, copy the write-ahead log into the database after a batch is
+                            committed if this many seconds have passed since the last time.
+        :param snapshot_interval: In memory mode, when greater than 0, save the database to db_file
+                            after a batch is committed if this many seconds have passed since the
+                            last snapshot, see snapshot_db().
         """
+        if extractor not in EXTRACTORS:
+            raise ValueError(f"extractor must be one of {EXTRACTORS}")
+        if metrics not in METRICS_LEVELS:
+            raise ValueError(f"metrics must be one of {METRICS_LEVELS}")
+        if writer not in WRITERS:
+            raise ValueError(f"writer must be one of {WRITERS}")
+        if db_mode not in DB_MODES:
+            raise ValueError(f"db_mode must be one of {DB_MODES}")
+        self.writer = writer
+        self.queue_size = queue_size
+        self.jobs = jobs
+        self.extractor = extractor
+        self.metrics = metrics
+        self.batch_commits = batch_commits
+        self.batch_files = batch_files
+        self._shas: Optional[ShaSet] = None
+        self._authors: Optional[AuthorCache] = None
+        self._paths: Optional[PathCache] = None
+        self._materialized: Optional[bool] = None
+        self._log_changes: Optional[bool] = None
+        self.is_wal = False
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpointed_at = time.monotonic()
+        self.snapshot_interval = snapshot_interval
+        self._snapshot: Optional[threading.Thread] = None
+        # changes of the memory database saved by the last snapshot, see _db_state_()
+        self._snapshot_state: Optional[Tuple[int, int]] = None
+        self._snapshot_at = time.monotonic()
+
         if flask_db:
             self._init_from_flask_db(flask_db)
             self.db_file = ""
@@ -60,6 +263,11 @@ class Indexer:
             env_uri = os.environ.get("SQLALCHEMY_DATABASE_URI")
             if uri:
                 self.uri = uri
+            elif db_mode == "wal":
+                if not db_file:
+                    raise ValueError("db_file is required in wal mode")
+                self.uri = f"sqlite:///{os.path.abspath(db_file)}"
+                self.is_wal = True
             elif env_uri:
                 self.uri = env_uri
             else:
@@ -68,17 +276,51 @@ class Indexer:
             self._init_db_(self.uri, db_file, echo)
 
         Base.metadata.create_all(self.engine)
+        upgrade_schema(self.engine)
+        if not self._has_commit_data_():
+            # e.g. a new database, or the view was dropped by upgrade_schema()
+            self.update_views()
+        # a new database records the rules, otherwise indexing is refused until the files are reclassified
+        self._check_exclude_rules_()
+        if materialize and not self._is_materialized_():
+            self.materialize_commit_data()
 
     def _init_db_(self, uri: str, db_file: str, echo: bool = False):
         self.is_mem_db = ":memory:" in self.uri
         self.db_file = db_file
-        self.engine = create_engine(self.uri, echo=echo)
+        if self.is_mem_db:
+            # snapshots read the memory database from another thread
+            self.engine = create_engine(self.uri, echo=echo, connect_args={"check_same_thread": False})
+            event.listen(self.engine, "before_cursor_execute", self._wait_snapshot_)
+        else:
+            self.engine = create_engine(self.uri, echo=echo)
+        if self.is_wal:
+            event.listen(self.engine, "connect", _set_wal_pragmas_)
         self.session = Session(self.engine)
 
         if self.is_mem_db and db_file and os.path.isfile(db_file):
             disk_db = sqlite3.connect(db_file)
             disk_db.backup(self.session.connection().connection.driver_connection)  # type: ignore   #it works...
             log(f"loaded database {db_file} into memory")
+            self._snapshot_state = self._db_state_()
+
+    def _check_exclude_rules_(self) -> bool:
+        """
+        new files are classified with the current exclude rules, which must be the rules the indexed files were
+        classified with, so that the saved version describes all of them. returns False if they are not
+        """
+        rules = exclude_rules()
+        version = load_exclude_rules_version(self.session)
+        if version is None:
+            save_exclude_rules_version(self.session, rules)
+            self.session.commit()
+        elif version != rules.version:
+            log(
+                f"indexed files were classified with exclude rules {version}, "
+                f"use --reclassify to apply {rules.version} before indexing"
+            )
+            return False
+        return True
 
     def _init_from_flask_db(self, flask_db: SQLAlchemy):
         """
@@ -97,110 +339,522 @@ class Indexer:
 
     def close(self):
         """
-        close the database connection and save the database to disk if it's a memory database
+        close the database connection and save the database to disk if it's a memory database.
+        in wal mode, the write-ahead log is copied into the database file, which can then be copied alone
         """
+        if self.is_wal:
+            self._checkpoint_("TRUNCATE")
+        self._wait_snapshot_()
         self.session.close()
 
         if self.is_mem_db and self.db_file:
-            self._export_db_(self.db_file)
+            if self._db_state_() == self._snapshot_state:
+                log(f"database unchanged since it was loaded or saved, not saving to {self.db_file}")
+            else:
+                self._export_db_(self.db_file)
+        if self.is_wal:
+            self.engine.dispose()
 
         # self.engine.dispose()
 
-    def _export_db_(self, dbf: str):
+    def _export_db_(self, dbf: str, source: Optional[sqlite3.Connection] = None, pages: int = -1):
         if "sqlite://" not in self.uri:
             log("not a sqlite database, not exporting")
             return
 
+        if source is None:
+            source = self.session.connection().connection.driver_connection
+
         # export database to file
         # write to temp file first then rename to avoid potentially corrupting the database
         tmp_file = dbf + ".new"
+        if os.path.exists(tmp_file):
+            # left by an interrupted run
+            os.unlink(tmp_file)
         file_conn = sqlite3.connect(tmp_file)
-        self.session.connection().connection.driver_connection.backup(file_conn)  # type: ignore   #it works...
+        progress = _backup_progress_(dbf) if pages > 0 else None
+        source.backup(file_conn, pages=pages, progress=progress, sleep=0)  # type: ignore   #it works...
         file_conn.close()
 
-        if dbf and os.path.exists(dbf):
-            os.unlink(dbf)
-        os.rename(tmp_file, dbf)
+        os.replace(tmp_file, dbf)
         log(f"saved database to {dbf}")
 
+    def snapshot_db(self, wait: bool = False) -> bool:
+        """
+        save the memory database to db_file, unless nothing has changed since the last time. a background
+        thread copies SNAPSHOT_PAGES pages at a time. the next statement on the database waits for it to
+        finish, so the snapshot has everything committed when it started. only work that does not touch the
+        database goes on meanwhile, e.g. git extraction in the pipeline thread or in worker processes.
+        returns True if a snapshot is started
+
+        :param wait:    wait for the snapshot to be saved
+        """
+        if not (self.is_mem_db and self.db_file) or self._snapshot is not None:
+            return False
+
+        self.session.commit()
+        self._snapshot_at = time.monotonic()
+        state = self._db_state_()
+        if state == self._snapshot_state:
+            log("database unchanged since the last snapshot, skipping")
+            return False
+
+        self._snapshot_state = state
+        source = self.session.connection().connection.driver_connection
+        self._snapshot = threading.Thread(target=self._snapshot_db_, args=(source,), daemon=True)
+        self._snapshot.start()
+        if wait:
+            self._wait_snapshot_()
+        return True
+
+    def _snapshot_db_(self, source: sqlite3.Connection) -> None:
+        try:
+            self._export_db_(self.db_file, source, SNAPSHOT_PAGES)
+        except Exception as e:
+            # saved again by the next snapshot
+            self._snapshot_state = None
+            exc = traceback.format_exc()
+            print(f"Exception saving snapshot to {self.db_file} => {str(e)}\n{exc}")
+
+    def _wait_snapshot_(self, *args: Any) -> None:
+        """called before every statement on the memory database, which is not changed while it is being saved"""
+        if self._snapshot is not None:
+            started_at = time.monotonic()
+            self._snapshot.join()
+            self._snapshot = None
+            waited = time.monotonic() - started_at
+            if waited >= 1:
+                log(f"waited {waited:.1f}s for the snapshot to be saved")
+
+    def _db_state_(self) -> Tuple[int, int]:
+        """rows changed in the memory database and its schema version, the same when nothing has changed"""
+        driver_connection = self.session.connection().connection.driver_connection
+        return driver_connection.total_changes, self.session.scalar(text("PRAGMA schema_version"))  # type: ignore
+
+    def _checkpoint_(self, mode: str = "PASSIVE") -> None:
+        """
+        copy the write-ahead log into the database, so that it does not grow while indexing. PASSIVE does not
+        wait for readers, e.g. the GUI, TRUNCATE also empties the log
+        """
+        self.session.commit()
+        busy, n_pages, n_copied = self.session.execute(text(f"PRAGMA wal_checkpoint({mode})")).one()
+        self._checkpointed_at = time.monotonic()
+        if busy or n_copied < n_pages:
+            log(f"checkpoint copied {n_copied:,} of {n_pages:,} pages of the write-ahead log")
+
     def index_repository(
         self, clone_url: str, git_repo_type: str = "", show_progress: bool = False, timeout: int = 28800
     ) -> int:
-        n_branch_updates, n_new_commits = 0, 0
+        if not self._check_exclude_rules_():
+            return 0
 
         try:
             log(f"starting to index {display_url(clone_url)}")
-            start_t = datetime.now()
-            repo = ensure_repository(self.session, clone_url=clone_url, repo_type=git_repo_type)
-            if repo.is_active is False:
-                log(f"skipping inactive repository {display_url(clone_url)}")
+            repo = self._active_repository_(clone_url, git_repo_type)
+            if repo is None:
                 return 0
 
-            # use list comprehension to force loading of commits
-            old_commits = {}
-            for commit in repo.commits:
-                old_commits[commit.sha] = commit
+            known_commits = load_known_commits(self.session, repo)
+            records = iter_commits(
+                clone_url,
+                known_commits,
+                load_ref_tips(self.session, repo),
+                timeout,
+                self.extractor,
+                self.metrics,
+                self._existing_shas_(),
+                load_checkpoint(self.session, repo),
+                self.jobs,
+            )
+            if self.queue_size > 0:
+                # ORM objects can only be built in the thread that owns the session
+                transforms = [_commit_rows_] if self.writer == "bulk" else []
+                records = pipeline(records, *transforms, maxsize=self.queue_size)
+            return self._save_records_(repo, known_commits, records, show_progress)
 
-            url = patch_ssh_gitlab_url(clone_url)  # kludge: workaround for some unfortunate ssh setup
-            for git_commit in PyDrillerRepository(url, include_refs=True, include_remotes=True).traverse_commits():
-                # impose some timeout to avoid spending tons of time on very large repositories
-                if (datetime.now() - start_t).seconds > timeout:
-                    print(f"### indexing not done after {timeout} seconds, aborting {display_url(clone_url)}")
+        except GitCommandError as e:
+            print(f"{e._cmdline} returned {e.stderr} for {clone_url}")
+        except DBAPIError as e:
+            print(f"{e.statement} returned {e._message}")
+        except Exception as e:
+            exc = traceback.format_exc()
+            print(f"Exception indexing repository {clone_url} => {str(e)}\n{exc}")
+
+        # the commits of the batch that failed are not saved, the next repository must not see them
+        self._discard_unsaved_()
+        return 0
+
+    def index_repositories(
+        self,
+        repos: Iterable[Tuple[str, str]],
+        workers: int = 1,
+        show_progress: bool = False,
+        timeout: int = 28800,
+    ) -> Tuple[int, int]:
+        """
+        index multiple repositories, returns number of repositories and number of commits indexed
+
+        :param repos:       iterable of (clone_url, git_repo_type)
+        :param workers:     when greater than 1, git traversal and diff extraction runs in a pool
+                            of worker processes, while this process remains the only database writer
+        """
+        n_repos, n_commits = 0, 0
+        if not self._check_exclude_rules_():
+            return n_repos, n_commits
+
+        if workers <= 1:
+            for clone_url, git_repo_type in repos:
+                n_commits += self.index_repository(clone_url, git_repo_type, show_progress, timeout)
+                n_repos += 1
+            return n_repos, n_commits
+
+        # workers get a snapshot of existing commits, the writer checks new records against the live set.
+        # records are saved in the order the repositories are submitted, later ones wait in bounded queues
+        repos = iter(repos)
+        pending: List[Tuple[Future, Any, str, str, Repository, Dict[str, str]]] = []
+        failed: List[Tuple[str, str]] = []
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(self._existing_shas_(),)
+        ) as executor:
+            for clone_url, git_repo_type in repos:
+                n_repos += 1
+                log(f"starting to index {display_url(clone_url)}")
+                repo = self._active_repository_(clone_url, git_repo_type)
+                if repo is None:
+                    continue
+
+                known_commits = load_known_commits(self.session, repo)
+                out = manager.Queue(maxsize=QUEUED_CHUNKS)
+                try:
+                    future = executor.submit(
+                        extract_repository,
+                        out,
+                        clone_url,
+                        known_commits,
+                        load_ref_tips(self.session, repo),
+                        timeout,
+                        self.extractor,
+                        self.metrics,
+                        checkpoint=load_checkpoint(self.session, repo),
+                        jobs=self.jobs,
+                    )
+                except BrokenProcessPool:
+                    failed.append((clone_url, git_repo_type))
                     break
+                pending.append((future, out, clone_url, git_repo_type, repo, known_commits))
+
+                if len(pending) >= workers * 2:
+                    n_commits += self._save_extracted_(*pending.pop(0), failed, show_progress)
+                    if failed:
+                        break
+
+            while pending and not failed:
+                n_commits += self._save_extracted_(*pending.pop(0), failed, show_progress)
+
+        if failed:
+            # the pool is unusable once a worker process died, e.g. killed when out of memory.
+            # repositories not saved yet are indexed here, they resume from their checkpoints
+            remaining = failed + [(clone_url, git_repo_type) for _, _, clone_url, git_repo_type, _, _ in pending]
+            log("a worker process died, indexing the remaining repositories in this process")
+            for clone_url, git_repo_type in remaining:
+                n_commits += self.index_repository(clone_url, git_repo_type, show_progress, timeout)
+            for clone_url, git_repo_type in repos:
+                n_commits += self.index_repository(clone_url, git_repo_type, show_progress, timeout)
+                n_repos += 1
+
+        return n_repos, n_commits
+
+    def _active_repository_(self, clone_url: str, git_repo_type: str) -> Optional[Repository]:
+        repo = ensure_repository(self.session, clone_url=clone_url, repo_type=git_repo_type)
+        if repo.is_active is False:
+            log(f"skipping inactive repository {display_url(clone_url)}")
+            return None
+        return repo
+
+    def _save_extracted_(
+        self,
+        future: Future,
+        out: Any,
+        clone_url: str,
+        git_repo_type: str,
+        repo: Repository,
+        known_commits: Dict[str, str],
+        failed: List[Tuple[str, str]],
+        show_progress: bool,
+    ) -> int:
+        """
+        save the records of a repository as the worker extracts them. extraction errors are reported by the
+        worker, a repository whose worker process died is added to failed
+        """
+        n_commits = 0
+        records = queued_records(out, future)
+        try:
+            n_commits = self._save_records_(repo, known_commits, records, show_progress)
+        except DBAPIError as e:
+            print(f"{e.statement} returned {e._message}")
+            self._discard_unsaved_()
+        except Exception as e:
+            exc = traceback.format_exc()
+            print(f"Exception indexing repository {clone_url} => {str(e)}\n{exc}")
+            self._discard_unsaved_()
+        # e.g. after an error, the worker waits until the queue has room for the rest
+        for _ in records:
+            pass
+
+        try:
+            future.result()
+        except BrokenProcessPool as e:
+            print(f"Worker process indexing repository {clone_url} died => {str(e)}")
+            failed.append((clone_url, git_repo_type))
+        except Exception as e:
+            exc = traceback.format_exc()
+            print(f"Exception indexing repository {clone_url} => {str(e)}\n{exc}")
+
+        return n_commits
 
-                git_commit_hash = git_commit.hash
-                if git_commit_hash in old_commits:
-                    # we've seen this commit before, just compare branches and update
-                    # if needed
-                    old_commit = old_commits[git_commit_hash]
-                    new_branches = normalize_branches(git_commit.branches)
-                    if new_branches != old_commit.branches:
-                        old_commit.branches = new_branches
-                        self.session.add(old_commit)
-                        n_branch_updates += 1
+    def _discard_unsaved_(self) -> None:
+        """roll back the batch being saved, the caches may contain commits, authors and paths of it"""
+        self.session.rollback()
+        self._shas, self._authors, self._paths = None, None, None
+
+    def _link_commits_(self, repo: Repository, shas: List[str]) -> None:
+        # a commit that is in the set of existing commits but not in the database would be lost for the
+        # repository, fail the batch instead so that the set is reloaded and the commit is indexed next time
+        n_linked = link_commits(self.session, repo, shas)
+        if n_linked < len(shas):
+            raise ValueError(f"{len(shas) - n_linked} commits to add to {repo.clone_url} are not in the database")
+
+    def _existing_shas_(self) -> ShaSet:
+        """hashes of all commits in the database, loaded once and kept up to date by _save_records_"""
+        if self._shas is None:
+            self._shas = load_sha_set(self.session)
+        return self._shas
+
+    def _save_records_(
+        self,
+        repo: Repository,
+        known_commits: Dict[str, str],
+        records: Iterable[Union[GitRecord, CommitRows]],
+        show_progress: bool = False,
+    ) -> int:
+        """
+        write the records extracted from a repository to database
+
+        :param known_commits:   sha -> branches of commits already in the repository, as given to the extractor
+        """
+        n_branch_updates, n_new_commits = 0, 0
+        existing_shas = self._existing_shas_()
+
+        # new commits are emitted parents first, so all the commits saved so far are reachable
+        # from the ones whose children have not been saved yet. they are the checkpoint
+        checkpoint = set(load_checkpoint(self.session, repo))
+        is_completed = False
+
+        # branch updates and commits that already exist in other repositories are written in batches
+        branch_updates: Dict[str, str] = {}
+        links: List[str] = []
+        # new and linked commits of the batch, whose rows are added to the materialized all_commit_data
+        batch_shas: List[str] = []
+        # new commits waiting to be written by the bulk writer
+        new_commits: List[Tuple[Author, CommitRows]] = []
+        n_batch_commits, n_batch_files = 0, 0
+        git_commit_hash = ""
+        for item in records:
+            # new commits may have been converted to rows already
+            rows, record = (item, item.record) if isinstance(item, CommitRows) else (None, item)
+            if isinstance(record, RefTips):
+                # the repository has been traversed completely, next time start from here
+                save_ref_tips(self.session, repo, record.tips)
+                is_completed = True
+                continue
+
+            git_commit_hash = record.sha
+            if git_commit_hash in known_commits:
+                # we've seen this commit before, just compare branches and update
+                # if needed
+                if record.branches != known_commits[git_commit_hash]:
+                    branch_updates[git_commit_hash] = record.branches
+                    n_branch_updates += 1
+            else:
+                if isinstance(record, KnownCommit) or git_commit_hash in existing_shas:
+                    # new commit in this repo, but it's already in another repo
+                    links.append(git_commit_hash)
+                elif self.writer == "bulk":
+                    new_commits.append((self._author_(record), rows or _commit_rows_(record)))
+                    existing_shas.add(git_commit_hash)
+                    n_batch_files += len(record.files)
                 else:
-                    # new commit in this repo, check if the repo is already exist in another repo
-                    new_commit = load_commit(self.session, git_commit_hash)
-                    if new_commit is None:
-                        new_commit = self._new_commit_(git_commit)
-                    repo.commits.append(new_commit)
-                    n_new_commits += 1
-
-                nn = n_new_commits + n_branch_updates
-                if nn > 0 and nn % 200 == 0 and show_progress:
-                    log(f"indexed {n_new_commits:5,} new commits and {n_branch_updates:5,} branch updates")
-
-            repo.last_indexed_at = datetime.now().astimezone().isoformat(timespec="seconds")
+                    new_commit = self._new_commit_(record)
+                    new_commit.repos.append(repo)
+                    self.session.add(new_commit)
+                    existing_shas.add(git_commit_hash)
+                    n_batch_files += len(record.files)
+
+                batch_shas.append(git_commit_hash)
+                checkpoint.difference_update(record.parents)
+                checkpoint.add(git_commit_hash)
+                n_new_commits += 1
+                n_batch_commits += 1
+
+            if len(branch_updates) >= 500:
+                update_branches(self.session, branch_updates)
+                branch_updates.clear()
+            if len(links) >= 500:
+                self._link_commits_(repo, links)
+                links.clear()
+
+            if n_batch_commits >= self.batch_commits or n_batch_files >= self.batch_files:
+                if not self._save_batch_(
+                    repo, new_commits, branch_updates, links, batch_shas, checkpoint, git_commit_hash
+                ):
+                    return n_new_commits + n_branch_updates
+                n_batch_commits, n_batch_files = 0, 0
+
+            nn = n_new_commits + n_branch_updates
+            if nn > 0 and nn % 200 == 0 and show_progress:
+                log(f"indexed {n_new_commits:5,} new commits and {n_branch_updates:5,} branch updates")
+
+        repo.last_indexed_at = datetime.now().astimezone().isoformat(timespec="seconds")
+        if self._is_materialized_():
+            # the existing rows of the repository in all_commit_data have the new last_indexed_at too
+            self.session.flush()
+            self.session.execute(REFRESH_ONE_REPO_COMMIT_DATA_SQL, {"repo_id": repo.id})
+        checkpoint = set() if is_completed else checkpoint
+        self._save_batch_(repo, new_commits, branch_updates, links, batch_shas, checkpoint, git_commit_hash)
+
+        if (n_new_commits + n_branch_updates) > 0:
+            log(f"indexed {n_new_commits:5,} new commits and {n_branch_updates:5,} branch updates in the repository")
+
+        return n_new_commits + n_branch_updates
+
+    def _save_batch_(
+        self,
+        repo: Repository,
+        new_commits: List[Tuple[Author, CommitRows]],
+        branch_updates: Dict[str, str],
+        links: List[str],
+        shas: List[str],
+        checkpoint: Set[str],
+        git_commit_hash: str,
+    ) -> bool:
+        """
+        write pending updates and the checkpoint of the repository, then commit and remove the saved
+        commits from the session to keep memory usage flat. returns False if the commit failed
+        """
+        try:
+            self._insert_commits_(repo, new_commits)
+            update_branches(self.session, branch_updates)
+            self._link_commits_(repo, links)
+            self._commit_data_changed_(shas, repo)
+            save_checkpoint(self.session, repo, checkpoint)
             self.session.add(repo)
+            self.session.commit()
+        except Exception as e:
+            exc = traceback.format_exc()
+            print(f"### unable to save commit {git_commit_hash} => {str(e)}\n{exc}", file=sys.stderr)
+            self._discard_unsaved_()
+            return False
+        finally:
+            new_commits.clear()
+            branch_updates.clear()
+            links.clear()
+            shas.clear()
 
+        for obj in list(self.session.identity_map.values()):
+            if isinstance(obj, (Commit, CommittedFile)):
+                self.session.expunge(obj)
+
+        if self.is_wal and time.monotonic() - self._checkpointed_at >= self.checkpoint_interval:
+            self._checkpoint_()
+        if self.snapshot_interval > 0 and time.monotonic() - self._snapshot_at >= self.snapshot_interval:
+            self.snapshot_db()
+        return True
+
+    def update_commit_stats(self, shas: Optional[Iterable[str]] = None) -> None:
+        """
+        update stats at commit level, then recreate the views. new commits have their stats computed
+        when they are indexed, so this is only needed for commits whose files have changed since,
+        given by shas. when shas is None, stats of all commits are updated
+        """
+        statements: List[Tuple[List[TextClause], Dict[str, Any]]] = []
+        if shas is None:
+            log("updating commit stats")
+            statements = [([ZERO_STATS_SQL, STATS_SQL], {})]
+        else:
+            shas = list(shas)
+            log(f"updating commit stats of {len(shas):,} commits")
+            statements = [
+                ([ZERO_STATS_BY_SHA_SQL, STATS_BY_SHA_SQL], {"shas": shas[i : i + 500]})
+                for i in range(0, len(shas), 500)
+            ]
+
+        for batch, params in statements:
             try:
+                for statement in batch:
+                    self.session.execute(statement, params)
+                if "shas" in params:
+                    # the rows of the commits in all_commit_data have the stats too
+                    self._commit_data_changed_(params["shas"])
                 self.session.commit()
-            except Exception as e:
-                exc = traceback.format_exc()
-                print(f"### unable to save commit {git_commit_hash} => {str(e)}\n{exc}", file=sys.stderr)
+            except DBAPIError as e:
                 self.session.rollback()
+                exc = traceback.format_exc()
+                print(f"Exception execute statement {batch} => {str(e)}\n{exc}")
 
-            if (n_new_commits + n_branch_updates) > 0:
-                log(
-                    f"indexed {n_new_commits:5,} new commits and {n_branch_updates:5,} branch updates in the repository"
-                )
+        if shas is None and self._logs_changes_():
+            # everything may have changed, the next export of changes exports everything
+            reset_export_watermark(self.session)
+            self.session.commit()
+            self._log_changes = False
+        if shas is None and self._is_materialized_():
+            self.materialize_commit_data()
+        self.update_views()
 
-            return n_new_commits + n_branch_updates
+    def update_views(self) -> None:
+        if self._is_materialized_():
+            # all_commit_data is a table that is kept up to date
+            self.refresh_commit_data()
+            return
 
-        except GitCommandError as e:
-            print(f"{e._cmdline} returned {e.stderr} for {clone_url}")
+        for statement in VIEW_SQL:
+            try:
+                self.session.execute(statement)
+                self.session.commit()
+            except DBAPIError as e:
+                self.session.rollback()
+                exc = traceback.format_exc()
+                print(f"Exception execute statement {statement} => {str(e)}\n{exc}")
+
+    def materialize_commit_data(self) -> None:
+        """
+        replace the all_commit_data view with a table of the same rows, indexed on the common filter columns,
+        so that exports and queries scan the table instead of joining 5 tables every time.
+        afterwards the rows of new commits and commits whose stats or metrics change are rewritten as they are
+        saved, and the rows of a repository get its new last_indexed_at when it is indexed.
+        see refresh_commit_data() for repositories and authors changed otherwise
+        """
+        log("materializing all_commit_data")
+        statements = [DROP_TABLE_SQL if self._is_materialized_() else DROP_VIEW_SQL, *MATERIALIZE_SQL]
+        try:
+            for statement in statements:
+                self.session.execute(statement)
+            self.session.commit()
+            self._materialized = True
         except DBAPIError as e:
-            print(f"{e.statement} returned {e._message}")
-        except Exception as e:
+            self.session.rollback()
             exc = traceback.format_exc()
-            print(f"Exception indexing repository {clone_url} => {str(e)}\n{exc}")
+            print(f"Exception materializing all_commit_data => {str(e)}\n{exc}")
 
-        return 0
+    def refresh_commit_data(self) -> None:
+        """
+        update the repository and author attributes of the rows of the materialized all_commit_data,
+        e.g. after authors are aliased in the database. only the rows that differ are written.
+        update_views() does this too
+        """
+        if not self._is_materialized_():
+            return
 
-    def update_commit_stats(self) -> None:
-        """update stats at commit level"""
-        log("updating commit stats")
-        for statement in STATS_SQL:
+        for statement in [REFRESH_REPO_COMMIT_DATA_SQL, REFRESH_AUTHOR_COMMIT_DATA_SQL]:
             try:
                 self.session.execute(statement)
                 self.session.commit()
@@ -209,57 +863,359 @@ class Indexer:
                 exc = traceback.format_exc()
                 print(f"Exception execute statement {statement} => {str(e)}\n{exc}")
 
-    def _new_commit_(self, commit: PyDrillerCommit) -> Commit:
-        author = ensure_author(self.session, commit.committer.name.lower(), commit.committer.email.lower())
-
-        git_commit = Commit(
-            sha=commit.hash,
-            message=commit.msg[:2048],  # some commits has super long message, e.g. squash merge
-            author=author,
-            is_merge=commit.merge,
-            branches=normalize_branches(commit.branches),
-            n_lines=commit.lines,
-            n_files=commit.files,
-            n_insertions=commit.insertions,
-            n_deletions=commit.deletions,
-            # comment to save some time. metrics not used for now
-            # dmm_unit_size=commit.dmm_unit_size,
-            # dmm_unit_complexity=commit.dmm_unit_complexity,
-            # dmm_unit_interfacing=commit.dmm_unit_interfacing,
-            created_at=commit.committer_date.isoformat(),
-            created_ts=commit.committer_date,
-        )
+    def _has_commit_data_(self) -> bool:
+        inspector = inspect(self.session.connection())
+        return "all_commit_data" in inspector.get_view_names() or self._is_materialized_()
+
+    def _is_materialized_(self) -> bool:
+        if self._materialized is None:
+            self._materialized = "all_commit_data" in inspect(self.session.connection()).get_table_names()
+        return self._materialized
+
+    def _logs_changes_(self) -> bool:
+        if self._log_changes is None:
+            self._log_changes = load_export_watermark(self.session) is not None
+        return self._log_changes
 
-        for mod in commit.modified_files:
-            file_path = mod.new_path or mod.old_path
-            flag = should_exclude_from_stats(file_path)
-            new_file = CommittedFile(
-                commit_sha=commit.hash,
-                change_type=str(mod.change_type).split(".")[1],  # enum ModificationType.ADD => "ADD"
-                file_path=file_path,
-                file_name=mod.filename,
-                n_lines_added=mod.added_lines,
-                n_lines_deleted=mod.deleted_lines,
-                n_lines_changed=mod.added_lines + mod.deleted_lines,
-                n_lines_of_code=mod.nloc,
-                n_methods=len(mod.methods),
-                n_methods_changed=len(mod.changed_methods),
-                is_on_exclude_list=flag,
-                is_superfluous=flag,
+    def _commit_data_changed_(self, shas: List[str], repo: Optional[Repository] = None) -> None:
+        """
+        the rows of the commits in all_commit_data are added or changed, only those of repo if given.
+        log them for the next export of changes and rewrite them if all_commit_data is materialized
+        """
+        if shas and self._logs_changes_():
+            log_commit_changes(self.session, shas)
+        if not shas or not self._is_materialized_():
+            return
+
+        if repo is None:
+            delete_sql, insert_sql, params = DELETE_COMMIT_DATA_SQL, INSERT_COMMIT_DATA_SQL, {}
+        else:
+            delete_sql, insert_sql, params = (
+                DELETE_REPO_COMMIT_DATA_SQL,
+                INSERT_REPO_COMMIT_DATA_SQL,
+                {"repo_id": repo.id},
             )
-            git_commit.files.append(new_file)
 
+        # new commits may still be pending in the session
+        self.session.flush()
+        for i in range(0, len(shas), 500):
+            batch = {"shas": shas[i : i + 500], **params}
+            self.session.execute(delete_sql, batch)
+            self.session.execute(insert_sql, batch)
+
+    def _author_(self, record: CommitRecord) -> Author:
+        if self._authors is None:
+            self._authors = AuthorCache(self.session)
+        return self._authors.get(record.author_name, record.author_email)
+
+    def _path_cache_(self) -> PathCache:
+        if self._paths is None:
+            self._paths = PathCache(self.session)
+        return self._paths
+
+    def _new_commit_(self, record: CommitRecord) -> Commit:
+        # paths are resolved first, looking them up flushes the session
+        file_rows = self._path_cache_().resolve(
+            [_file_fields_(record.sha, file_record) for file_record in record.files]
+        )
+        git_commit = Commit(author=self._author_(record), **_commit_fields_(record))
+        for row in file_rows:
+            git_commit.files.append(CommittedFile(**row))
         return git_commit
 
-    def export_all_data(self, csv_file: str) -> None:
+    def _insert_commits_(self, repo: Repository, new_commits: List[Tuple[Author, CommitRows]]) -> None:
+        """write new commits, their files and links to the repository with one executemany per table"""
+        if not new_commits:
+            return
+
+        # new authors are added to the session by the author cache, flush them to get their ids
+        self.session.flush()
+
+        commit_rows, message_rows, file_rows = [], [], []
+        for author, rows in new_commits:
+            commit = {"author_id": author.id, **rows.commit}
+            message_rows.append({"sha": commit["sha"], "message": commit.pop("message")})
+            commit_rows.append(commit)
+            file_rows.extend(rows.files)
+
+        self.session.execute(insert(Commit.__table__), commit_rows)
+        self.session.execute(insert(CommitMessage.__table__), message_rows)
+        if file_rows:
+            self.session.execute(insert(CommittedFile.__table__), self._path_cache_().resolve(file_rows))
+        self.session.execute(
+            insert(repo_to_commit_table), [{"repo_id": repo.id, "commit_id": row["sha"]} for row in commit_rows]
+        )
+
+    def backfill_metrics(
+        self,
+        repo_filter: str = "*",
+        metrics: str = "methods",
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> int:
+        """
+        compute file metrics for commits that were indexed with a lower metrics level,
+        returns the number of commits updated
+
+        :param repo_filter:     only repositories with clone_url matching these patterns, see utils.match_any
+        :param metrics:         metrics level to compute, one of METRICS_LEVELS
+        :param since:           only commits created at or after this time
+        :param until:           only commits created before this time
+        """
+        if metrics not in METRICS_LEVELS:
+            raise ValueError(f"metrics must be one of {METRICS_LEVELS}")
+
+        lower_levels = METRICS_LEVELS[: METRICS_LEVELS.index(metrics)]
+        n_commits = 0
+        for repo in self.session.scalars(select(Repository)).all():
+            if repo.is_active is False or not match_any(repo.clone_url, repo_filter):
+                continue
+
+            query = select(Commit.sha).where(Commit.repos.any(id=repo.id), Commit.metrics_level.in_(lower_levels))
+            if since:
+                query = query.where(Commit.created_ts >= since)
+            if until:
+                query = query.where(Commit.created_ts < until)
+            shas = self.session.scalars(query).all()
+            if not shas:
+                continue
+
+            log(f"computing {metrics} metrics for {len(shas):5,} commits in {display_url(repo.clone_url)}")
+            try:
+                with open_repository(repo.clone_url) as git:
+                    for sha in shas:
+                        metrics_by_path = commit_metrics(git, sha, metrics)
+                        files = self.session.scalars(select(CommittedFile).where(CommittedFile.commit_id == sha))
+                        for committed_file in files:
+                            for key, value in metrics_by_path.get(committed_file.file_path, {}).items():
+                                setattr(committed_file, key, value)
+                        self.session.execute(update(Commit).where(Commit.sha == sha).values(metrics_level=metrics))
+                self._commit_data_changed_(list(shas))
+                self.session.commit()
+                n_commits += len(shas)
+            except GitCommandError as e:
+                self.session.rollback()
+                print(f"{e._cmdline} returned {e.stderr} for {repo.clone_url}")
+            except DBAPIError as e:
+                self.session.rollback()
+                print(f"{e.statement} returned {e._message}")
+
+        return n_commits
+
+    def reclassify_files(self, rules: Optional[ExcludeRules] = None, batch_size: int = 50000) -> int:
+        """
+        classify indexed files again with the exclude rules, e.g. after the rules file has changed, then
+        update the stats of the commits affected. returns the number of files changed.
+        each distinct path is matched once, rows are updated in ranges of batch_size ids
+
+        :param rules:       exclude rules to apply, default to utils.exclude_rules()
+        """
+        rules = rules or exclude_rules()
+        log(f"reclassifying files with exclude rules {rules.version}")
+
+        changed: Dict[int, bool] = {}
+        for path_id, file_path, is_on_exclude_list, is_superfluous in self.session.execute(
+            select(Path.id, Path.file_path, CommittedFile.is_on_exclude_list, CommittedFile.is_superfluous)
+            .join(CommittedFile, CommittedFile.path_id == Path.id)
+            .distinct()
+        ):
+            excluded = rules.match(file_path)
+            if is_on_exclude_list != excluded or is_superfluous != excluded:
+                changed[path_id] = excluded
+
+        n_files = 0
+        shas: Set[str] = set()
+        try:
+            if changed:
+                log(f"{len(changed):,} distinct paths changed")
+                # temporary table lives in the connection of the transaction, which is kept until commit
+                paths = _reclassified_paths_
+                paths.create(self.session.connection())
+                self.session.execute(insert(paths), [{"path_id": p, "excluded": e} for p, e in changed.items()])
+
+                min_id, max_id = self.session.execute(
+                    select(func.min(CommittedFile.id), func.max(CommittedFile.id))
+                ).one()
+                for start in range(min_id, max_id + 1, batch_size):
+                    in_batch = [
+                        CommittedFile.id >= start,
+                        CommittedFile.id < start + batch_size,
+                        CommittedFile.path_id == paths.c.path_id,
+                        or_(
+                            CommittedFile.is_on_exclude_list != paths.c.excluded,
+                            CommittedFile.is_superfluous != paths.c.excluded,
+                        ),
+                    ]
+                    shas.update(self.session.scalars(select(CommittedFile.commit_id).where(*in_batch).distinct()))
+                    result = self.session.execute(
+                        update(CommittedFile)
+                        .where(*in_batch)
+                        .values(is_on_exclude_list=paths.c.excluded, is_superfluous=paths.c.excluded),
+                        execution_options={"synchronize_session": False},
+                    )
+                    n_files += result.rowcount  # type: ignore
+
+                paths.drop(self.session.connection())
+
+            save_exclude_rules_version(self.session, rules)
+            self.session.commit()
+        except DBAPIError as e:
+            self.session.rollback()
+            print(f"{e.statement} returned {e._message}")
+            return 0
+
+        log(f"reclassified {n_files:,} files in {len(shas):,} commits")
+        if shas:
+            self.update_commit_stats(shas)
+        return n_files
+
+    def export_all_data(
+        self,
+        csv_file: str,
+        part_size: int = 0,
+        compression: str = "none",
+        changes: Optional[ExportChanges] = None,
+    ) -> Dict[str, Any]:
+        """
+        export all_commit_data to csv_file, streamed without loading all rows into memory.
+        returns the manifest of the files written, see export.export_csv()
+
+        :param part_size:   when greater than 0, split into part files of about this many bytes each
+        :param compression: one of COMPRESSIONS
+        :param changes:     only export the rows of these commits, see changes_to_export()
+        """
+        base, _ = os.path.splitext(csv_file)
+        query, fields = self._export_query_(changes, f"{base}.changed_commits.txt")
+        with self.engine.connect() as conn:
+            return export_csv(conn, query, csv_file, part_size, compression, manifest_fields=fields)
+
+    def export_parquet(
+        self,
+        out_dir: str,
+        partition_by: str = "none",
+        compression: str = "zstd",
+        changes: Optional[ExportChanges] = None,
+    ) -> Dict[str, Any]:
+        """
+        export all_commit_data to parquet files in out_dir, typed as the BigQuery table.
+        returns the manifest of the files written, see export.export_parquet()
+
+        :param partition_by:    one of PARTITIONS, split the files by repository or by month
+        :param compression:     parquet codec
+        :param changes:         only export the rows of these commits, see changes_to_export()
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        changes_file = os.path.join(out_dir, "all_commit_data.changed_commits.txt")
+        query, fields = self._export_query_(changes, changes_file, PARTITION_ORDER.get(partition_by, ""))
         with self.engine.connect() as conn:
-            result = conn.execute(QUERY_SQL["all_commit_data"])
-
-            n_rows = 0
-            with open(csv_file, "w", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(result.keys())
-                for row in result:
-                    n_rows += 1
-                    writer.writerow(row)
-                log(f"exported {n_rows} rows to {csv_file}")
+            return export_parquet(conn, query, out_dir, partition_by, compression, manifest_fields=fields)
+
+    def changes_to_export(self) -> ExportChanges:
+        """
+        commits whose rows in all_commit_data were added or changed since the last export marked by
+        mark_exported(). changes are logged only after the first export is marked, until then, or after
+        the stats of all commits are updated, everything has to be exported
+        """
+        since = load_export_watermark(self.session)
+        until = self.session.scalar(select(func.max(CommitChange.id))) or since or 0
+        if since is None:
+            return ExportChanges(None, until, [])
+
+        shas = self.session.scalars(
+            select(CommitChange.sha).where(CommitChange.id > since, CommitChange.id <= until).distinct()
+        ).all()
+        return ExportChanges(since, until, list(shas))
+
+    def mark_exported(self, changes: ExportChanges, n_rows: int) -> None:
+        """the changes have been exported, the next export starts after them"""
+        save_export_watermark(self.session, changes.until, "full" if changes.since is None else "delta", n_rows)
+        self.session.commit()
+        self._log_changes = True
+
+    def _export_query_(
+        self, changes: Optional[ExportChanges], changes_file: str, order_by: str = ""
+    ) -> Tuple[TextClause, Dict[str, Any]]:
+        """query of the rows to export and the fields added to the manifest, the changed commits are saved"""
+        order = f" order by {order_by}" if order_by else ""
+        if changes is None or changes.since is None:
+            return text(QUERY_SQL["all_commit_data"].text + order), {"mode": "full"}
+
+        with open(changes_file, "w") as f:
+            f.writelines(f"{sha}\n" for sha in changes.shas)
+        query = text(QUERY_SQL["changed_commit_data"].text + order).bindparams(since=changes.since, until=changes.until)
+        fields = {
+            "mode": "delta",
+            "changed_commits": os.path.basename(changes_file),
+            "n_changed_commits": len(changes.shas),
+        }
+        return query, fields
+
+
+def _backup_progress_(dbf: str) -> Callable[[int, int, int], None]:
+    """reports the progress of saving a large database every 10 seconds"""
+    reported_at = time.monotonic()
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal reported_at
+        if time.monotonic() - reported_at >= 10:
+            log(f"saving database to {dbf}, {total - remaining:,} of {total:,} pages copied")
+            reported_at = time.monotonic()
+
+    return progress
+
+
+def _set_wal_pragmas_(dbapi_connection: Any, connection_record: Any) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in WAL_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def _commit_fields_(record: CommitRecord) -> Dict[str, Any]:
+    # commit level stats of the files, same as STATS_SQL
+    n_lines_changed, n_files_changed, n_lines_ignored, n_files_ignored = 0, 0, 0, 0
+    for file_record in record.files:
+        if file_record.is_superfluous is True:
+            n_lines_ignored += file_record.n_lines_added + file_record.n_lines_deleted
+            n_files_ignored += 1
+        elif file_record.is_superfluous is False:
+            n_lines_changed += file_record.n_lines_added + file_record.n_lines_deleted
+            n_files_changed += 1
+
+    return {
+        "sha": record.sha,
+        "message": record.message,
+        "summary": commit_summary(record.message),
+        "is_merge": record.is_merge,
+        "branches": record.branches,
+        "n_lines": record.n_lines,
+        "n_files": record.n_files,
+        "n_insertions": record.n_insertions,
+        "n_deletions": record.n_deletions,
+        "created_at": record.created_at,
+        "created_ts": record.created_ts,
+        "metrics_level": record.metrics_level,
+        "n_lines_changed": n_lines_changed,
+        "n_files_changed": n_files_changed,
+        "n_lines_ignored": n_lines_ignored,
+        "n_files_ignored": n_files_ignored,
+    }
+
+
+def _file_fields_(sha: str, file_record: FileRecord) -> Dict[str, Any]:
+    # FileRecord only has plain fields, vars() is much faster than asdict()
+    n_lines_changed = file_record.n_lines_added + file_record.n_lines_deleted
+    return {"commit_sha": sha, "n_lines_changed": n_lines_changed, **vars(file_record)}
+
+
+def _commit_rows_(record: Any) -> Any:
+    """convert a new commit to rows for the bulk writer, other records are passed through"""
+    if not isinstance(record, CommitRecord):
+        return record
+
+    files = []
+    for file_record in record.files:
+        row = _file_fields_(record.sha, file_record)
+        row["commit_id"] = record.sha
+        files.append(row)
+    return CommitRows(record, _commit_fields_(record), files)
@@ -0,0 +1,267 @@
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import TextClause
+
+from utils import log, timestamp
+
+# how exported files are compressed, BigQuery only loads gzip compressed CSV files
+COMPRESSIONS = ["none", "gzip", "zstd"]
+
+_SUFFIXES_ = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# how the parquet export is split into directories
+PARTITIONS = ["none", "repo", "month"]
+
+# column of all_commit_data to order the rows by, so that the rows of each partition come together
+PARTITION_ORDER = {"none": "", "repo": "repo_id", "month": "commit_date_ts"}
+
+# schema of the BigQuery table all_commit_data, the parquet export has the same columns and types
+BQ_SCHEMA_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "gcp", "bq", "schema.json"))
+
+
+def export_csv(
+    conn: Connection,
+    query: TextClause,
+    csv_file: str,
+    part_size: int = 0,
+    compression: str = "none",
+    batch_size: int = 50000,
+    manifest_fields: Optional[Dict[str, Any]] = None,
+    check_rows: int = 1000,
+) -> Dict[str, Any]:
+    """
+    stream the result of query to csv_file, batch_size rows are fetched at a time.
+    a manifest listing the files written and their number of rows is saved next to csv_file,
+    e.g. all_commit_data.manifest.json, and returned
+
+    :param part_size:   when greater than 0, split the rows into part files of about this many bytes each,
+                        e.g. all_commit_data-00001.csv, all_commit_data-00002.csv, each with the header row
+    :param compression: compress the files on the fly, one of COMPRESSIONS. the suffix is added to the file names
+    :param manifest_fields: added to the manifest
+    :param check_rows:  the size of the part is checked every this many rows
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}")
+
+    base, ext = os.path.splitext(csv_file)
+    result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    columns = list(result.keys())
+
+    parts: List[Dict[str, Any]] = []
+    part: Optional[_Part_] = None
+    for rows in result.partitions(batch_size):
+        # a batch can be much larger than a part
+        for start in range(0, len(rows), check_rows):
+            if part is not None and part_size > 0 and part.n_bytes() >= part_size:
+                parts.append(part.close())
+                part = None
+            if part is None:
+                part_file = f"{base}-{len(parts) + 1:05d}{ext}" if part_size > 0 else csv_file
+                part = _Part_(part_file + _SUFFIXES_[compression], compression, columns)
+            part.write(rows[start : start + check_rows])
+
+    if part is None:
+        # no rows, still write the header
+        part = _Part_(csv_file + _SUFFIXES_[compression], compression, columns)
+    parts.append(part.close())
+
+    return _save_manifest_(f"{base}.manifest.json", "csv", compression, columns, parts, manifest_fields)
+
+
+def export_parquet(
+    conn: Connection,
+    query: TextClause,
+    out_dir: str,
+    partition_by: str = "none",
+    compression: str = "zstd",
+    row_group_size: int = 100000,
+    batch_size: int = 50000,
+    schema_file: str = BQ_SCHEMA_FILE,
+    manifest_fields: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    stream the result of query to parquet files in out_dir, with the columns and types of the BigQuery
+    schema in schema_file. rows are written in row groups of row_group_size rows. a manifest listing the
+    files written and their number of rows is saved as out_dir/all_commit_data.manifest.json and returned.
+    only the file of the current partition is open, so the query must be ordered by the PARTITION_ORDER column.
+    requires the pyarrow package
+
+    :param partition_by:    one of PARTITIONS, "repo" writes the rows of each repository to out_dir/repo_id=<id>/,
+                            "month" writes the rows of each month of commit_date_ts to out_dir/month=<yyyy-mm>/,
+                            rows without commit_date_ts to out_dir/month=unknown/
+    :param compression:     parquet codec, e.g. zstd, snappy, gzip or none
+    :param manifest_fields: added to the manifest
+    """
+    pa, pq = _pyarrow_()
+    if partition_by not in PARTITIONS:
+        raise ValueError(f"partition_by must be one of {PARTITIONS}")
+
+    with open(schema_file) as f:
+        fields = json.load(f)
+    schema = pa.schema(
+        [pa.field(field["name"], _ARROW_TYPES_[field["type"]](pa), field["mode"] != "REQUIRED") for field in fields]
+    )
+    converters = [_CONVERTERS_[field["type"]] for field in fields]
+
+    result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    keys = list(result.keys())
+    missing = [name for name in schema.names if name not in keys]
+    if missing:
+        raise ValueError(f"columns {missing} of the schema are not in the query result")
+    indexes = [keys.index(name) for name in schema.names]
+
+    os.makedirs(out_dir, exist_ok=True)
+    parts: List[Dict[str, Any]] = []
+    partitions: Set[str] = set()
+    writer: Any = None
+    buffer: List[List[Any]] = []
+
+    def write_row_group() -> None:
+        columns = [pa.array(column, type=field.type) for column, field in zip(zip(*buffer), schema)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema), row_group_size=row_group_size)
+        parts[-1]["n_rows"] += len(buffer)
+        buffer.clear()
+
+    def close_part() -> None:
+        if buffer:
+            write_row_group()
+        writer.close()
+        parts[-1]["n_bytes"] = os.path.getsize(os.path.join(out_dir, parts[-1]["file"]))
+
+    for batch in result.partitions(batch_size):
+        for raw_row in batch:
+            row = [convert(raw_row[i]) for convert, i in zip(converters, indexes)]
+            partition = _partition_(partition_by, schema.names, row)
+            if writer is None or partition != parts[-1]["partition"]:
+                if writer is not None:
+                    close_part()
+                if partition in partitions:
+                    raise ValueError(f"rows of {partition} are not together, order the query by {partition_by}")
+                part_file = os.path.join(partition, "all_commit_data.parquet")
+                os.makedirs(os.path.join(out_dir, partition), exist_ok=True)
+                writer = pq.ParquetWriter(os.path.join(out_dir, part_file), schema, compression=compression)
+                parts.append({"file": part_file, "partition": partition, "n_rows": 0})
+                partitions.add(partition)
+            buffer.append(row)
+            if len(buffer) >= row_group_size:
+                write_row_group()
+
+    if writer is not None:
+        close_part()
+
+    manifest_file = os.path.join(out_dir, "all_commit_data.manifest.json")
+    parts.sort(key=lambda part: part["partition"])
+    return _save_manifest_(manifest_file, "parquet", compression, schema.names, parts, manifest_fields)
+
+
+def _partition_(partition_by: str, names: List[str], row: List[Any]) -> str:
+    if partition_by == "repo":
+        return f"repo_id={row[names.index('repo_id')]}"
+    elif partition_by == "month":
+        # e.g. commits indexed before commit_date_ts was added
+        commit_date_ts = row[names.index("commit_date_ts")]
+        return "month=unknown" if commit_date_ts is None else f"month={commit_date_ts:%Y-%m}"
+    return ""
+
+
+def _timestamp_(value: Any) -> Optional[datetime]:
+    """timestamps without timezone are taken as UTC, as BigQuery does when loading CSV"""
+    if value is None:
+        return None
+    ts = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+# BigQuery types to arrow types and to python values accepted by them
+_ARROW_TYPES_: Dict[str, Callable[[Any], Any]] = {
+    "INTEGER": lambda pa: pa.int64(),
+    "STRING": lambda pa: pa.string(),
+    "BOOLEAN": lambda pa: pa.bool_(),
+    "TIMESTAMP": lambda pa: pa.timestamp("us", tz="UTC"),
+}
+
+_CONVERTERS_: Dict[str, Callable[[Any], Any]] = {
+    "INTEGER": lambda value: None if value is None else int(value),
+    "STRING": lambda value: None if value is None else str(value),
+    "BOOLEAN": lambda value: None if value is None else bool(value),
+    "TIMESTAMP": _timestamp_,
+}
+
+
+def _pyarrow_() -> Tuple[Any, Any]:
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("parquet export requires the pyarrow package") from e
+    return pyarrow, pyarrow.parquet
+
+
+def _save_manifest_(
+    manifest_file: str,
+    file_format: str,
+    compression: str,
+    columns: List[str],
+    parts: List[Dict[str, Any]],
+    fields: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    manifest = {
+        "created_at": timestamp(),
+        "format": file_format,
+        "compression": compression,
+        "columns": columns,
+        "n_rows": sum(part["n_rows"] for part in parts),
+        "parts": parts,
+        **(fields or {}),
+    }
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    log(f"exported {manifest['n_rows']:,} rows to {len(parts)} {file_format} files, manifest {manifest_file}")
+    return manifest
+
+
+class _Part_:
+    """a csv file compressed as it is written"""
+
+    def __init__(self, path: str, compression: str, columns: List[str]):
+        self.path = path
+        self.n_rows = 0
+        self.raw = open(path, "wb")
+        stream: Any = self.raw
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        elif compression == "zstd":
+            stream = _zstd_writer_(self.raw)
+        self.text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(columns)
+
+    def write(self, rows: Sequence[Any]) -> None:
+        self.writer.writerows(rows)
+        self.n_rows += len(rows)
+
+    def n_bytes(self) -> int:
+        """bytes written to the file so far, compressors may hold back some"""
+        self.text.flush()
+        return self.raw.tell()
+
+    def close(self) -> Dict[str, Any]:
+        self.text.close()
+        self.raw.close()
+        return {"file": os.path.basename(self.path), "n_rows": self.n_rows, "n_bytes": os.path.getsize(self.path)}
+
+
+def _zstd_writer_(raw: BinaryIO) -> Any:
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compression requires the zstandard package") from e
+    return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
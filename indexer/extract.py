@@ -0,0 +1,639 @@
+import multiprocessing
+import os
+import queue
+import subprocess
+import tempfile
+import traceback
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from itertools import chain
+from typing import (
+    Any,
+    Container,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from git import Repo
+from git.exc import GitCommandError
+from pydriller.domain.commit import Commit as PyDrillerCommit
+from pydriller.domain.commit import ModifiedFile
+from pydriller.git import Git
+from pydriller.utils.conf import Conf
+
+from utils import classify_path, display_url, normalize_branches, patch_ssh_gitlab_url
+
+# the records below are plain data extracted from git,
+# they can be passed between processes and written to database by Indexer
+
+
+@dataclass
+class FileRecord:
+    change_type: str
+    file_path: str
+    file_name: str
+    n_lines_added: int = 0
+    n_lines_deleted: int = 0
+    n_lines_of_code: int = 0
+    n_methods: int = 0
+    n_methods_changed: int = 0
+    is_on_exclude_list: bool = False
+    is_superfluous: bool = False
+    file_type: str = ""
+
+
+@dataclass
+class CommitRecord:
+    sha: str
+    message: str
+    author_name: str
+    author_email: str
+    is_merge: bool
+    branches: str
+    n_lines: int
+    n_files: int
+    n_insertions: int
+    n_deletions: int
+    created_at: str
+    created_ts: datetime
+    files: List[FileRecord] = field(default_factory=list)
+    metrics_level: str = "lines"
+    parents: List[str] = field(default_factory=list)
+
+
+class KnownCommit(NamedTuple):
+    """
+    a commit that is already in the database, either in this repository and only its branches
+    need to be checked, or in another repository (e.g. a fork) and only needs to be linked
+    """
+
+    sha: str
+    branches: str
+    parents: Tuple[str, ...] = ()
+
+
+class RefTips(NamedTuple):
+    """ref name -> sha of all branches and tags, only emitted after a repository is fully traversed"""
+
+    tips: Dict[str, str]
+
+
+GitRecord = Union[CommitRecord, KnownCommit, RefTips]
+
+EXTRACTORS = ["pydriller", "gitlog"]
+
+# each level includes the metrics of the levels before it
+# lines:    n_lines_added, n_lines_deleted and n_lines_changed, they come with the diff
+# loc:      n_lines_of_code, requires lizard to analyze the source code after the change
+# methods:  n_methods and n_methods_changed, requires lizard to analyze source code before the change as well
+METRICS_LEVELS = ["lines", "loc", "methods"]
+
+# hash, parents, committer name, committer email, commit date, message, then the diff
+_LOG_FORMAT_ = "%x1e%H%x1f%P%x1f%cn%x1f%ce%x1f%cI%x1f%B%x1f"
+
+# status letter in git diff --raw => same names as PyDriller ModificationType
+_CHANGE_TYPES_ = {"A": "ADD", "C": "COPY", "D": "DELETE", "M": "MODIFY", "R": "RENAME", "T": "MODIFY"}
+
+
+@contextmanager
+def open_repository(clone_url: str) -> Iterator[Git]:
+    """
+    open a local repository, or clone a remote one into a temporary directory.
+    remote branches are always considered, same as PyDriller with include_refs and include_remotes
+    """
+    url = patch_ssh_gitlab_url(clone_url)  # kludge: workaround for some unfortunate ssh setup
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if url.startswith(("git@", "https://", "http://")):
+            path = os.path.join(tmp_dir, "repo")
+            Repo.clone_from(url=url, to_path=path)
+        else:
+            path = url
+
+        conf = Conf({"path_to_repo": path, "include_refs": True, "include_remotes": True})
+        git = Git(path, conf)
+        try:
+            yield git
+        finally:
+            # GitPython leaks memory unless cleared
+            git.clear()
+
+
+def read_ref_tips(git: Git) -> Dict[str, str]:
+    """return ref name -> commit sha of HEAD and all branches and tags, tags are peeled to the commits"""
+    tips = {}
+    refs = git.repo.git.for_each_ref(
+        "--format=%(objecttype)%09%(objectname)%09%(*objecttype)%09%(*objectname)%09%(symref)%09%(refname)"
+    )
+    for ref in refs.splitlines():
+        obj_type, sha, peeled_type, peeled_sha, symref, ref_name = ref.split("\t", 5)
+        if symref:
+            # e.g. refs/remotes/origin/HEAD, the ref it points to is listed on its own
+            continue
+        if obj_type == "commit":
+            tips[ref_name] = sha
+        elif peeled_type == "commit":
+            tips[ref_name] = peeled_sha
+
+    try:
+        tips["HEAD"] = git.repo.git.rev_parse("--verify", "--quiet", "HEAD^{commit}")
+    except GitCommandError:
+        # empty repository or HEAD points to nowhere
+        pass
+
+    return tips
+
+
+def rev_list(git: Git, include: Iterable[str], exclude: Iterable[str] = ()) -> Dict[str, List[str]]:
+    """return sha -> parents of commits reachable from include but not from exclude, parents first"""
+    include, exclude = list(include), list(exclude)
+    if not include:
+        return {}
+
+    args = ["--topo-order", "--reverse", "--parents", "--ignore-missing"] + include
+    if exclude:
+        args += ["--not"] + exclude
+
+    commits = {}
+    for line in git.repo.git.rev_list(*args).splitlines():
+        sha, *parents = line.split()
+        commits[sha] = parents
+    return commits
+
+
+def branch_membership(git: Git, tips: Dict[str, str]) -> Dict[str, str]:
+    """
+    compute the branches of all commits in a single walk of the commit graph, returns sha -> branches.
+    the result is the same as normalize_branches(commit.branches) of PyDriller for every commit,
+    without running git branch --contains for each commit. commits not on any branch are not included.
+
+    :param tips: ref name -> sha, as returned by read_ref_tips()
+    """
+    # PyDriller runs git branch -a -r --contains, which only lists remote branches,
+    # e.g. origin/feature/blah, that normalize_branches turns into "feature".
+    # every distinct normalized name gets a bit, the branches of a commit is a bit mask
+    bits: Dict[str, int] = {}
+    masks: Dict[str, int] = {}
+    for ref_name, sha in tips.items():
+        if not ref_name.startswith("refs/remotes/"):
+            continue
+        name = normalize_branches({ref_name[len("refs/remotes/") :]})
+        if name:
+            bit = bits.setdefault(name, 1 << len(bits))
+            masks[sha] = masks.get(sha, 0) | bit
+
+    if not masks:
+        return {}
+
+    # --topo-order lists all children of a commit before the commit itself,
+    # so the mask of a commit is complete by the time it's pushed to its parents
+    for line in git.repo.git.rev_list("--topo-order", "--parents", *masks.keys()).splitlines():
+        sha, *parents = line.split()
+        mask = masks[sha]
+        for parent in parents:
+            masks[parent] = masks.get(parent, 0) | mask
+
+    names = {bit: name for name, bit in bits.items()}
+    branches_of_mask: Dict[int, str] = {}
+    result = {}
+    for sha, mask in masks.items():
+        if mask not in branches_of_mask:
+            branches_of_mask[mask] = normalize_branches({names[bit] for bit in names if mask & bit})
+        result[sha] = branches_of_mask[mask]
+
+    return result
+
+
+def iter_commits(
+    clone_url: str,
+    known_commits: Dict[str, str],
+    ref_tips: Optional[Dict[str, str]] = None,
+    timeout: int = 28800,
+    extractor: str = "pydriller",
+    metrics: str = "methods",
+    existing_shas: Container[str] = (),
+    checkpoint: Iterable[str] = (),
+    jobs: int = 1,
+) -> Iterator[GitRecord]:
+    """
+    traverse the commits in a repository that are new since the last time it was indexed
+
+    :param clone_url:       url or local path of the repository
+    :param known_commits:   sha -> branches of commits already indexed for this repository,
+                            only the ones with changed branches will be emitted
+    :param ref_tips:        ref name -> sha of branches and tags saved after the last traversal.
+                            when given, only commits reachable from new tips but not from these ones are
+                            traversed. when not given, the whole history is traversed.
+    :param timeout:         stop traversing after this many seconds
+    :param extractor:       "pydriller" extracts everything from PyDriller commits, "gitlog" streams
+                            a single git log --numstat which is much faster
+    :param metrics:         file metrics to compute, one of METRICS_LEVELS. with gitlog extractor
+                            the metrics beyond lines are computed with PyDriller for the new commits only
+    :param existing_shas:   hashes of commits already in the database from any repository. new commits in this
+                            set are emitted as KnownCommit without extracting their files
+    :param checkpoint:      commits saved by an interrupted traversal, they and their ancestors are skipped.
+                            new commits are always emitted parents first, so that the commits emitted so
+                            far are all reachable from a few of them, which can be used as checkpoint
+    :param jobs:            when greater than 1, diffs and file metrics of new commits are computed in a pool
+                            of this many processes. records are still emitted in the same order
+    """
+    if extractor not in EXTRACTORS:
+        raise ValueError(f"extractor must be one of {EXTRACTORS}")
+    if metrics not in METRICS_LEVELS:
+        raise ValueError(f"metrics must be one of {METRICS_LEVELS}")
+
+    start_t = datetime.now()
+    with open_repository(clone_url) as git:
+        new_tips = read_ref_tips(git)
+        if ref_tips and new_tips == ref_tips:
+            return
+
+        branches = branch_membership(git, new_tips)
+        changed: List[GitRecord] = [
+            KnownCommit(sha, branches.get(sha, ""))
+            for sha, old_branches in known_commits.items()
+            if branches.get(sha, "") != old_branches
+        ]
+
+        # known commits have been taken care of above, only new commits need to be extracted
+        include = list(new_tips.values())
+        exclude = (list(ref_tips.values()) if ref_tips else []) + list(checkpoint)
+        if extractor == "gitlog":
+            log_records = _iter_log_records_(git, include, exclude, known_commits, existing_shas, branches)
+            records = _with_metrics_(git, log_records, metrics, jobs)
+        else:
+            commits = rev_list(git, include, exclude)
+            records = _iter_pydriller_records_(git, commits, known_commits, existing_shas, branches, metrics, jobs)
+
+        for record in chain(changed, records):
+            # impose some timeout to avoid spending tons of time on very large repositories
+            if (datetime.now() - start_t).seconds > timeout:
+                print(f"### indexing not done after {timeout} seconds, aborting {display_url(clone_url)}")
+                return
+            yield record
+
+        yield RefTips(new_tips)
+
+
+def _iter_pydriller_records_(
+    git: Git,
+    commits: Dict[str, List[str]],
+    known_commits: Dict[str, str],
+    existing_shas: Container[str],
+    branches: Dict[str, str],
+    metrics: str,
+    jobs: int = 1,
+) -> Iterator[Union[CommitRecord, KnownCommit]]:
+    shas = [sha for sha in commits if sha not in known_commits]
+    if jobs <= 1:
+        for sha in shas:
+            if sha in existing_shas:
+                yield KnownCommit(sha, branches.get(sha, ""), tuple(commits[sha]))
+            else:
+                yield commit_record(git.get_commit(sha), branches.get(sha, ""), metrics)
+        return
+
+    with _commits_pool_(git, jobs) as executor:
+        results = (
+            KnownCommit(sha, branches.get(sha, ""), tuple(commits[sha]))
+            if sha in existing_shas
+            else executor.submit(_worker_commit_record_, sha, branches.get(sha, ""), metrics)
+            for sha in shas
+        )
+        yield from _in_order_(results, jobs * 4)
+
+
+def _iter_log_records_(
+    git: Git,
+    include: List[str],
+    exclude: List[str],
+    known_commits: Dict[str, str],
+    existing_shas: Container[str],
+    branches: Dict[str, str],
+) -> Iterator[Union[CommitRecord, KnownCommit]]:
+    for record in iter_log(git, include, exclude):
+        if record.sha in known_commits:
+            continue
+        if record.sha in existing_shas:
+            yield KnownCommit(record.sha, branches.get(record.sha, ""), tuple(record.parents))
+            continue
+
+        record.branches = branches.get(record.sha, "")
+        yield record
+
+
+def _with_metrics_(
+    git: Git, records: Iterator[Union[CommitRecord, KnownCommit]], metrics: str, jobs: int = 1
+) -> Iterator[Union[CommitRecord, KnownCommit]]:
+    """add the metrics beyond lines to the records extracted from git log"""
+    if metrics == "lines":
+        yield from records
+    elif jobs <= 1:
+        for record in records:
+            yield add_metrics(git, record, metrics) if isinstance(record, CommitRecord) else record
+    else:
+        with _commits_pool_(git, jobs) as executor:
+            results = (
+                executor.submit(_worker_add_metrics_, record, metrics) if isinstance(record, CommitRecord) else record
+                for record in records
+            )
+            yield from _in_order_(results, jobs * 4)
+
+
+def add_metrics(git: Git, record: CommitRecord, metrics: str) -> CommitRecord:
+    metrics_by_path = commit_metrics(git, record.sha, metrics)
+    for file_record in record.files:
+        for key, value in metrics_by_path.get(file_record.file_path, {}).items():
+            setattr(file_record, key, value)
+    record.metrics_level = metrics
+    return record
+
+
+@contextmanager
+def _commits_pool_(git: Git, jobs: int) -> Iterator[ProcessPoolExecutor]:
+    """process pool whose workers open the same repository, pending tasks are cancelled on exit"""
+    lock = multiprocessing.Lock()
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_commits_worker_, initargs=(str(git.path), lock))
+    try:
+        yield executor
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _in_order_(results: Iterable[Any], window: int) -> Iterator[Any]:
+    """
+    yield results in the order they are given, futures are waited for. results is consumed
+    at most window items ahead, which bounds the number of tasks in flight
+    """
+    pending: Deque[Any] = deque()
+    for result in results:
+        pending.append(result)
+        if len(pending) >= window:
+            item = pending.popleft()
+            yield item.result() if isinstance(item, Future) else item
+    while pending:
+        item = pending.popleft()
+        yield item.result() if isinstance(item, Future) else item
+
+
+# repository a commits pool worker works on, see _init_commits_worker_
+_worker_git_: Optional[Git] = None
+
+
+def _init_commits_worker_(path: str, lock: Any) -> None:
+    global _worker_git_
+    # PyDriller writes to the config of the repository when it's opened, which fails when done concurrently
+    with lock:
+        _worker_git_ = Git(path)
+
+
+def _worker_commit_record_(sha: str, branches: str, metrics: str) -> CommitRecord:
+    assert _worker_git_ is not None
+    return commit_record(_worker_git_.get_commit(sha), branches, metrics)
+
+
+def _worker_add_metrics_(record: CommitRecord, metrics: str) -> CommitRecord:
+    assert _worker_git_ is not None
+    return add_metrics(_worker_git_, record, metrics)
+
+
+# hashes of commits in the database when the worker process started, see init_worker
+_worker_existing_shas_: Container[str] = ()
+
+
+def init_worker(existing_shas: Container[str]) -> None:
+    """
+    process pool initializer, existing commit hashes are sent once per worker process
+    instead of once per repository
+    """
+    global _worker_existing_shas_
+    _worker_existing_shas_ = existing_shas
+
+
+def extract_repository(
+    out: Any,
+    clone_url: str,
+    known_commits: Dict[str, str],
+    ref_tips: Optional[Dict[str, str]] = None,
+    timeout: int = 28800,
+    extractor: str = "pydriller",
+    metrics: str = "methods",
+    existing_shas: Optional[Container[str]] = None,
+    checkpoint: Iterable[str] = (),
+    jobs: int = 1,
+    chunk_size: int = 500,
+) -> bool:
+    """
+    extract the records of a repository in a worker process and put them into the queue out in lists of
+    chunk_size records, so that they are saved while the repository is traversed. out is bounded, the worker
+    waits while the writer is behind. None is put at the end, also after an error, which is reported the same
+    way as Indexer.index_repository and False is returned. existing_shas defaults to the set given to init_worker
+    """
+    if existing_shas is None:
+        existing_shas = _worker_existing_shas_
+    try:
+        chunk: List[GitRecord] = []
+        for record in iter_commits(
+            clone_url, known_commits, ref_tips, timeout, extractor, metrics, existing_shas, checkpoint, jobs
+        ):
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                out.put(chunk)
+                chunk = []
+        if chunk:
+            out.put(chunk)
+        return True
+    except GitCommandError as e:
+        print(f"{e._cmdline} returned {e.stderr} for {clone_url}")
+    except Exception as e:
+        exc = traceback.format_exc()
+        print(f"Exception indexing repository {clone_url} => {str(e)}\n{exc}")
+    finally:
+        out.put(None)
+
+    return False
+
+
+def queued_records(out: Any, future: Future) -> Iterator[GitRecord]:
+    """records put into out by extract_repository running as future, until the end or the worker is gone"""
+    while True:
+        try:
+            chunk = out.get(timeout=1)
+        except queue.Empty:
+            if future.done():
+                # the worker process died before putting the end
+                return
+            continue
+        if chunk is None:
+            return
+        yield from chunk
+
+
+def commit_record(commit: PyDrillerCommit, branches: str, metrics: str = "methods") -> CommitRecord:
+    record = CommitRecord(
+        sha=commit.hash,
+        message=commit.msg[:2048],  # some commits has super long message, e.g. squash merge
+        author_name=commit.committer.name.lower(),
+        author_email=commit.committer.email.lower(),
+        is_merge=commit.merge,
+        branches=branches,
+        n_lines=commit.lines,
+        n_files=commit.files,
+        n_insertions=commit.insertions,
+        n_deletions=commit.deletions,
+        # comment to save some time. metrics not used for now
+        # dmm_unit_size=commit.dmm_unit_size,
+        # dmm_unit_complexity=commit.dmm_unit_complexity,
+        # dmm_unit_interfacing=commit.dmm_unit_interfacing,
+        created_at=commit.committer_date.isoformat(),
+        created_ts=commit.committer_date,
+        metrics_level=metrics,
+        parents=commit.parents,
+    )
+
+    for mod in commit.modified_files:
+        file_path = mod.new_path or mod.old_path
+        flag, type_ = classify_path(file_path)
+        record.files.append(
+            FileRecord(
+                change_type=str(mod.change_type).split(".")[1],  # enum ModificationType.ADD => "ADD"
+                file_path=file_path,
+                file_name=mod.filename,
+                n_lines_added=mod.added_lines,
+                n_lines_deleted=mod.deleted_lines,
+                is_on_exclude_list=flag,
+                is_superfluous=flag,
+                file_type=type_,
+                **file_metrics(mod, metrics),
+            )
+        )
+
+    return record
+
+
+def file_metrics(mod: ModifiedFile, metrics: str) -> Dict[str, Any]:
+    """compute the metrics of a modified file that are beyond the lines level"""
+    result: Dict[str, Any] = {}
+    if metrics in ("loc", "methods"):
+        result["n_lines_of_code"] = mod.nloc or 0  # None when the language is not supported by lizard
+    if metrics == "methods":
+        result["n_methods"] = len(mod.methods)
+        result["n_methods_changed"] = len(mod.changed_methods)
+    return result
+
+
+def commit_metrics(git: Git, sha: str, metrics: str) -> Dict[str, Dict[str, Any]]:
+    """compute file metrics of a commit on demand, returns file path -> metrics"""
+    return {mod.new_path or mod.old_path: file_metrics(mod, metrics) for mod in git.get_commit(sha).modified_files}
+
+
+def iter_log(git: Git, include: Iterable[str], exclude: Iterable[str] = ()) -> Iterator[CommitRecord]:
+    """
+    stream commits reachable from include but not from exclude with a single git log --raw --numstat.
+    no patch is built and no source code is analyzed, so it's much faster than going through PyDriller,
+    but method level metrics are left at 0 and branches are not populated.
+    merge commits are compared to their first parent for commit level stats and have no files,
+    same as PyDriller.
+    """
+    include, exclude = list(include), list(exclude)
+    if not include:
+        return
+
+    # -z makes file names verbatim, and the fields are seperated by NUL
+    args = ["git", "-C", str(git.path), "-c", "core.quotepath=off", "log", "-z", "--topo-order", "--reverse"]
+    args += ["--ignore-missing"]
+    args += ["-M", "--raw", "--numstat", "--no-abbrev", "--diff-merges=first-parent", f"--format={_LOG_FORMAT_}"]
+    args += include
+    if exclude:
+        args += ["--not"] + exclude
+
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    assert proc.stdout is not None
+    try:
+        buf = b""
+        for chunk in iter(partial(proc.stdout.read, 1 << 16), b""):
+            *blocks, buf = (buf + chunk).split(b"\x1e")
+            for block in blocks:
+                if block:
+                    yield _parse_log_entry_(block.decode("utf-8", errors="replace"))
+        if buf:
+            yield _parse_log_entry_(buf.decode("utf-8", errors="replace"))
+
+        if proc.wait() != 0:
+            raise GitCommandError(args, proc.returncode)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            # generator closed before git log is finished, e.g. timeout
+            proc.kill()
+            proc.wait()
+
+
+def _parse_log_entry_(entry: str) -> CommitRecord:
+    sha, parents, name, email, date, message, diff = entry.split("\x1f", 6)
+
+    # --raw output comes first, then --numstat output, both list files in the same order
+    changes, stats = [], []
+    tokens = iter(diff.lstrip("\0\n").split("\0"))
+    for token in tokens:
+        if token.startswith(":"):
+            # :100644 100644 <old blob> <new blob> R086\0old_path\0new_path
+            status = token.split()[-1]
+            path = next(tokens)
+            if status[0] in "RC":
+                path = next(tokens)
+            changes.append((_CHANGE_TYPES_.get(status[0], "UNKNOWN"), path))
+        elif token:
+            # added\tdeleted\tpath, path is empty for renames and followed by old_path\0new_path
+            added, deleted, path = token.split("\t", 2)
+            if not path:
+                next(tokens)
+                next(tokens)
+            # binary files shows - instead of number of lines
+            stats.append((int(added) if added != "-" else 0, int(deleted) if deleted != "-" else 0))
+
+    n_insertions, n_deletions = sum(a for a, _ in stats), sum(d for _, d in stats)
+    committer_date = datetime.fromisoformat(date)
+    record = CommitRecord(
+        sha=sha,
+        message=message.strip()[:2048],
+        author_name=name.lower(),
+        author_email=email.lower(),
+        is_merge=len(parents.split()) > 1,
+        branches="",
+        parents=parents.split(),
+        n_lines=n_insertions + n_deletions,
+        n_files=len(stats),
+        n_insertions=n_insertions,
+        n_deletions=n_deletions,
+        created_at=committer_date.isoformat(),
+        created_ts=committer_date,
+    )
+
+    if not record.is_merge:
+        for (change_type, file_path), (n_added, n_deleted) in zip(changes, stats):
+            flag, type_ = classify_path(file_path)
+            record.files.append(
+                FileRecord(
+                    change_type=change_type,
+                    file_path=file_path,
+                    file_name=os.path.basename(file_path),
+                    n_lines_added=n_added,
+                    n_lines_deleted=n_deleted,
+                    is_on_exclude_list=flag,
+                    is_superfluous=flag,
+                    file_type=type_,
+                )
+            )
+
+    return record
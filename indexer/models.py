@@ -1,8 +1,9 @@
 import os
 import re
+import zlib
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 from sqlalchemy import (
     Boolean,
@@ -11,16 +12,40 @@ from sqlalchemy import (
     Float,
     ForeignKey,
     Integer,
+    LargeBinary,
+    SmallInteger,
     String,
     Table,
+    Text,
+    TypeDecorator,
+    bindparam,
+    delete,
+    insert,
+    inspect,
+    literal,
+    select,
+    text,
+    update,
 )
+from sqlalchemy.engine import Connection, Dialect, Engine
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import Mapped, Session, mapped_column, registry, relationship
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
-from utils import clone_to_browse_url
+from utils import ExcludeRules, clone_to_browse_url, file_type, log
 
 _REPO_TYPES_ = ["gitlab", "gitlab_private", "github", "bitbucket", "bitbucket_private", "local", "other"]
 
+# change types of committed files, stored as their position in the list
+CHANGE_TYPES = ["UNKNOWN", "ADD", "COPY", "RENAME", "DELETE", "MODIFY"]
+_CHANGE_TYPE_CODES_ = {name: code for code, name in enumerate(CHANGE_TYPES)}
+
+# fields of committed files that are stored in paths
+_PATH_FIELDS_ = ("file_path", "file_name", "file_type")
+
+# length of Commit.summary
+SUMMARY_LENGTH = 100
+
 
 mapper_registry = registry()
 
@@ -37,7 +62,8 @@ repo_to_commit_table = Table(
     "repo_to_commits",
     Base.metadata,
     Column("repo_id", ForeignKey("repositories.id"), primary_key=True),
-    Column("commit_id", ForeignKey("commits.sha"), primary_key=True),
+    # the primary key only serves lookups by repo_id
+    Column("commit_id", ForeignKey("commits.sha"), primary_key=True, index=True),
 )
 
 
@@ -47,10 +73,10 @@ class Repository(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
     repo_type: Mapped[str] = mapped_column(String(20))
-    repo_name: Mapped[str] = mapped_column(String(128))
+    repo_name: Mapped[str] = mapped_column(String(128), index=True)
     repo_group: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     component: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
-    clone_url: Mapped[str] = mapped_column(String(256))
+    clone_url: Mapped[str] = mapped_column(String(256), index=True)
     browse_url: Mapped[str] = mapped_column(String(256))
     include_in_stats: Mapped[bool] = mapped_column(Boolean, default=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
@@ -113,7 +139,8 @@ class Commit(Base):
 
     sha: Mapped[str] = mapped_column(primary_key=True)
     branches: Mapped[str] = mapped_column(String(1024), default="[]")
-    message: Mapped[str] = mapped_column(String(2048), default="")
+    # first line of the message for lists, the message is loaded from commit_messages when used
+    summary: Mapped[str] = mapped_column(String(SUMMARY_LENGTH), default="", server_default="")
     created_at: Mapped[str] = mapped_column(String(32))
     created_ts: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
 
@@ -127,21 +154,106 @@ class Commit(Base):
     dmm_unit_complexity: Mapped[float] = mapped_column(Float, default=0.0)
     dmm_unit_interfacing: Mapped[float] = mapped_column(Float, default=0.0)
     # should be populated from committed_files
-    n_lines_changed: Mapped[int] = mapped_column(Integer, default=0)
+    n_lines_changed: Mapped[int] = mapped_column(Integer, default=0, index=True)
     n_lines_ignored: Mapped[int] = mapped_column(Integer, default=0)
     n_files_changed: Mapped[int] = mapped_column(Integer, default=0)
     n_files_ignored: Mapped[int] = mapped_column(Integer, default=0)
+    # how much of the file metrics were computed, see indexer.extract.METRICS_LEVELS
+    # commits indexed before this column existed had all metrics computed
+    metrics_level: Mapped[str] = mapped_column(String(8), default="methods", server_default="methods")
 
     # relationships
-    author_id: Mapped[int] = mapped_column(ForeignKey("authors.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("authors.id"), index=True)
     author: Mapped["Author"] = relationship("Author", back_populates="commits")
 
     repos: Mapped[List["Repository"]] = relationship(secondary=repo_to_commit_table, back_populates="commits")
 
     files: Mapped[List["CommittedFile"]] = relationship("CommittedFile", back_populates="commit")
 
+    commit_message: Mapped[Optional["CommitMessage"]] = relationship("CommitMessage")
+
+    # not annotated, same as the association proxies of CommittedFile
+    message = association_proxy("commit_message", "message", creator=lambda message: CommitMessage(message=message))
+
+    def __init__(self, **kw: Any) -> None:
+        super().__init__(**kw)
+
+        if self.summary or not self.commit_message:
+            return
+
+        self.summary = commit_summary(self.commit_message.message)
+
     def __repr__(self) -> str:
-        return f"commits(id={self.sha!r} in message={self.message[:20]!r})"
+        return f"commits(id={self.sha!r} in message={self.summary[:20]!r})"
+
+
+class CompressedText(TypeDecorator):
+    """text stored as bytes, compressed with zlib when that makes it shorter. the first byte tells which"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[str], dialect: Dialect) -> Optional[bytes]:
+        if value is None:
+            return None
+        data = value.encode("utf-8")
+        compressed = zlib.compress(data)
+        return b"z" + compressed if len(compressed) < len(data) else b"t" + data
+
+    def process_result_value(self, value: Optional[bytes], dialect: Dialect) -> Optional[str]:
+        if value is None:
+            return None
+        data = zlib.decompress(value[1:]) if value[:1] == b"z" else value[1:]
+        return data.decode("utf-8")
+
+
+@dataclass
+class CommitMessage(Base):
+    """message of a commit, kept out of commits so that loading and scanning commits does not read it"""
+
+    __tablename__ = "commit_messages"
+
+    sha: Mapped[str] = mapped_column(ForeignKey("commits.sha"), primary_key=True)
+    message: Mapped[str] = mapped_column(CompressedText)
+
+    def __repr__(self) -> str:
+        return f"CommitMessage(sha={self.sha!r})"
+
+
+class ChangeType(TypeDecorator):
+    """change type names stored as small integers, names not in CHANGE_TYPES are stored as UNKNOWN"""
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[str], dialect: Dialect) -> Optional[int]:
+        return None if value is None else _CHANGE_TYPE_CODES_.get(value, 0)
+
+    def process_result_value(self, value: Optional[int], dialect: Dialect) -> Optional[str]:
+        return None if value is None else CHANGE_TYPES[value]
+
+
+@dataclass
+class Path(Base):
+    """a file path stored once, no matter how many commits changed the file"""
+
+    __tablename__ = "paths"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    file_path: Mapped[str] = mapped_column(String(256), index=True, unique=True)
+    file_name: Mapped[str] = mapped_column(String(128))
+    file_type: Mapped[str] = mapped_column(String(128))
+
+    def __init__(self, **kw: Any) -> None:
+        super().__init__(**kw)
+
+        if self.id or self.file_type:
+            return
+
+        self.file_type = file_type(self.file_path)
+
+    def __repr__(self) -> str:
+        return f"Path(id={self.id!r}, file_path={self.file_path!r})"
 
 
 @dataclass
@@ -150,10 +262,7 @@ class CommittedFile(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
     commit_sha: Mapped[str] = mapped_column(String(40))
-    change_type: Mapped[str] = mapped_column(String(16), default="UNKNOWN")
-    file_path: Mapped[str] = mapped_column(String(256))
-    file_name: Mapped[str] = mapped_column(String(128))
-    file_type: Mapped[str] = mapped_column(String(128))
+    change_type: Mapped[str] = mapped_column(ChangeType, default="UNKNOWN")
 
     # line metrics from Pydiller
     n_lines_added: Mapped[int] = mapped_column(Integer, default=0)
@@ -167,22 +276,24 @@ class CommittedFile(Base):
     is_superfluous: Mapped[bool] = mapped_column(Boolean, default=False)
 
     # relationships
-    commit_id: Mapped[int] = mapped_column(ForeignKey("commits.sha"))
+    commit_id: Mapped[int] = mapped_column(ForeignKey("commits.sha"), index=True)
     commit: Mapped["Commit"] = relationship("Commit", back_populates="files")
 
-    def __init__(self, **kw: Any) -> None:
-        super().__init__(**kw)
+    path_id: Mapped[int] = mapped_column(ForeignKey("paths.id"), index=True)
+    path: Mapped["Path"] = relationship("Path")
 
-        if self.id:
-            return
+    # not annotated, the dataclass decorator would read them before the mappers are configured
+    file_path = association_proxy("path", "file_path")
+    file_name = association_proxy("path", "file_name")
+    file_type = association_proxy("path", "file_type")
 
-        main, ext = os.path.splitext(self.file_path)
-        if main.startswith("."):
-            self.file_type = "hiden"
-        elif ext != "":
-            self.file_type = ext[1:].lower()
-        else:
-            self.file_type = "generic"
+    def __init__(self, **kw: Any) -> None:
+        # a new path when given by file_path instead of path or path_id, the indexer uses PathCache instead
+        if "file_path" in kw:
+            kw["path"] = Path(
+                file_path=kw.pop("file_path"), file_name=kw.pop("file_name"), file_type=kw.pop("file_type", "")
+            )
+        super().__init__(**kw)
 
     def __repr__(self) -> str:
         return f"commits(id={self.id!r} in commit {self.commit_sha!r})"
@@ -194,9 +305,9 @@ class Author(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
     name: Mapped[str] = mapped_column(String(128))
-    email: Mapped[str] = mapped_column(String(1024))
+    email: Mapped[str] = mapped_column(String(1024), index=True)
     real_name: Mapped[str] = mapped_column(String(128))
-    real_email: Mapped[str] = mapped_column(String(1024))
+    real_email: Mapped[str] = mapped_column(String(1024), index=True)
     company: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     team: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     group: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
@@ -208,6 +319,195 @@ class Author(Base):
         return f"Authro(id={self.id!r}, name={self.name}, email={self.email!r})"
 
 
+@dataclass
+class RefTip(Base):
+    """tip of a branch or tag of a repository when it was last fully indexed"""
+
+    __tablename__ = "ref_tips"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    repo_id: Mapped[int] = mapped_column(ForeignKey("repositories.id"))
+    ref_name: Mapped[str] = mapped_column(String(256))
+    sha: Mapped[str] = mapped_column(String(40))
+
+    def __repr__(self) -> str:
+        return f"RefTip(repo_id={self.repo_id!r}, ref_name={self.ref_name!r}, sha={self.sha!r})"
+
+
+@dataclass
+class Checkpoint(Base):
+    """
+    commits saved by an indexing run that was interrupted, all their ancestors have been saved too.
+    a resumed run only traverses commits not reachable from them
+    """
+
+    __tablename__ = "checkpoints"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    repo_id: Mapped[int] = mapped_column(ForeignKey("repositories.id"))
+    sha: Mapped[str] = mapped_column(String(40))
+
+    def __repr__(self) -> str:
+        return f"Checkpoint(repo_id={self.repo_id!r}, sha={self.sha!r})"
+
+
+@dataclass
+class ExcludeRuleSet(Base):
+    """
+    exclude rules that committed files were classified with, the latest one is in effect.
+    files indexed before any rules is recorded were classified with the default rules
+    """
+
+    __tablename__ = "exclude_rules"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    version: Mapped[str] = mapped_column(String(12))
+    patterns: Mapped[str] = mapped_column(Text)
+    applied_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self) -> str:
+        return f"ExcludeRuleSet(id={self.id!r}, version={self.version!r})"
+
+
+@dataclass
+class CommitChange(Base):
+    """
+    commits whose rows in all_commit_data were added or changed since the last export,
+    they are only logged once exports of changes are used
+    """
+
+    __tablename__ = "commit_changes"
+    # ids are never reused once the exported changes are deleted
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    sha: Mapped[str] = mapped_column(String(40))
+
+    def __repr__(self) -> str:
+        return f"CommitChange(id={self.id!r}, sha={self.sha!r})"
+
+
+@dataclass
+class ExportWatermark(Base):
+    """an export of all_commit_data, which includes the commit changes up to change_id"""
+
+    __tablename__ = "export_watermarks"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # noqa: A003,VNE003
+    change_id: Mapped[int] = mapped_column(Integer)
+    mode: Mapped[str] = mapped_column(String(8))
+    n_rows: Mapped[int] = mapped_column(Integer)
+    exported_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self) -> str:
+        return f"ExportWatermark(change_id={self.change_id!r}, mode={self.mode!r})"
+
+
+def upgrade_schema(engine: Engine) -> None:
+    """
+    create_all() only creates missing tables, this adds the columns and indexes that were
+    introduced later to existing tables, e.g. when an older database file is loaded
+    """
+    inspector = inspect(engine)
+    if inspector.has_table("committed_files") and "file_path" in {
+        column["name"] for column in inspector.get_columns("committed_files")
+    }:
+        with engine.begin() as conn:
+            _intern_file_paths_(conn)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                ddl = f"alter table {table.name} add column {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" default '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+
+            # may take a while on a large database, only once
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    log(f"creating index {index.name}")
+                    index.create(conn)
+
+    if inspector.has_table("commits") and "message" in {column["name"] for column in inspector.get_columns("commits")}:
+        with engine.begin() as conn:
+            _move_commit_messages_(conn)
+
+
+def _intern_file_paths_(conn: Connection) -> None:
+    """
+    committed_files created before paths existed repeat the path and the change type name in every row,
+    rebuild it with rows referring to paths and change type codes
+    """
+    log("moving file paths of committed_files to paths, may take a while")
+    inspector = inspect(conn)
+    # the view refers to the old columns, Indexer creates it again when it is missing
+    if "all_commit_data" in inspector.get_view_names():
+        conn.execute(text("drop view all_commit_data"))
+    # names of indexes are shared by all tables
+    for index in inspector.get_indexes("committed_files"):
+        conn.execute(text(f"drop index {index['name']}"))
+    conn.execute(text("alter table committed_files rename to committed_files_old"))
+
+    Path.__table__.create(conn, checkfirst=True)
+    CommittedFile.__table__.create(conn)
+    conn.execute(
+        text(
+            """insert into paths (file_path, file_name, file_type)
+            select file_path, min(file_name), min(file_type) from committed_files_old group by file_path"""
+        )
+    )
+
+    old_columns = {column["name"] for column in inspector.get_columns("committed_files_old")}
+    columns = [c.name for c in CommittedFile.__table__.columns if c.name in old_columns and c.name != "change_type"]
+    codes = " ".join(f"when '{name}' then {code}" for code, name in enumerate(CHANGE_TYPES))
+    conn.execute(
+        text(
+            f"""insert into committed_files ({", ".join(columns)}, change_type, path_id)
+            select {", ".join(f"old.{c}" for c in columns)}, case old.change_type {codes} else 0 end, paths.id
+            from committed_files_old old join paths on paths.file_path = old.file_path"""
+        )
+    )
+    conn.execute(text("drop table committed_files_old"))
+
+
+def _move_commit_messages_(conn: Connection, batch_size: int = 10000) -> None:
+    """commits created before commit_messages existed have the message inline, move them and fill the summary"""
+    log("moving messages of commits to commit_messages, may take a while")
+    CommitMessage.__table__.create(conn, checkfirst=True)
+
+    commits = Commit.__table__
+    update_summary = update(commits).where(commits.c.sha == bindparam("b_sha")).values(summary=bindparam("b_summary"))
+    last_sha = ""
+    while True:
+        batch = conn.execute(
+            text("select sha, message from commits where sha > :sha order by sha limit :limit"),
+            {"sha": last_sha, "limit": batch_size},
+        ).all()
+        if not batch:
+            break
+        messages = [{"sha": sha, "message": message or ""} for sha, message in batch]
+        conn.execute(insert(CommitMessage.__table__), messages)
+        conn.execute(update_summary, [{"b_sha": m["sha"], "b_summary": commit_summary(m["message"])} for m in messages])
+        last_sha = batch[-1].sha
+
+    conn.execute(text("alter table commits drop column message"))
+
+
+def commit_summary(message: str) -> str:
+    """first line of a commit message, cut to fit Commit.summary"""
+    return message.strip().split("\n", 1)[0][:SUMMARY_LENGTH]
+
+
 def ensure_repository(session: Session, clone_url: str, repo_type: str) -> Repository:
     repo = session.query(Repository).filter(Repository.clone_url == clone_url).one_or_none()
     if repo is None:
@@ -226,5 +526,185 @@ def ensure_author(session: Session, name: str, email: str) -> Author:
     return author
 
 
+class AuthorCache:
+    """
+    authors keyed by (name, email), loaded from database once and kept for a indexing run.
+    new authors are added to the session without committing, they are inserted with the commits
+    that refer to them. same as ensure_author, authors with same email are the same author
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self._authors: Dict[Tuple[str, str], Author] = {}
+        self._authors_by_email: Dict[str, Author] = {}
+        for author in session.scalars(select(Author)):
+            self._authors.setdefault((author.name, author.email), author)
+            self._authors_by_email.setdefault(author.email, author)
+
+    def get(self, name: str, email: str) -> Author:
+        author = self._authors.get((name, email))
+        if author is None:
+            author = self._authors_by_email.get(email)
+            if author is None:
+                author = Author(name=name, email=email, real_name=name, real_email=email)
+                self.session.add(author)
+                self._authors_by_email[email] = author
+            self._authors[(name, email)] = author
+        return author
+
+
+class PathCache:
+    """
+    ids of the file paths seen in an indexing run. paths not in the cache are looked up, and inserted if new,
+    once per batch of files, in the transaction of the files that refer to them
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self._ids: Dict[str, int] = {}
+
+    def resolve(self, files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """rows of committed files with file_path, file_name and file_type replaced by path_id"""
+        missing = {file_row["file_path"]: file_row for file_row in files if file_row["file_path"] not in self._ids}
+        if missing:
+            file_paths = list(missing)
+            for i in range(0, len(file_paths), 500):
+                query = select(Path.file_path, Path.id).where(Path.file_path.in_(file_paths[i : i + 500]))
+                self._ids.update(self.session.execute(query).tuples().all())
+
+            new_paths = [
+                {
+                    "file_path": file_path,
+                    "file_name": file_row["file_name"],
+                    "file_type": file_row["file_type"] or file_type(file_path),
+                }
+                for file_path, file_row in missing.items()
+                if file_path not in self._ids
+            ]
+            if new_paths:
+                inserted = self.session.execute(insert(Path).returning(Path.file_path, Path.id), new_paths)
+                self._ids.update(inserted.tuples().all())
+
+        rows = []
+        for file_row in files:
+            row = {key: value for key, value in file_row.items() if key not in _PATH_FIELDS_}
+            row["path_id"] = self._ids[file_row["file_path"]]
+            rows.append(row)
+        return rows
+
+
 def load_commit(session: Session, sha: str) -> Optional[Commit]:
     return session.query(Commit).filter(Commit.sha == sha).one_or_none()
+
+
+def load_known_commits(session: Session, repo: Repository) -> Dict[str, str]:
+    """sha -> branches of all commits of a repository, without loading the Commit objects"""
+    rows = session.execute(
+        select(Commit.sha, Commit.branches)
+        .join(repo_to_commit_table, repo_to_commit_table.c.commit_id == Commit.sha)
+        .where(repo_to_commit_table.c.repo_id == repo.id)
+    )
+    return dict(rows.tuples().all())
+
+
+def update_branches(session: Session, branches: Dict[str, str]) -> None:
+    """update branches of commits with one executemany UPDATE statement"""
+    if branches:
+        session.execute(update(Commit), [{"sha": sha, "branches": value} for sha, value in branches.items()])
+
+
+def link_commits(session: Session, repo: Repository, shas: Iterable[str]) -> int:
+    """
+    add existing commits to a repository without loading them or the commits of the repository.
+    hashes not in the commits table are skipped, returns the number of commits linked
+    """
+    shas = list(shas)
+    n_linked = 0
+    for i in range(0, len(shas), 500):
+        existing = select(literal(repo.id), Commit.sha).where(Commit.sha.in_(shas[i : i + 500]))  # type: ignore
+        result = session.execute(insert(repo_to_commit_table).from_select(["repo_id", "commit_id"], existing))
+        n_linked += result.rowcount  # type: ignore
+    return n_linked
+
+
+class ShaSet:
+    """
+    compact set of commit hashes, stored as 20 bytes digests instead of 40 characters strings
+    so that all commits of a large database fit in memory
+    """
+
+    def __init__(self, shas: Iterable[str] = ()):
+        self._digests: Set[bytes] = {bytes.fromhex(sha) for sha in shas}
+
+    def add(self, sha: str) -> None:
+        self._digests.add(bytes.fromhex(sha))
+
+    def __contains__(self, sha: object) -> bool:
+        if not isinstance(sha, str):
+            return False
+        try:
+            return bytes.fromhex(sha) in self._digests
+        except ValueError:
+            return False
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+
+def load_sha_set(session: Session) -> ShaSet:
+    """load hashes of all commits in the database with a single streamed query"""
+    return ShaSet(session.scalars(select(Commit.sha).execution_options(yield_per=10000)))
+
+
+def load_ref_tips(session: Session, repo: Repository) -> Dict[str, str]:
+    rows = session.execute(select(RefTip.ref_name, RefTip.sha).where(RefTip.repo_id == repo.id))
+    return dict(rows.tuples().all())
+
+
+def save_ref_tips(session: Session, repo: Repository, tips: Dict[str, str]) -> None:
+    session.execute(delete(RefTip).where(RefTip.repo_id == repo.id))
+    session.add_all([RefTip(repo_id=repo.id, ref_name=ref_name, sha=sha) for ref_name, sha in tips.items()])
+
+
+def load_checkpoint(session: Session, repo: Repository) -> List[str]:
+    return list(session.scalars(select(Checkpoint.sha).where(Checkpoint.repo_id == repo.id)))
+
+
+def save_checkpoint(session: Session, repo: Repository, shas: Iterable[str]) -> None:
+    session.execute(delete(Checkpoint).where(Checkpoint.repo_id == repo.id))
+    session.add_all([Checkpoint(repo_id=repo.id, sha=sha) for sha in shas])
+
+
+def load_exclude_rules_version(session: Session) -> Optional[str]:
+    """version of the exclude rules that committed files were classified with"""
+    version = session.scalar(select(ExcludeRuleSet.version).order_by(ExcludeRuleSet.id.desc()).limit(1))
+    if version is None and session.scalar(select(CommittedFile.id).limit(1)) is not None:
+        return ExcludeRules.default().version
+    return version
+
+
+def save_exclude_rules_version(session: Session, rules: ExcludeRules) -> None:
+    session.add(ExcludeRuleSet(version=rules.version, patterns="\n".join(rules.patterns), applied_at=datetime.now()))
+
+
+def log_commit_changes(session: Session, shas: Iterable[str]) -> None:
+    rows = [{"sha": sha} for sha in shas]
+    if rows:
+        session.execute(insert(CommitChange), rows)
+
+
+def load_export_watermark(session: Session) -> Optional[int]:
+    """the last commit change included in an export, None if changes have not been exported"""
+    return session.scalar(select(ExportWatermark.change_id).order_by(ExportWatermark.id.desc()).limit(1))
+
+
+def save_export_watermark(session: Session, change_id: int, mode: str, n_rows: int) -> None:
+    """changes up to change_id are exported, the log only keeps the changes after"""
+    session.add(ExportWatermark(change_id=change_id, mode=mode, n_rows=n_rows, exported_at=datetime.now()))
+    session.execute(delete(CommitChange).where(CommitChange.id <= change_id))
+
+
+def reset_export_watermark(session: Session) -> None:
+    """stop logging changes, e.g. when all commits are changed, the next export has to include everything"""
+    session.execute(delete(ExportWatermark))
+    session.execute(delete(CommitChange))
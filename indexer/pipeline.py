@@ -0,0 +1,97 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List
+
+# marks the end of the items in a queue
+_DONE_ = object()
+
+
+class _Failure_:
+    """an exception raised in a stage, passed down the pipeline and re-raised by the consumer"""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def pipeline(source: Iterable[Any], *transforms: Callable[[Any], Any], maxsize: int = 1000) -> Iterator[Any]:
+    """
+    iterate source in a thread and apply each transform in a thread of its own, stages are connected
+    with queues of at most maxsize items, so a slow consumer holds back the stages before it.
+    items are yielded in the same order as source. when the consumer stops early, e.g. on error,
+    all stages are stopped and source is closed in the thread that iterates it.
+    """
+    stop = threading.Event()
+    queues: List[queue.Queue] = [queue.Queue(maxsize) for _ in range(len(transforms) + 1)]
+    threads = [threading.Thread(target=_read_, args=(source, queues[0], stop), daemon=True)]
+    for transform, inbox, outbox in zip(transforms, queues, queues[1:]):
+        threads.append(threading.Thread(target=_transform_, args=(transform, inbox, outbox, stop), daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE_:
+                return
+            if isinstance(item, _Failure_):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _put_(outbox: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """put item into queue, wait while it's full unless the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get_(inbox: queue.Queue, stop: threading.Event) -> Any:
+    while not stop.is_set():
+        try:
+            return inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE_
+
+
+def _read_(source: Iterable[Any], outbox: queue.Queue, stop: threading.Event) -> None:
+    items = iter(source)
+    try:
+        for item in items:
+            if not _put_(outbox, item, stop):
+                break
+        else:
+            _put_(outbox, _DONE_, stop)
+    except BaseException as e:
+        _put_(outbox, _Failure_(e), stop)
+    finally:
+        # e.g. kills the git process behind a generator when the pipeline is stopped
+        close = getattr(items, "close", None)
+        if close is not None:
+            close()
+
+
+def _transform_(
+    transform: Callable[[Any], Any], inbox: queue.Queue, outbox: queue.Queue, stop: threading.Event
+) -> None:
+    while True:
+        item = _get_(inbox, stop)
+        if item is _DONE_ or isinstance(item, _Failure_):
+            _put_(outbox, item, stop)
+            return
+        try:
+            item = transform(item)
+        except BaseException as e:
+            _put_(outbox, _Failure_(e), stop)
+            return
+        if not _put_(outbox, item, stop):
+            return
@@ -1,59 +1,59 @@
-from sqlalchemy import text
+from typing import Dict
 
-STATS_SQL = [
-    text(
-        """
-    update commits
-    set n_lines_changed = (
-        select COALESCE(sum(n_lines_changed),0)
-        from committed_files
-        where committed_files.commit_id = commits.sha
-        and is_superfluous is false
-        )
-    where true
-    """
-    ),
-    text(
-        """
-    update commits
-    set n_files_changed = (
-        select count(1)
-        from committed_files
-        where committed_files.commit_id = commits.sha
-        and is_superfluous is false
-    )
-    where true
-    """
-    ),
-    text(
-        """
+from sqlalchemy import bindparam, text
+
+from .models import CHANGE_TYPES
+
+# commit level aggregates of committed files, computed in one pass over committed_files.
+# new commits have them computed when they are indexed, these are for updating existing commits.
+# files whose is_superfluous is NULL, e.g. in old databases, are counted as neither changed nor ignored
+_COMMIT_STATS_SQL_ = """
     update commits
-    set n_lines_ignored = (
-        select COALESCE(sum(n_lines_changed),0)
+    set n_lines_changed = stats.n_lines_changed,
+        n_files_changed = stats.n_files_changed,
+        n_lines_ignored = stats.n_lines_ignored,
+        n_files_ignored = stats.n_files_ignored
+    from (
+        select
+            commit_id,
+            COALESCE(sum(case when is_superfluous is false then n_lines_changed else 0 end), 0) as n_lines_changed,
+            sum(case when is_superfluous is false then 1 else 0 end) as n_files_changed,
+            COALESCE(sum(case when is_superfluous is true then n_lines_changed else 0 end), 0) as n_lines_ignored,
+            sum(case when is_superfluous is true then 1 else 0 end) as n_files_ignored
         from committed_files
-        where committed_files.commit_id = commits.sha
-        and is_superfluous is true
-    )
-    where true
+        {where}
+        group by commit_id
+    ) as stats
+    where commits.sha = stats.commit_id
     """
-    ),
-    text(
-        """
+
+STATS_SQL = text(_COMMIT_STATS_SQL_.format(where=""))
+
+STATS_BY_SHA_SQL = text(_COMMIT_STATS_SQL_.format(where="where commit_id in :shas")).bindparams(
+    bindparam("shas", expanding=True)
+)
+
+# the update above skips commits without committed files, e.g. all their files were deleted
+_ZERO_STATS_SQL_ = """
     update commits
-    set n_files_ignored = (
-        select count(1)
-        from committed_files
-        where committed_files.commit_id = commits.sha
-        and is_superfluous is true
-    )
-    where true
+    set n_lines_changed = 0, n_files_changed = 0, n_lines_ignored = 0, n_files_ignored = 0
+    where not exists (select 1 from committed_files where committed_files.commit_id = commits.sha)
+    {where}
     """
-    ),
-    text("drop view if exists all_commit_data"),
-    text(
-        """
-        create view all_commit_data
-        as
+
+ZERO_STATS_SQL = text(_ZERO_STATS_SQL_.format(where=""))
+
+ZERO_STATS_BY_SHA_SQL = text(_ZERO_STATS_SQL_.format(where="and commits.sha in :shas")).bindparams(
+    bindparam("shas", expanding=True)
+)
+
+# change type codes of committed_files back to their names
+_CHANGE_TYPE_NAME_ = "case committed_files.change_type {} end".format(
+    " ".join(f"when {code} then '{name}'" for code, name in enumerate(CHANGE_TYPES))
+)
+
+# one row per committed file per repository, denormalized for exports and BI tools
+_COMMIT_DATA_SELECT_ = f"""
         select
             authors.id as author_id,
             authors.name,
@@ -76,10 +76,10 @@ STATS_SQL = [
             commits.n_files_changed as commit_n_files_changed,
             commits.n_files_ignored as commit_n_files_ignored,
             committed_files.id as committed_file_id,
-            committed_files.change_type,
-            committed_files.file_path,
-            committed_files.file_name,
-            committed_files.file_type,
+            {_CHANGE_TYPE_NAME_} as change_type,
+            paths.file_path,
+            paths.file_name,
+            paths.file_type,
             committed_files.n_lines_added,
             committed_files.n_lines_deleted,
             committed_files.n_lines_changed,
@@ -100,13 +100,92 @@ STATS_SQL = [
         from authors
             inner join commits on commits.author_id = authors.id
             inner join committed_files on committed_files.commit_id = commits.sha
+            inner join paths on paths.id = committed_files.path_id
             inner join repo_to_commits rtc on commits.sha = rtc.commit_id
             inner join repositories repo on rtc.repo_id = repo.id
-        """,
-    ),
+    """
+
+DROP_VIEW_SQL = text("drop view if exists all_commit_data")
+DROP_TABLE_SQL = text("drop table if exists all_commit_data")
+
+VIEW_SQL = [DROP_VIEW_SQL, text("create view all_commit_data as " + _COMMIT_DATA_SELECT_)]
+
+# all_commit_data as a table, which is kept up to date by rewriting the rows of new or changed commits.
+# the rows of a few commits are selected quickly with the index on commit_id of committed_files
+MATERIALIZE_SQL = [
+    text("create table all_commit_data as " + _COMMIT_DATA_SELECT_),
+    text("create index ix_all_commit_data_sha on all_commit_data (sha)"),
+    text("create index ix_all_commit_data_repo_id on all_commit_data (repo_id)"),
+    text("create index ix_all_commit_data_author_id on all_commit_data (author_id)"),
+    text("create index ix_all_commit_data_commit_date_ts on all_commit_data (commit_date_ts)"),
 ]
 
+# rows of the given commits in all repositories
+DELETE_COMMIT_DATA_SQL = text("delete from all_commit_data where sha in :shas").bindparams(
+    bindparam("shas", expanding=True)
+)
+INSERT_COMMIT_DATA_SQL = text(
+    "insert into all_commit_data " + _COMMIT_DATA_SELECT_ + " where commits.sha in :shas"
+).bindparams(bindparam("shas", expanding=True))
+
+# rows of the given commits in one repository
+DELETE_REPO_COMMIT_DATA_SQL = text("delete from all_commit_data where repo_id = :repo_id and sha in :shas").bindparams(
+    bindparam("shas", expanding=True)
+)
+INSERT_REPO_COMMIT_DATA_SQL = text(
+    "insert into all_commit_data " + _COMMIT_DATA_SELECT_ + " where repo.id = :repo_id and commits.sha in :shas"
+).bindparams(bindparam("shas", expanding=True))
+
+# repository and author columns of all_commit_data, and the columns of repositories and authors they come from
+_REPO_COLUMNS_ = {
+    "repo_name": "repo_name",
+    "repo_group": "repo_group",
+    "repo_type": "repo_type",
+    "component": "component",
+    "clone_url": "clone_url",
+    "browse_url": "browse_url",
+    "repo_inlude_in_stats": "include_in_stats",
+    "last_indexed_at": "last_indexed_at",
+}
+_AUTHOR_COLUMNS_ = {
+    "name": "name",
+    "email": "email",
+    "real_name": "real_name",
+    "real_email": "real_email",
+    "company": "company",
+    "team": "team",
+    "author_group": '"group"',
+}
+
+
+def _refresh_commit_data_sql_(table: str, key: str, columns: Dict[str, str], where: str = "") -> str:
+    # only the rows that differ are written
+    return f"""
+    update all_commit_data
+    set {", ".join(f"{column} = {table}.{source}" for column, source in columns.items())}
+    from {table}
+    where {table}.id = all_commit_data.{key}
+        and ({" or ".join(f"all_commit_data.{column} is not {table}.{source}" for column, source in columns.items())})
+        {where}
+    """
+
+
+# rows of the materialized all_commit_data keep the repository and author attributes of the time they were
+# written, these bring them up to date after a repository is indexed again or an author is aliased
+REFRESH_REPO_COMMIT_DATA_SQL = text(_refresh_commit_data_sql_("repositories", "repo_id", _REPO_COLUMNS_))
+REFRESH_AUTHOR_COMMIT_DATA_SQL = text(_refresh_commit_data_sql_("authors", "author_id", _AUTHOR_COLUMNS_))
+
+# rows of one repository, e.g. with the new last_indexed_at
+REFRESH_ONE_REPO_COMMIT_DATA_SQL = text(
+    _refresh_commit_data_sql_("repositories", "repo_id", _REPO_COLUMNS_, "and all_commit_data.repo_id = :repo_id")
+)
+
 
 QUERY_SQL = {
-    "all_commit_data": text(" select * from all_commit_data limit 1000000"),
+    "all_commit_data": text("select * from all_commit_data"),
+    # rows of the commits changed after since, up to until, in commit_changes
+    "changed_commit_data": text(
+        """select * from all_commit_data
+        where sha in (select sha from commit_changes where id > :since and id <= :until)"""
+    ),
 }
@@ -1,15 +1,19 @@
 import argparse
+import importlib.util
 import os
 import re
 import shlex
 import subprocess
 import sys
+from datetime import datetime
 from functools import partial
-from typing import Iterator
+from typing import Any, Dict, Iterator
 
 from dotenv import load_dotenv
 
-from indexer import Indexer
+from indexer import DB_MODES, WRITERS, Indexer
+from indexer.export import COMPRESSIONS, PARTITIONS
+from indexer.extract import EXTRACTORS, METRICS_LEVELS
 from utils import (
     enumerate_github_repos,
     enumerate_gitlab_repos,
@@ -95,10 +99,12 @@ def run_mirror(args: argparse.Namespace) -> None:
 
 
 def run_indexer(args: argparse.Namespace) -> None:
-    # the sqlite3 database this program needs will reside in memory
+    # by default the sqlite3 database this program needs will reside in memory
     # for performance reason as well as ability to run in serverless environment
     # we'll load the database from disk if it exists
     # after indexing is done we'll save the database in memory back to disk
+    # with --snapshot-interval the database is also saved while indexing, database writes wait for it
+    # with --db-mode wal the database is used in place, for databases too large to fit in memory
     n_repos, n_commits = 0, 0
 
     if args.source == "gitlab":
@@ -113,36 +119,101 @@ def run_indexer(args: argparse.Namespace) -> None:
         print(f"don't know how to index {args.source}")
         return
 
-    indexer = Indexer(db_file=args.db)
-
-    # speical undocumented query string for update the stats only
-    # do not index any repos
-    if args.query != "_stats_":
-        for repo_url in enumerator(args.query):
-            if match_any(repo_url, args.filter):
-                if not args.dry_run:
-                    source = "other" if args.source == "list" else args.source
-                    n_commits += indexer.index_repository(repo_url, source, show_progress=True)
-                    n_repos += 1
-
-    if n_commits or args.query == "_stats_":
-        indexer.update_commit_stats()
-
-    if args.export_csv:
-        indexer.export_all_data(args.export_csv)
+    indexer = Indexer(
+        db_file=args.db,
+        extractor=args.extractor,
+        metrics=args.metrics,
+        batch_commits=args.batch_commits,
+        batch_files=args.batch_files,
+        writer=args.writer,
+        queue_size=args.queue_size,
+        jobs=args.jobs,
+        materialize=args.materialize,
+        db_mode=args.db_mode,
+        snapshot_interval=args.snapshot_interval * 60,
+    )
 
-    indexer.close()
+    # the database is closed, and saved when in memory, even if indexing fails
+    try:
+        # speical undocumented query string for update the stats only
+        # do not index any repos
+        if args.query != "_stats_" and not args.dry_run:
+            source = "other" if args.source == "list" else args.source
+            repos = ((repo_url, source) for repo_url in enumerator(args.query) if match_any(repo_url, args.filter))
+            n_repos, n_commits = indexer.index_repositories(repos, workers=args.workers, show_progress=True)
+
+        if args.query == "_stats_":
+            indexer.update_commit_stats()
+        else:
+            # stats of new commits are computed when they are indexed, a materialized
+            # all_commit_data gets the changed repository and author attributes
+            indexer.update_views()
+
+        # with --export-delta, only the rows of commits changed since the last export are exported
+        changes = indexer.changes_to_export() if args.export_delta else None
+        manifest, manifest_file = None, ""
+        if args.export_csv:
+            manifest = indexer.export_all_data(
+                args.export_csv, args.export_part_size * 1024 * 1024, args.export_compression or "none", changes
+            )
+            manifest_file = os.path.splitext(args.export_csv)[0] + ".manifest.json"
+        if args.export_parquet:
+            # only one of the exports is loaded into BigQuery, parquet loads faster
+            manifest = indexer.export_parquet(
+                args.export_parquet, args.export_partition, args.export_compression or "zstd", changes
+            )
+            manifest_file = os.path.join(args.export_parquet, "all_commit_data.manifest.json")
+
+        is_uploaded = False
+        if args.upload and manifest:
+            if manifest["mode"] == "full" and manifest["format"] == "csv" and manifest["compression"] == "none":
+                is_uploaded = len(manifest["parts"]) == 1 and upload_file(args.export_csv, "all_commit_data.csv")
+            if not is_uploaded:
+                is_uploaded = upload_export(manifest_file, manifest)
+
+        # an export that is not loaded is included in the next one
+        if changes and manifest and (is_uploaded or not args.upload):
+            indexer.mark_exported(changes, manifest["n_rows"])
+    finally:
+        indexer.close()
 
     if args.upload:
         suffix = re.sub(r"[^0-9.]", "", timestamp())
         upload_file(args.db, f"git-indexer-{suffix}.db")
 
-        if os.path.isfile(args.export_csv) and os.stat(args.export_csv).st_size > 0:
-            upload_file(args.export_csv, "all_commit_data.csv")
-
     log(f"finished indexing {n_commits} commits in {n_repos} repositories")
 
 
+def upload_export(manifest_file: str, manifest: Dict[str, Any]) -> bool:
+    """
+    upload the files of an export split into parts, compressed, in parquet format or of changes only,
+    then the manifest, which triggers the cloud function to load all of them into BigQuery
+    """
+    export_dir = os.path.dirname(manifest_file)
+    files = [part["file"] for part in manifest["parts"]]
+    if "changed_commits" in manifest:
+        files.append(manifest["changed_commits"])
+    for file_name in files:
+        if not upload_file(os.path.join(export_dir, file_name), f"all_commit_data/{file_name}"):
+            return False
+
+    return upload_file(manifest_file, "all_commit_data.manifest.json")
+
+
+def run_backfill(args: argparse.Namespace) -> None:
+    indexer = Indexer(db_file=args.db, db_mode=args.db_mode)
+    n_commits = indexer.backfill_metrics(args.filter, args.metrics, args.since, args.until)
+    indexer.close()
+    log(f"finished computing {args.metrics} metrics for {n_commits} commits")
+
+
+def run_reclassify(args: argparse.Namespace) -> None:
+    indexer = Indexer(db_file=args.db, db_mode=args.db_mode)
+    n_files = indexer.reclassify_files()
+    indexer.close()
+    log(f"finished reclassifying {n_files} files")
+
+
 def parse_args(args: list[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
 
@@ -169,6 +240,18 @@ def parse_args(args: list[str]) -> argparse.Namespace:
         default=False,
         help="Mirror repositories",
     )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        default=False,
+        help="Compute metrics specified by --metrics for commits already indexed with a lower level",
+    )
+    parser.add_argument(
+        "--reclassify",
+        action="store_true",
+        default=False,
+        help="Apply the exclude rules to files already indexed and update the stats of affected commits",
+    )
 
     parser.add_argument(
         "--filter",
@@ -197,12 +280,140 @@ def parse_args(args: list[str]) -> argparse.Namespace:
         default="db/git-indexer.db",
         help="local data for storing indexed data",
     )
+    parser.add_argument(
+        "--db-mode",
+        dest="db_mode",
+        choices=DB_MODES,
+        default="memory",
+        help="Load the database into memory and save it back when done, or use it in place in write-ahead log mode",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        dest="snapshot_interval",
+        type=int,
+        default=0,
+        help="Save the memory database every this many minutes while indexing, if it has changed. "
+        "Statements wait until it is saved. 0 to disable, the default",
+    )
     parser.add_argument(
         "--output",
         dest="output",
         required=False,
         help="Specify base output directory",
     )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to index repositories concurrently",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to compute diffs and metrics within a repository",
+    )
+    parser.add_argument(
+        "--extractor",
+        dest="extractor",
+        choices=EXTRACTORS,
+        default="pydriller",
+        help="How commits are extracted from git. gitlog is much faster but does not compute method metrics",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        choices=METRICS_LEVELS,
+        default="methods",
+        help="File metrics to compute. lines is the fastest, loc adds lines of code, methods adds method counts",
+    )
+    parser.add_argument(
+        "--writer",
+        dest="writer",
+        choices=WRITERS,
+        default="orm",
+        help="How new commits are written to database. bulk uses executemany and is much faster",
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        default=0,
+        help="Run git traversal and database writes in separate threads connected by queues of this size",
+    )
+    parser.add_argument(
+        "--batch-commits",
+        dest="batch_commits",
+        type=int,
+        default=1000,
+        help="Save the progress of a repository every this many new commits, an interrupted run resumes from there",
+    )
+    parser.add_argument(
+        "--batch-files",
+        dest="batch_files",
+        type=int,
+        default=20000,
+        help="Also save the progress of a repository every this many new files",
+    )
+    parser.add_argument(
+        "--materialize",
+        action="store_true",
+        default=False,
+        help="Keep all_commit_data as a table that is updated for new or changed commits, instead of a view",
+    )
+    parser.add_argument(
+        "--exclude-rules",
+        dest="exclude_rules",
+        default="",
+        help="File of regex patterns, one per line, for files not counted towards commit stats",
+    )
+    parser.add_argument(
+        "--export-part-size",
+        dest="export_part_size",
+        type=int,
+        default=0,
+        help="Split the export into files of about this many MB each, a manifest lists the files",
+    )
+    parser.add_argument(
+        "--export-compression",
+        dest="export_compression",
+        choices=COMPRESSIONS,
+        default=None,
+        help="Compress the exported files, default to none for CSV and zstd for parquet. BigQuery only loads gzip CSV",
+    )
+    parser.add_argument(
+        "--export-delta",
+        action="store_true",
+        default=False,
+        help="Only export the rows of commits added or changed since the last export, loaded by merging",
+    )
+    parser.add_argument(
+        "--export-parquet",
+        dest="export_parquet",
+        default="",
+        help="Export index result to typed parquet files in this directory, requires pyarrow",
+    )
+    parser.add_argument(
+        "--export-partition",
+        dest="export_partition",
+        choices=PARTITIONS,
+        default="none",
+        help="Split the parquet export into a directory per repository or per month",
+    )
+    parser.add_argument(
+        "--since",
+        dest="since",
+        type=datetime.fromisoformat,
+        help="With --backfill, only commits created on or after this date, e.g. 2023-01-01",
+    )
+    parser.add_argument(
+        "--until",
+        dest="until",
+        type=datetime.fromisoformat,
+        help="With --backfill, only commits created before this date",
+    )
     parser.add_argument(
         "--upload",
         action="store_true",
@@ -218,18 +429,36 @@ def parse_args(args: list[str]) -> argparse.Namespace:
 
     ns = parser.parse_args(args)
 
-    if ns.mirror and ns.index:
-        parser.error("both --index or --mirror are specified, can only choose one")
+    n_modes = [ns.mirror, ns.index, ns.backfill, ns.reclassify].count(True)
+    if n_modes > 1:
+        parser.error(
+            "more than one of --index, --mirror, --backfill or --reclassify are specified, can only choose one"
+        )
 
-    if not ns.mirror and not ns.index:
-        parser.error("either --index or --mirror must be specified")
+    if n_modes == 0:
+        parser.error("either --index, --mirror, --backfill or --reclassify must be specified")
 
-    if ns.index and ns.db is None:
+    if (ns.index or ns.backfill or ns.reclassify) and ns.db is None:
         parser.error("--db must be set")
 
-    if not ns.source:
+    if not ns.source and not (ns.backfill or ns.reclassify):
         parser.error("--source is required")
 
+    if ns.workers < 1 or ns.jobs < 1:
+        parser.error("--workers and --jobs must be at least 1")
+
+    if ns.queue_size < 0:
+        parser.error("--queue-size cannot be negative")
+
+    if ns.snapshot_interval < 0:
+        parser.error("--snapshot-interval cannot be negative")
+
+    if ns.export_part_size < 0:
+        parser.error("--export-part-size cannot be negative")
+
+    if ns.batch_commits < 1 or ns.batch_files < 1:
+        parser.error("--batch-commits and --batch-files must be at least 1")
+
     if ns.mirror and ns.output is None:
         parser.error("--output must be specified when --mirror is used")
 
@@ -247,6 +476,22 @@ def parse_args(args: list[str]) -> argparse.Namespace:
 
     if ns.export_csv:
         ns.export_csv = os.path.abspath(os.path.expanduser(ns.export_csv))
+        # pyarrow compresses parquet files itself
+        if ns.export_compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            parser.error("--export-compression zstd requires the zstandard package")
+        if ns.export_compression == "zstd" and ns.upload:
+            parser.error("--upload cannot be used with --export-compression zstd, BigQuery only loads gzip CSV")
+
+    if ns.export_parquet:
+        ns.export_parquet = os.path.abspath(os.path.expanduser(ns.export_parquet))
+        # checked before indexing, which can take hours
+        if importlib.util.find_spec("pyarrow") is None:
+            parser.error("--export-parquet requires the pyarrow package")
+
+    if ns.exclude_rules:
+        ns.exclude_rules = os.path.abspath(os.path.expanduser(ns.exclude_rules))
+        if not os.path.isfile(ns.exclude_rules):
+            parser.error(f"exclude rules file {ns.exclude_rules} does not exist")
 
     # print(ns)
     return ns
@@ -254,7 +499,14 @@ def parse_args(args: list[str]) -> argparse.Namespace:
 
 if __name__ == "__main__":  # pragma: no cover
     args = parse_args(sys.argv[1:])
+    if args.exclude_rules:
+        # passed by environment so that worker processes use the same rules
+        os.environ["EXCLUDE_RULES_FILE"] = args.exclude_rules
     if args.mirror:
         run_mirror(args)
     elif args.index:
         run_indexer(args)
+    elif args.backfill:
+        run_backfill(args)
+    elif args.reclassify:
+        run_reclassify(args)
@@ -0,0 +1,101 @@
+import json
+import os
+from importlib.util import module_from_spec, spec_from_file_location
+
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("google.cloud.storage")
+
+MAIN_FILE = os.path.join(os.path.dirname(__file__), "..", "gcp", "cloud_function", "main.py")
+
+
+@pytest.fixture
+def main():
+    spec = spec_from_file_location("cloud_function_main", MAIN_FILE)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeJob:
+    def __init__(self, output_rows=0):
+        self.output_rows = output_rows
+
+    def result(self):
+        return self
+
+
+class FakeBigQuery:
+    def __init__(self):
+        self.queries = []
+        self.loads = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        return FakeJob()
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None):
+        self.loads.append((source_uris, destination, job_config))
+        return FakeJob(1)
+
+
+class FakeStorage:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def bucket(self, name):
+        return self
+
+    def blob(self, name):
+        return FakeBlob(self.blobs[name])
+
+
+class FakeBlob:
+    def __init__(self, content):
+        self.content = content
+
+    def download_as_text(self):
+        return self.content
+
+
+def test_load_full_csv(main):
+    client = FakeBigQuery()
+    main.load_export(client, FakeStorage({}), "bucket", "all_commit_data.csv")
+
+    assert [sql for sql, _ in client.queries] == [f"DELETE FROM `{table(main)}` WHERE true"]
+    assert client.loads[0][0] == ["gs://bucket/all_commit_data.csv"]
+    assert client.loads[0][2].write_disposition == "WRITE_APPEND"
+
+
+def test_load_delta(main):
+    manifest = {
+        "format": "csv",
+        "mode": "delta",
+        "compression": "gzip",
+        "changed_commits": "all_commit_data.changed_commits.txt",
+        "parts": [{"file": "all_commit_data-00001.csv.gz"}],
+    }
+    blobs = {
+        "all_commit_data.manifest.json": json.dumps(manifest),
+        "all_commit_data/all_commit_data.changed_commits.txt": "sha1\nsha2\n",
+    }
+    client = FakeBigQuery()
+    main.load_export(client, FakeStorage(blobs), "bucket", "all_commit_data.manifest.json")
+
+    # the rows of the changed commits are replaced
+    ((sql, job_config),) = client.queries
+    assert sql == f"DELETE FROM `{table(main)}` WHERE sha IN UNNEST(@shas)"
+    assert job_config.query_parameters[0].values == ["sha1", "sha2"]
+    assert client.loads[0][0] == ["gs://bucket/all_commit_data/all_commit_data-00001.csv.gz"]
+    assert client.loads[0][2].write_disposition == "WRITE_APPEND"
+
+
+def test_skip_other_files(main):
+    client = FakeBigQuery()
+    main.load_export(client, FakeStorage({}), "bucket", "db.sqlite")
+    assert client.queries == [] and client.loads == []
+
+
+def table(main):
+    return f"{main.project_id}.{main.dataset_id}.{main.table_id}"
@@ -0,0 +1,192 @@
+import csv
+import gzip
+import json
+import subprocess
+
+import pyarrow.parquet as pq
+import pytest
+import zstandard
+from sqlalchemy import text
+
+from indexer import Indexer
+from indexer.export import BQ_SCHEMA_FILE, export_csv, export_parquet
+from indexer.stats import QUERY_SQL
+
+
+@pytest.fixture
+def indexed(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    indexer.index_repository(local_repo + "/repo1_clone")
+    indexer.update_views()
+    yield indexer
+    indexer.close()
+
+
+def test_export_parts_gzip(tmp_path, indexed):
+    n_rows = indexed.session.scalar(text("select count(*) from all_commit_data"))
+    assert n_rows > 3
+
+    # every batch of 2 rows goes to a new part
+    csv_file = (tmp_path / "all_commit_data.csv").as_posix()
+    with indexed.engine.connect() as conn:
+        manifest = export_csv(conn, QUERY_SQL["all_commit_data"], csv_file, 1, "gzip", batch_size=2)
+
+    assert manifest["n_rows"] == n_rows and len(manifest["parts"]) == (n_rows + 1) // 2
+    assert manifest["parts"][0]["file"] == "all_commit_data-00001.csv.gz"
+    with open(tmp_path / "all_commit_data.manifest.json") as f:
+        assert json.load(f) == manifest
+
+    rows = []
+    for part in manifest["parts"]:
+        with gzip.open(tmp_path / part["file"], "rt", newline="") as f:
+            reader = csv.reader(f)
+            assert next(reader) == manifest["columns"]
+            part_rows = list(reader)
+        assert len(part_rows) == part["n_rows"]
+        rows.extend(part_rows)
+    assert len(rows) == n_rows
+
+
+def test_export_parts_smaller_than_batch(tmp_path, indexed):
+    # the size is checked within a batch
+    csv_file = (tmp_path / "all_commit_data.csv").as_posix()
+    with indexed.engine.connect() as conn:
+        manifest = export_csv(conn, QUERY_SQL["all_commit_data"], csv_file, 1, check_rows=1)
+
+    assert len(manifest["parts"]) == manifest["n_rows"] > 3
+    assert all(part["n_rows"] == 1 for part in manifest["parts"])
+
+
+def test_export_single_file(tmp_path, indexed):
+    csv_file = (tmp_path / "all_commit_data.csv").as_posix()
+    manifest = indexed.export_all_data(csv_file)
+    assert [part["file"] for part in manifest["parts"]] == ["all_commit_data.csv"]
+
+    with open(csv_file, newline="") as f:
+        assert len(list(csv.reader(f))) == manifest["n_rows"] + 1
+
+
+def test_export_zstd(tmp_path, indexed):
+    csv_file = (tmp_path / "all_commit_data.csv").as_posix()
+    manifest = indexed.export_all_data(csv_file, compression="zstd")
+    with open(csv_file + ".zst", "rb") as f:
+        content = zstandard.ZstdDecompressor().stream_reader(f).read().decode()
+    assert len(content.splitlines()) == manifest["n_rows"] + 1
+
+
+@pytest.mark.parametrize("partition_by", ["none", "repo", "month"])
+def test_export_parquet(tmp_path, indexed, partition_by):
+    manifest = indexed.export_parquet(tmp_path.as_posix(), partition_by, "zstd")
+    n_rows = indexed.session.scalar(text("select count(*) from all_commit_data"))
+    assert manifest["format"] == "parquet" and manifest["n_rows"] == n_rows
+
+    with open(BQ_SCHEMA_FILE) as f:
+        bq_schema = {field["name"]: field["type"] for field in json.load(f)}
+    for part in manifest["parts"]:
+        # the file alone, without columns for the partition directories
+        table = pq.ParquetFile(tmp_path / part["file"]).read()
+        assert table.num_rows == part["n_rows"] and table.column_names == list(bq_schema)
+        assert str(table.schema.field("commit_date_ts").type) == "timestamp[us, tz=UTC]"
+        assert str(table.schema.field("is_superfluous").type) == "bool"
+
+    if partition_by == "repo":
+        assert [part["partition"] for part in manifest["parts"]] == ["repo_id=1"]
+    elif partition_by == "month":
+        assert [part["partition"] for part in manifest["parts"]] == ["month=2023-07"]
+
+
+def test_export_changes(tmp_path, local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    indexer.index_repository(local_repo + "/repo1")
+    indexer.update_views()
+
+    # nothing exported yet, everything is
+    changes = indexer.changes_to_export()
+    assert changes.since is None
+    csv_file = (tmp_path / "all_commit_data.csv").as_posix()
+    manifest = indexer.export_all_data(csv_file, changes=changes)
+    assert manifest["mode"] == "full"
+    indexer.mark_exported(changes, manifest["n_rows"])
+    assert indexer.changes_to_export().shas == []
+
+    # the fork adds 1 commit and links the other 2 to another repository, only their rows are exported
+    indexer.index_repository(local_repo + "/repo1_clone")
+    changes = indexer.changes_to_export()
+    assert changes.since == 0 and len(changes.shas) == 3
+    manifest = indexer.export_all_data(csv_file, changes=changes)
+    assert manifest["mode"] == "delta" and manifest["n_changed_commits"] == 3
+    with open(tmp_path / manifest["changed_commits"]) as f:
+        assert sorted(f.read().split()) == sorted(changes.shas)
+    with open(csv_file, newline="") as f:
+        assert sorted(row["sha"] for row in csv.DictReader(f)) == sorted(
+            indexer.session.scalars(text("select sha from all_commit_data")).all()
+        )
+    indexer.mark_exported(changes, manifest["n_rows"])
+    assert indexer.changes_to_export() == (changes.until, changes.until, [])
+
+    # changes after are not taken as exported
+    repo1_clone = local_repo + "/repo1_clone"
+    git = ["git", "-C", repo1_clone, "-c", "user.name=me", "-c", "user.email=me@me"]
+    subprocess.run([*git, "commit", "--allow-empty", "-m", "4th commit"], check=True, capture_output=True)
+    indexer.index_repository(repo1_clone)
+    assert len(indexer.changes_to_export().shas) == 1
+
+    # updating the stats of all commits may change every row
+    indexer.update_commit_stats()
+    assert indexer.changes_to_export().since is None
+
+    indexer.close()
+
+
+def test_export_without_new_commits(tmp_path, local_repo):
+    db_file = (tmp_path / "indexed.db").as_posix()
+    indexer = Indexer(db_file=db_file, db_mode="wal")
+    indexer.index_repository(local_repo + "/repo1_clone")
+    # e.g. upgrade_schema() dropped the view of an older database
+    indexer.session.execute(text("drop view all_commit_data"))
+    indexer.session.commit()
+    indexer.close()
+
+    # the view is there to export without indexing anything new
+    indexer = Indexer(db_file=db_file, db_mode="wal")
+    manifest = indexer.export_all_data((tmp_path / "all_commit_data.csv").as_posix())
+    assert manifest["n_rows"] > 3
+    indexer.close()
+
+
+def test_export_parquet_one_partition_at_a_time(tmp_path, indexed, local_repo, monkeypatch):
+    # repo1 shares commits with repo1_clone, ordered by sha their rows are mixed
+    indexed.index_repository(local_repo + "/repo1")
+    indexed.update_views()
+    with indexed.engine.connect() as conn:
+        with pytest.raises(ValueError, match="not together"):
+            export_parquet(conn, text("select * from all_commit_data order by sha"), tmp_path.as_posix(), "repo")
+
+    # the file of a partition is closed before the next one is opened
+    n_open, writer = [], pq.ParquetWriter
+
+    class Writer(writer):
+        def __init__(self, *args, **kwargs):
+            assert not n_open
+            n_open.append(1)
+            super().__init__(*args, **kwargs)
+
+        def close(self):
+            n_open.clear()
+            super().close()
+
+    monkeypatch.setattr(pq, "ParquetWriter", Writer)
+    manifest = indexed.export_parquet((tmp_path / "ordered").as_posix(), "repo")
+    assert [part["partition"] for part in manifest["parts"]] == ["repo_id=1", "repo_id=2"]
+
+
+def test_export_parquet_without_commit_date(tmp_path, indexed):
+    session = indexed.session
+    session.execute(text("update commits set created_ts = null where sha = (select min(sha) from commits)"))
+    session.commit()
+    n_rows = session.scalar(text("select count(*) from all_commit_data where commit_date_ts is null"))
+
+    manifest = indexed.export_parquet(tmp_path.as_posix(), "month")
+    parts = {part["partition"]: part["n_rows"] for part in manifest["parts"]}
+    assert n_rows > 0 and parts["month=unknown"] == n_rows
+    assert sum(parts.values()) == manifest["n_rows"]
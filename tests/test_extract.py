@@ -0,0 +1,145 @@
+import queue
+import subprocess
+from concurrent.futures import Future
+
+from pydriller.git import Git
+from pydriller.utils.conf import Conf
+
+from indexer.extract import (
+    CommitRecord,
+    KnownCommit,
+    RefTips,
+    branch_membership,
+    extract_repository,
+    iter_commits,
+    queued_records,
+    read_ref_tips,
+)
+from utils import normalize_branches
+
+
+def test_gitlog_extractor_matches_pydriller(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    pydriller_records = list(iter_commits(repo_url, {}, extractor="pydriller"))
+    gitlog_records = list(iter_commits(repo_url, {}, extractor="gitlog"))
+
+    assert isinstance(gitlog_records[-1], RefTips) and gitlog_records[-1] == pydriller_records[-1]
+
+    expected = [r for r in pydriller_records if isinstance(r, CommitRecord)]
+    commits = [r for r in gitlog_records if isinstance(r, CommitRecord)]
+    assert len(commits) == len(expected) == 3
+
+    for commit, other in zip(commits, expected):
+        assert commit.sha == other.sha
+        assert commit.message == other.message
+        assert commit.author_email == other.author_email
+        assert commit.branches == other.branches
+        assert commit.created_ts == other.created_ts
+        assert (commit.n_lines, commit.n_files, commit.n_insertions, commit.n_deletions) == (
+            other.n_lines,
+            other.n_files,
+            other.n_insertions,
+            other.n_deletions,
+        )
+        assert [
+            (f.change_type, f.file_path, f.n_lines_added, f.n_lines_deleted, f.is_superfluous) for f in commit.files
+        ] == [(f.change_type, f.file_path, f.n_lines_added, f.n_lines_deleted, f.is_superfluous) for f in other.files]
+
+
+def test_known_commits_are_not_extracted(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    known = {"7fc253ccbfddb00ed15e0896a43579dd808fd2f0": "main", "95b9a17006c3f4940f85096998f07ccadc959bd3": ""}
+    for extractor in ["pydriller", "gitlog"]:
+        records = list(iter_commits(repo_url, known, extractor=extractor))
+        # only known commits with different branches are emitted
+        assert [type(r).__name__ for r in records] == ["KnownCommit", "CommitRecord", "RefTips"]
+        assert records[0] == KnownCommit("95b9a17006c3f4940f85096998f07ccadc959bd3", "main")
+        assert records[1].sha == "6721bc457bed5bee484b4754279503ce2253c601"
+
+
+def test_existing_commits_are_not_extracted(local_repo):
+    # commits already indexed from another repository, e.g. the upstream of a fork
+    repo_url = local_repo + "/repo1_clone"
+    existing = {"7fc253ccbfddb00ed15e0896a43579dd808fd2f0", "95b9a17006c3f4940f85096998f07ccadc959bd3"}
+    for extractor in ["pydriller", "gitlog"]:
+        records = list(iter_commits(repo_url, {}, extractor=extractor, existing_shas=existing))
+        assert [type(r).__name__ for r in records] == ["KnownCommit", "KnownCommit", "CommitRecord", "RefTips"]
+        assert {r.sha for r in records[:2]} == existing
+        assert all(r.branches == "main" for r in records[:2])
+
+
+def test_parallel_extraction_keeps_order(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    existing = {"95b9a17006c3f4940f85096998f07ccadc959bd3"}
+    for extractor in ["pydriller", "gitlog"]:
+        expected = list(iter_commits(repo_url, {}, extractor=extractor, existing_shas=existing))
+        records = list(iter_commits(repo_url, {}, extractor=extractor, existing_shas=existing, jobs=2))
+        assert [type(r).__name__ for r in records] == ["CommitRecord", "KnownCommit", "CommitRecord", "RefTips"]
+        assert records == expected
+
+
+def test_extract_repository_in_chunks(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    out = queue.Queue()
+    assert extract_repository(out, repo_url, {}, existing_shas=set(), chunk_size=2)
+
+    # 3 commits and the ref tips, then the end
+    chunks = [out.get() for _ in range(out.qsize())]
+    assert [len(chunk) for chunk in chunks[:-1]] == [2, 2] and chunks[-1] is None
+
+    for chunk in chunks:
+        out.put(chunk)
+    future = Future()
+    future.set_result(True)
+    assert list(queued_records(out, future)) == list(iter_commits(repo_url, {}))
+
+    # the end is put after an error too
+    assert not extract_repository(out, local_repo + "/no_such_repo", {}, existing_shas=set())
+    assert out.get() is None and list(queued_records(out, future)) == []
+
+
+def test_resume_from_checkpoint(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    for extractor in ["pydriller", "gitlog"]:
+        records = [r for r in iter_commits(repo_url, {}, extractor=extractor) if isinstance(r, CommitRecord)]
+        # parents are always emitted before their children
+        assert [r.parents for r in records] == [[], [records[0].sha], [records[1].sha]]
+
+        # the commits reachable from checkpoint are not traversed again
+        records = list(iter_commits(repo_url, {}, extractor=extractor, checkpoint=[records[1].sha]))
+        assert [type(r).__name__ for r in records] == ["CommitRecord", "RefTips"]
+        assert records[0].sha == "6721bc457bed5bee484b4754279503ce2253c601"
+
+
+def test_branch_membership(local_repo, tmp_path):
+    # a clone of repo1_clone has remote branches origin/main and origin/develop
+    repo_path = (tmp_path / "clone").as_posix()
+    subprocess.run(["git", "clone", "-q", local_repo + "/repo1_clone", repo_path], check=True)
+    git = Git(repo_path)
+    git.repo.git.update_ref("refs/remotes/origin/feature/one", "7fc253ccbfddb00ed15e0896a43579dd808fd2f0")
+    git.repo.git.update_ref("refs/remotes/upstream/bugfix/two", "95b9a17006c3f4940f85096998f07ccadc959bd3")
+    git.repo.git.update_ref("refs/tags/v1", "7fc253ccbfddb00ed15e0896a43579dd808fd2f0")
+
+    conf = Conf({"path_to_repo": repo_path, "include_refs": True, "include_remotes": True})
+    git = Git(repo_path, conf)
+    branches = branch_membership(git, read_ref_tips(git))
+
+    assert branches["7fc253ccbfddb00ed15e0896a43579dd808fd2f0"] == "develop,feature,main,upstream"
+    for sha in git.repo.git.rev_list("--all").split():
+        assert branches.get(sha, "") == normalize_branches(git.get_commit(sha).branches)
+
+
+def test_metrics_levels(local_repo):
+    repo_url = local_repo + "/repo1_clone"
+    js_file = "casa-account-server.js"
+    for extractor in ["pydriller", "gitlog"]:
+        files = {}
+        for metrics in ["lines", "loc", "methods"]:
+            records = list(iter_commits(repo_url, {}, extractor=extractor, metrics=metrics))
+            assert all(r.metrics_level == metrics for r in records if isinstance(r, CommitRecord))
+            files[metrics] = {f.file_path: f for r in records if isinstance(r, CommitRecord) for f in r.files}
+
+        assert files["lines"][js_file].n_lines_of_code == 0 and files["lines"][js_file].n_methods == 0
+        assert files["loc"][js_file].n_lines_of_code > 0 and files["loc"][js_file].n_methods == 0
+        assert files["methods"][js_file].n_lines_of_code > 0 and files["methods"][js_file].n_methods > 0
+        assert files["methods"][js_file].n_lines_added == files["lines"][js_file].n_lines_added
@@ -1,3 +1,5 @@
+from sqlalchemy import event
+
 from gui import app
 
 
@@ -43,3 +45,28 @@ def test_search_by_repo_name(session):
         )
         assert response.status_code == 200
         assert bytes(sha, "utf-8") in response.data
+
+
+def test_search_queries(session):
+    # the repositories of the commits listed are loaded with 1 query, not 1 per commit
+    engine = session.get_bind()  # same engine as the app
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_execute)
+    try:
+        with app.test_client() as client:
+            for query, n_queries in [("mini@me", 2), ("repo", 3), ("feb3a2837630c0e51447fc1d7e68d86f964a8440", 2)]:
+                statements.clear()
+                response = client.post(
+                    "/search",
+                    data={"query": query},
+                    content_type="application/x-www-form-urlencoded",
+                )
+                assert response.status_code == 200
+                assert b"https://github.com/super/repo" in response.data
+                assert len(statements) == n_queries, statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_execute)
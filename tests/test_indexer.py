@@ -1,9 +1,26 @@
 import os
+import sqlite3
+import subprocess
+from datetime import datetime
+from itertools import islice
 
 import pytest
-from sqlalchemy import text
+from git import GitCommandError
+from sqlalchemy import create_engine, event, select, text
 
-from indexer.models import ensure_repository
+from indexer import Indexer, extract
+from indexer.extract import iter_commits
+from indexer.models import (
+    Commit,
+    CommittedFile,
+    ensure_repository,
+    load_checkpoint,
+    load_commit,
+    load_exclude_rules_version,
+    load_ref_tips,
+)
+from indexer.stats import STATS_SQL
+from utils import ExcludeRules
 
 
 def test_index_github_repo(indexer, github_test_repo):
@@ -64,6 +81,460 @@ def test_index_local_repo(indexer, local_repo):
     assert 5 == get_row_count_from_join_table(session, repo1_clone_sha)
 
 
+def test_index_repositories_with_workers(indexer, local_repo):
+    repos = [(f"{local_repo}/{name}", "local") for name in ["repo1", "repo1_clone", "empty_repo"]]
+    n_repos, n_commits = indexer.index_repositories(repos, workers=2)
+    assert n_repos == 3 and n_commits == 5
+
+    repo1_clone_sha = repo_hashes(indexer.session, f"{local_repo}/repo1_clone")
+    assert len(repo1_clone_sha) == 3
+    n_rows = get_row_count_from_join_table(indexer.session, repo1_clone_sha)
+
+    # 2nd run should not add any new commits, at most update the branches
+    indexer.index_repositories(repos, workers=2)
+    assert n_rows == get_row_count_from_join_table(indexer.session, repo1_clone_sha)
+
+
+def test_index_repositories_when_worker_dies(local_repo, monkeypatch):
+    def die(clone_url, *args):
+        if clone_url.endswith("repo1"):
+            os._exit(1)
+        return iter_commits(clone_url, *args)
+
+    # inherited by the worker processes, which are forked after this
+    monkeypatch.setattr(extract, "iter_commits", die)
+    indexer = Indexer(uri="sqlite:///:memory:", batch_commits=1)
+    repos = [(f"{local_repo}/{name}", "local") for name in ["repo1", "repo1_clone", "empty_repo"]]
+
+    # the repositories not saved by the workers are indexed in this process
+    assert indexer.index_repositories(repos, workers=2) == (3, 5)
+    assert len(repo_hashes(indexer.session, f"{local_repo}/repo1")) == 2
+    assert len(repo_hashes(indexer.session, f"{local_repo}/repo1_clone")) == 3
+
+    indexer.close()
+
+
+def test_incremental_index_from_ref_tips(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    session = indexer.session
+    repo_url = local_repo + "/repo1_clone"
+    assert indexer.index_repository(repo_url) == 3
+
+    repo = ensure_repository(session, repo_url, "local")
+    tips = load_ref_tips(session, repo)
+    assert tips["refs/remotes/origin/main"] == "95b9a17006c3f4940f85096998f07ccadc959bd3"
+    assert tips["refs/heads/develop"] == "6721bc457bed5bee484b4754279503ce2253c601"
+
+    # nothing changed, nothing to traverse
+    assert indexer.index_repository(repo_url) == 0
+
+    # only the new commit is traversed
+    git(repo_url, "-c", "user.name=me", "-c", "user.email=me@me", "commit", "--allow-empty", "-m", "4th commit")
+    assert indexer.index_repository(repo_url) == 1
+    assert len(repo_hashes(session, repo_url)) == 4
+
+    # moving a remote branch updates the branches of commits already indexed
+    git(repo_url, "update-ref", "refs/remotes/origin/main", "6721bc457bed5bee484b4754279503ce2253c601")
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # without loading the full commits of the repository, as in a new run
+    session.expire_all()
+    event.listen(indexer.engine, "before_cursor_execute", before_execute)
+    assert indexer.index_repository(repo_url) == 1
+    event.remove(indexer.engine, "before_cursor_execute", before_execute)
+    assert statements and not any("commit_messages" in statement for statement in statements)
+    assert load_commit(session, "6721bc457bed5bee484b4754279503ce2253c601").branches == "main"
+
+    indexer.close()
+
+
+def test_index_fork_links_existing_commits(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    session = indexer.session
+    assert indexer.index_repository(local_repo + "/repo1") == 2
+
+    # repo1_clone shares 2 commits with repo1, only the other one is created
+    new_commits = []
+    new_commit = indexer._new_commit_
+    indexer._new_commit_ = lambda record: new_commits.append(record.sha) or new_commit(record)
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+    assert new_commits == ["6721bc457bed5bee484b4754279503ce2253c601"]
+
+    assert session.scalar(text("select count(*) from commits")) == 3
+    assert len(repo_hashes(session, local_repo + "/repo1_clone")) == 3
+
+    indexer.close()
+
+
+@pytest.mark.parametrize("writer", ["orm", "bulk"])
+def test_index_fork_after_failed_repo(local_repo, monkeypatch, writer):
+    def fail(clone_url, *args):
+        records = iter_commits(clone_url, *args)
+        if clone_url.endswith("repo1"):
+            # e.g. git fails halfway through the traversal
+            yield next(records)
+            raise GitCommandError("git log", 128)
+        yield from records
+
+    monkeypatch.setattr("indexer.iter_commits", fail)
+    indexer = Indexer(uri="sqlite:///:memory:", writer=writer)
+    session = indexer.session
+    assert indexer.index_repository(local_repo + "/repo1") == 0
+
+    # the commit of repo1 that was not saved is created for the fork, not linked
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+    assert session.scalar(text("select count(*) from commits")) == 3
+    assert session.scalar(text("select count(*) from repo_to_commits")) == 3
+    assert repo_hashes(session, local_repo + "/repo1") == []
+
+    indexer.close()
+
+
+def test_index_with_commit_missing_from_database(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    session = indexer.session
+    repo_url = local_repo + "/repo1_clone"
+
+    # the set of existing commits has one that was never saved, it is not linked
+    indexer._existing_shas_().add("6721bc457bed5bee484b4754279503ce2253c601")
+    indexer.index_repository(repo_url)
+    assert session.scalar(text("select count(*) from repo_to_commits")) == 0
+
+    # the set is reloaded, the commit is created next time
+    assert indexer.index_repository(repo_url) == 3
+    assert len(repo_hashes(session, repo_url)) == 3
+
+    indexer.close()
+
+
+def test_index_without_commit_per_author(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    n_commits = []
+    event.listen(indexer.session, "after_commit", lambda session: n_commits.append(1))
+
+    # one commit for the new repository, one for all the commits and their authors
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+    assert len(n_commits) == 2
+    assert indexer.session.scalar(text("select count(*) from authors")) > 0
+
+    indexer.close()
+
+
+def test_resume_interrupted_index(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:", batch_commits=1)
+    session = indexer.session
+    repo_url = local_repo + "/repo1_clone"
+    repo = ensure_repository(session, repo_url, "local")
+
+    # the traversal stops after 2 commits, e.g. timeout or the process is killed
+    records = iter_commits(repo_url, {})
+    assert indexer._save_records_(repo, {}, islice(records, 2)) == 2
+    records.close()
+    assert load_checkpoint(session, repo) == ["95b9a17006c3f4940f85096998f07ccadc959bd3"]
+    assert load_ref_tips(session, repo) == {}
+
+    # next run resumes from the checkpoint, and clears it after the traversal is done
+    assert indexer.index_repository(repo_url) == 1
+    assert len(repo_hashes(session, repo_url)) == 3
+    assert load_checkpoint(session, repo) == []
+    assert load_ref_tips(session, repo) != {}
+
+    indexer.close()
+
+
+def test_writers_and_pipeline_save_same_rows(local_repo):
+    def dump(indexer):
+        # everything but generated ids
+        session = indexer.session
+        return (
+            session.execute(text("select * from commits order by sha")).all(),
+            session.execute(text("select * from commit_messages order by sha")).all(),
+            session.execute(
+                text(
+                    """select commit_sha, commit_id, change_type, file_path, file_name, file_type,
+                    n_lines_added, n_lines_deleted, n_lines_changed, n_lines_of_code, n_methods,
+                    n_methods_changed, is_on_exclude_list, is_superfluous
+                    from committed_files join paths on paths.id = path_id order by 1, 3, 4"""
+                )
+            ).all(),
+            session.execute(
+                text(
+                    """select clone_url, commit_id from repo_to_commits
+                    join repositories on repositories.id = repo_id order by 1, 2"""
+                )
+            ).all(),
+            session.execute(text("select name, email from authors order by email")).all(),
+        )
+
+    results = []
+    for writer, queue_size in [("orm", 0), ("bulk", 0), ("orm", 2), ("bulk", 2)]:
+        indexer = Indexer(uri="sqlite:///:memory:", writer=writer, batch_commits=2, queue_size=queue_size)
+        for name in ["repo1", "repo1_clone"]:
+            indexer.index_repository(f"{local_repo}/{name}")
+        results.append(dump(indexer))
+        indexer.close()
+
+    assert len(results[0][0]) == len(results[0][1]) == 3 and len(results[0][2]) > 0 and len(results[0][3]) == 5
+    assert results[0] == results[1] == results[2] == results[3]
+
+
+def test_commit_stats_computed_when_indexed(local_repo):
+    stats_sql = text(
+        "select sha, n_lines_changed, n_files_changed, n_lines_ignored, n_files_ignored from commits order by sha"
+    )
+    for writer in ["orm", "bulk"]:
+        indexer = Indexer(uri="sqlite:///:memory:", writer=writer)
+        session = indexer.session
+        indexer.index_repository(local_repo + "/repo1_clone")
+        indexed = session.execute(stats_sql).all()
+        assert all(row.n_files_changed + row.n_files_ignored > 0 for row in indexed)
+
+        # same as computed from committed_files
+        indexer.update_commit_stats()
+        assert session.execute(stats_sql).all() == indexed
+
+        # only the given commits are updated
+        session.execute(text("update commits set n_lines_changed = 0, n_files_changed = 0"))
+        session.commit()
+        indexer.update_commit_stats([indexed[0].sha])
+        rows = session.execute(stats_sql).all()
+        assert rows[0] == indexed[0] and rows[1].n_files_changed == 0
+
+        # commits without files any more are reset, by sha and all at once
+        session.execute(
+            text("delete from committed_files where commit_id in (:sha0, :sha2)"),
+            {"sha0": indexed[0].sha, "sha2": indexed[2].sha},
+        )
+        session.commit()
+        indexer.update_commit_stats([indexed[0].sha])
+        assert tuple(session.execute(stats_sql).all()[0]) == (indexed[0].sha, 0, 0, 0, 0)
+        indexer.update_commit_stats()
+        assert tuple(session.execute(stats_sql).all()[2]) == (indexed[2].sha, 0, 0, 0, 0)
+
+        indexer.close()
+
+
+def test_commit_stats_of_files_without_flag():
+    # is_superfluous was added to committed_files by upgrade_schema, so old rows have NULL
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """create table commits (sha varchar primary key, n_lines_changed integer,
+                n_files_changed integer, n_lines_ignored integer, n_files_ignored integer)"""
+            )
+        )
+        conn.execute(text("create table committed_files (commit_id varchar, n_lines_changed integer)"))
+        conn.execute(text("alter table committed_files add column is_superfluous boolean"))
+        conn.execute(text("insert into commits (sha) values ('abc')"))
+        conn.execute(
+            text("insert into committed_files values ('abc', 1, false), ('abc', 10, true), ('abc', 100, null)")
+        )
+        conn.execute(STATS_SQL)
+
+        # files without the flag are counted as neither changed nor ignored
+        stats = conn.execute(
+            text("select n_lines_changed, n_files_changed, n_lines_ignored, n_files_ignored from commits")
+        )
+        assert tuple(stats.one()) == (1, 1, 10, 1)
+
+
+def test_reclassify_files(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    session = indexer.session
+    indexer.index_repository(local_repo + "/repo1_clone")
+    stats_sql = text("select sha, n_lines_changed, n_files_changed, n_lines_ignored, n_files_ignored from commits")
+    indexed = session.execute(stats_sql).all()
+
+    # all js files are excluded
+    rules = ExcludeRules([r".*\.js$"])
+    n_js_files = session.scalar(
+        text("select count(*) from committed_files join paths on paths.id = path_id where file_path like '%.js'")
+    )
+    assert n_js_files > 0
+    n_files = session.scalar(
+        text(
+            """select count(*) from committed_files join paths on paths.id = path_id
+            where is_superfluous != (file_path like '%.js')"""
+        )
+    )
+    assert indexer.reclassify_files(rules, batch_size=2) == n_files > 0
+    assert session.scalar(text("select count(*) from committed_files where is_superfluous")) == n_js_files
+    assert load_exclude_rules_version(session) == rules.version
+
+    # commit stats are consistent with the files
+    assert session.execute(stats_sql).all() != indexed
+    reclassified = session.execute(stats_sql).all()
+    indexer.update_commit_stats()
+    assert session.execute(stats_sql).all() == reclassified
+
+    # nothing changes the 2nd time, back to the original stats with default rules
+    assert indexer.reclassify_files(rules) == 0
+    indexer.reclassify_files(ExcludeRules.default())
+    assert sorted(session.execute(stats_sql).all()) == sorted(indexed)
+
+    indexer.close()
+
+
+def test_index_refused_after_rules_change(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:")
+    session = indexer.session
+    assert indexer.index_repository(local_repo + "/repo1") == 2
+    indexer.reclassify_files(ExcludeRules([r".*\.js$"]))
+
+    # new files would be classified with other rules than the version saved
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 0
+    assert indexer.index_repositories([(local_repo + "/repo1_clone", "local")]) == (0, 0)
+    assert session.scalar(text("select count(*) from commits")) == 2
+
+    indexer.reclassify_files(ExcludeRules.default())
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+    assert load_exclude_rules_version(session) == ExcludeRules.default().version
+
+    indexer.close()
+
+
+def test_materialized_commit_data(local_repo):
+    commit_data_sql = text(
+        """select sha, repo_id, committed_file_id, email, file_path, n_lines_of_code, is_superfluous,
+        commit_n_lines_changed, commit_n_files_changed, commit_n_lines_ignored, commit_n_files_ignored
+        from all_commit_data order by repo_id, committed_file_id"""
+    )
+    materialized = Indexer(uri="sqlite:///:memory:", metrics="lines", batch_commits=2, materialize=True)
+    view = Indexer(uri="sqlite:///:memory:", metrics="lines")
+
+    def assert_same_rows():
+        view.update_views()
+        rows = view.session.execute(commit_data_sql).all()
+        assert rows and materialized.session.execute(commit_data_sql).all() == rows
+
+    # new commits, then commits linked to a fork, are added as they are indexed
+    for name in ["repo1", "repo1_clone"]:
+        for indexer in [materialized, view]:
+            indexer.index_repository(f"{local_repo}/{name}")
+        assert_same_rows()
+
+    # rows of commits whose stats or metrics change are rewritten
+    for indexer in [materialized, view]:
+        indexer.reclassify_files(ExcludeRules([r".*\.js$"]))
+    assert_same_rows()
+    for indexer in [materialized, view]:
+        indexer.backfill_metrics("*/repo1_clone", "loc")
+    assert_same_rows()
+
+    session = materialized.session
+    assert session.scalar(text("select type from sqlite_master where name = 'all_commit_data'")) == "table"
+    indexes = session.scalars(text("select name from sqlite_master where tbl_name = 'all_commit_data'")).all()
+    assert "ix_all_commit_data_sha" in indexes and "ix_all_commit_data_repo_id" in indexes
+
+    # rebuilt with everything else
+    materialized.update_commit_stats()
+    assert_same_rows()
+
+    # repository and author attributes changed in the database
+    # indexing needs the files classified with the current rules
+    for indexer in [materialized, view]:
+        indexer.reclassify_files(ExcludeRules.default())
+    session.execute(text("update all_commit_data set last_indexed_at = 'stale'"))
+    session.commit()
+    materialized.index_repository(f"{local_repo}/repo1")
+    last_indexed_sql = text("select distinct repo_name, last_indexed_at = 'stale' from all_commit_data order by 1")
+    assert session.execute(last_indexed_sql).all() == [("repo1", False), ("repo1_clone", True)]
+    for indexer in [materialized, view]:
+        indexer.session.execute(text("update authors set real_name = 'someone', team = 'a team'"))
+        indexer.session.execute(text("update repositories set component = 'stuff'"))
+        indexer.session.commit()
+    aliased_sql = text("select count(*) from all_commit_data where real_name = 'someone' and component = 'stuff'")
+    assert session.scalar(aliased_sql) == 0
+    materialized.update_views()
+    assert session.scalar(aliased_sql) == session.scalar(text("select count(*) from all_commit_data"))
+    assert_same_rows()
+
+    materialized.close()
+    view.close()
+
+
+def test_wal_mode(tmp_path, local_repo):
+    db_file = (tmp_path / "wal.db").as_posix()
+    indexer = Indexer(db_file=db_file, db_mode="wal", batch_commits=1, checkpoint_interval=0)
+    assert indexer.session.scalar(text("pragma journal_mode")) == "wal"
+    assert indexer.session.scalar(text("pragma synchronous")) == 1  # NORMAL
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+
+    # every batch is on disk before the indexer is closed
+    conn = sqlite3.connect(db_file)
+    assert conn.execute("select count(*) from commits").fetchone()[0] == 3
+    conn.close()
+
+    # the write-ahead log is emptied, the database file has everything
+    indexer.close()
+    assert not os.path.exists(db_file + "-wal") or os.path.getsize(db_file + "-wal") == 0
+    indexer = Indexer(db_file=db_file)
+    assert indexer.session.scalar(text("select count(*) from commits")) == 3
+    indexer.close()
+
+    with pytest.raises(ValueError):
+        Indexer(db_mode="wal")
+
+
+def test_snapshot_memory_db(tmp_path, local_repo):
+    db_file = (tmp_path / "memory.db").as_posix()
+
+    def n_saved_commits():
+        conn = sqlite3.connect(db_file)
+        n_commits = conn.execute("select count(*) from commits").fetchone()[0]
+        conn.close()
+        return n_commits
+
+    indexer = Indexer(db_file=db_file, batch_commits=1, snapshot_interval=3600)
+    indexer._snapshot_at -= 3600
+    indexer.index_repository(local_repo + "/repo1")
+    assert n_saved_commits() > 0
+
+    # statements wait for the snapshot, nothing changed since it started
+    indexer.index_repository(local_repo + "/repo1_clone")
+    assert indexer.snapshot_db()
+    assert indexer.session.scalar(text("select count(*) from commits")) == 3
+    assert not indexer.snapshot_db(wait=True)
+    assert n_saved_commits() == 3
+
+    # nothing to save when closed, nor when loaded and closed again
+    mtime = os.path.getmtime(db_file)
+    indexer.close()
+    Indexer(db_file=db_file).close()
+    assert os.path.getmtime(db_file) == mtime
+
+
+def test_backfill_metrics(local_repo):
+    indexer = Indexer(uri="sqlite:///:memory:", metrics="lines")
+    session = indexer.session
+    assert indexer.index_repository(local_repo + "/repo1_clone") == 3
+
+    def js_file():
+        return session.scalars(select(CommittedFile).where(CommittedFile.file_name == "casa-account-server.js")).one()
+
+    assert js_file().n_lines_of_code == 0 and js_file().n_methods == 0
+
+    # no commits created in the date range
+    assert indexer.backfill_metrics("*/repo1_clone", "loc", until=datetime(2020, 1, 1)) == 0
+    assert indexer.backfill_metrics("*/repo1_clone", "loc") == 3
+    assert js_file().n_lines_of_code > 0 and js_file().n_methods == 0
+    assert indexer.backfill_metrics("*/repo1_clone", "loc") == 0
+
+    assert indexer.backfill_metrics("*/repo1_clone", "methods", since=datetime(2020, 1, 1)) == 3
+    assert js_file().n_methods > 0
+    assert {c.metrics_level for c in session.scalars(select(Commit))} == {"methods"}
+
+    indexer.close()
+
+
+def git(repo_path, *args):
+    subprocess.run(["git", "-C", repo_path, *args], check=True, capture_output=True)
+
+
 def repo_hashes(session, repo_url):
     repo = ensure_repository(session, repo_url, "local")
     hashes = [c.sha for c in repo.commits]
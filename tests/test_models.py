@@ -1,15 +1,27 @@
 from datetime import datetime
 
-from sqlalchemy import select
+from sqlalchemy import create_engine, event, func, inspect, select, text
+from sqlalchemy.orm import Session
 
 from indexer.models import (
     Author,
+    AuthorCache,
+    Base,
     Commit,
+    CommitMessage,
     CommittedFile,
+    Path,
+    PathCache,
     Repository,
+    ShaSet,
     ensure_author,
     ensure_repository,
+    link_commits,
     load_commit,
+    load_known_commits,
+    load_sha_set,
+    update_branches,
+    upgrade_schema,
 )
 
 
@@ -68,6 +80,31 @@ def test_ensure_author(session):
     assert author2.id == author.id
 
 
+def test_author_cache():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add(Author(name="me", email="me@me.com", real_name="Me", real_email="me@me.com"))
+    session.commit()
+
+    n_queries = []
+    event.listen(engine, "before_cursor_execute", lambda *args: n_queries.append(1))
+    authors = AuthorCache(session)
+    assert len(n_queries) == 1
+
+    # same email with a different name is the same author
+    me = authors.get("me", "me@me.com")
+    assert me.real_name == "Me" and authors.get("myself", "me@me.com") is me
+
+    # new authors are not saved until the session is flushed
+    you = authors.get("you", "you@you.com")
+    assert authors.get("you", "you@you.com") is you and you.id is None
+    assert len(n_queries) == 1
+
+    session.commit()
+    assert session.scalar(select(Author.id).where(Author.email == "you@you.com")) == you.id
+
+
 def test_typical_indexing_flow(session):
     """Test typical indexing flow"""
     # 1. create new repo
@@ -94,7 +131,7 @@ def test_typical_indexing_flow(session):
             commit_sha=sha,
             file_path="package.json",
             file_name="package.json",
-            change_type="UPDATE",
+            change_type="MODIFY",
         )
 
         commit.files += [new_file_1, new_file_2]
@@ -112,3 +149,158 @@ def test_typical_indexing_flow(session):
 
     session.add(repo2)
     session.commit()
+
+
+def test_path_cache():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add(Path(file_path="src/main.py", file_name="main.py"))
+    session.commit()
+
+    def row(file_path):
+        return {"file_path": file_path, "file_name": file_path.split("/")[-1], "file_type": "", "change_type": "ADD"}
+
+    paths = PathCache(session)
+    rows = paths.resolve([row("src/main.py"), row("README.md"), row("src/main.py")])
+    assert [set(r) for r in rows] == [{"path_id", "change_type"}] * 3
+    assert rows[0]["path_id"] == rows[2]["path_id"] != rows[1]["path_id"]
+
+    # new paths are inserted once, known paths are not looked up again
+    n_queries = []
+    event.listen(engine, "before_cursor_execute", lambda *args: n_queries.append(1))
+    assert paths.resolve([row("README.md")]) == [rows[1]]
+    assert len(n_queries) == 0
+    assert session.scalars(select(Path.file_type).order_by(Path.file_path)).all() == ["md", "py"]
+
+    # change types are stored as codes, unknown names as UNKNOWN
+    session.add_all(
+        [
+            CommittedFile(commit_sha="abc", commit_id="abc", change_type=change_type, path_id=rows[0]["path_id"])
+            for change_type in ["RENAME", "TYPECHANGE"]
+        ]
+    )
+    session.commit()
+    assert session.scalars(select(CommittedFile.change_type).order_by(CommittedFile.id)).all() == [
+        "RENAME",
+        "UNKNOWN",
+    ]
+    assert session.scalars(text("select change_type from committed_files order by id")).all() == [3, 0]
+    assert session.scalars(select(CommittedFile)).first().file_name == "main.py"
+
+
+def test_sha_set(session):
+    shas = load_sha_set(session)
+    assert len(shas) > 0
+    assert "feb3a2837630c0e51447fc1d7e68d86f964a8440" in shas
+    assert "0000000000000000000000000000000000000000" not in shas
+    assert "not a sha" not in shas and None not in shas
+
+    empty = ShaSet()
+    empty.add("0000000000000000000000000000000000000000")
+    assert "0000000000000000000000000000000000000000" in empty and len(empty) == 1
+
+
+def test_known_commits():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    me = Author(name="me", email="me@me.com", real_name="me", real_email="me@me.com")
+    shas = ["feb3a2837630c0e51447fc1d7e68d86f964a8440", "ee474544052762d314756bb7439d6dab73221d3d"]
+    repo = Repository(clone_url="git@github.com:super/repo.git", repo_type="github")
+    session.add_all([repo] + [Commit(sha=sha, author=me, created_at="", branches="main") for sha in shas])
+    session.commit()
+
+    assert load_known_commits(session, repo) == {}
+    # commits that are not in the database are not linked
+    assert link_commits(session, repo, shas + ["0000000000000000000000000000000000000000"]) == 2
+    assert load_known_commits(session, repo) == {shas[0]: "main", shas[1]: "main"}
+
+    update_branches(session, {shas[1]: "develop"})
+    session.commit()
+    assert load_known_commits(session, repo) == {shas[0]: "main", shas[1]: "develop"}
+    assert sorted(c.sha for c in repo.commits) == sorted(shas)
+
+
+def test_upgrade_schema():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        # commits table before metrics_level was added
+        conn.execute(text("create table commits (sha varchar not null primary key, message varchar(2048))"))
+        conn.execute(text("insert into commits (sha, message) values ('abc', 'old commit')"))
+
+    upgrade_schema(engine)
+
+    columns = [c["name"] for c in inspect(engine).get_columns("commits")]
+    assert "metrics_level" in columns and "message" not in columns
+    # with the indexes of the columns added
+    assert "ix_commits_n_lines_changed" in [index["name"] for index in inspect(engine).get_indexes("commits")]
+    upgrade_schema(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("select metrics_level, summary from commits")).one() == ("methods", "old commit")
+
+    # the message is moved to commit_messages
+    session = Session(engine)
+    assert session.scalar(select(CommitMessage.message).where(CommitMessage.sha == "abc")) == "old commit"
+
+
+def test_commit_message():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    me = Author(name="me", email="me@me.com", real_name="me", real_email="me@me.com")
+    message = "fix the build\n\n" + "the build was broken by the last commit. " * 20
+    session.add(Commit(sha="abc", author=me, created_at="", message=message))
+    session.commit()
+
+    # long messages are compressed
+    assert len(session.scalar(text("select message from commit_messages"))) < len(message) / 2
+
+    # the message is only loaded when used
+    session.expire_all()
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    commit = session.scalars(select(Commit)).one()
+    assert commit.summary == "fix the build"
+    assert not any("commit_messages" in statement for statement in statements)
+    assert commit.message == message
+
+
+def test_upgrade_schema_interns_file_paths():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        # committed_files before paths were added
+        conn.execute(
+            text(
+                """create table committed_files (id integer primary key, commit_sha varchar(40),
+                change_type varchar(16), file_path varchar(256), file_name varchar(128), file_type varchar(128),
+                n_lines_added integer, n_lines_deleted integer, n_lines_changed integer, n_lines_of_code integer,
+                n_methods integer, n_methods_changed integer, is_on_exclude_list boolean, is_superfluous boolean,
+                commit_id varchar)"""
+            )
+        )
+        conn.execute(text("create index ix_committed_files_commit_id on committed_files (commit_id)"))
+        conn.execute(text("create view all_commit_data as select * from committed_files"))
+        conn.execute(
+            text(
+                """insert into committed_files values
+                (1, 'abc', 'ADD', 'src/main.py', 'main.py', 'py', 10, 0, 10, 0, 0, 0, 0, 0, 'abc'),
+                (2, 'def', 'MODIFY', 'src/main.py', 'main.py', 'py', 5, 1, 6, 0, 0, 0, 0, 0, 'def'),
+                (3, 'def', 'DELETE', 'README.md', 'README.md', 'md', 0, 1, 1, 0, 0, 0, 1, 1, 'def')"""
+            )
+        )
+    Base.metadata.create_all(engine)
+
+    upgrade_schema(engine)
+
+    session = Session(engine)
+    files = session.scalars(select(CommittedFile).order_by(CommittedFile.id)).all()
+    assert [(f.id, f.commit_id, f.change_type, f.file_path, f.file_type, f.n_lines_added) for f in files] == [
+        (1, "abc", "ADD", "src/main.py", "py", 10),
+        (2, "def", "MODIFY", "src/main.py", "py", 5),
+        (3, "def", "DELETE", "README.md", "md", 0),
+    ]
+    assert files[0].path_id == files[1].path_id
+    assert session.scalar(select(func.count()).select_from(Path)) == 2
+    assert "file_path" not in [c["name"] for c in inspect(engine).get_columns("committed_files")]
+    assert "ix_committed_files_path_id" in [index["name"] for index in inspect(engine).get_indexes("committed_files")]
@@ -0,0 +1,44 @@
+import threading
+import time
+
+import pytest
+
+from indexer.pipeline import pipeline
+
+
+def test_pipeline():
+    assert list(pipeline(range(100), lambda x: x * 2, str, maxsize=3)) == [str(x * 2) for x in range(100)]
+    assert list(pipeline([])) == []
+
+
+def test_pipeline_error():
+    def source():
+        yield 1
+        raise ValueError("git failed")
+
+    with pytest.raises(ValueError, match="git failed"):
+        list(pipeline(source()))
+
+    with pytest.raises(ZeroDivisionError):
+        list(pipeline([1, 0], lambda x: 1 / x))
+
+
+def test_pipeline_stops_early():
+    produced, closed = [], threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    items = pipeline(source(), maxsize=2)
+    assert next(items) == 0
+    time.sleep(0.2)
+    # the reader is held back by the full queue
+    assert len(produced) <= 4
+
+    items.close()
+    assert closed.is_set() and len(produced) < 1000
@@ -16,6 +16,36 @@ def test_cmdline_options():
     args = run.parse_args(shlex.split("--index --source gitlab --dry-run"))
     assert args.index and args.source == "gitlab" and args.dry_run
 
+    args = run.parse_args(shlex.split("--index --source local --workers 4 --extractor gitlog --jobs 2"))
+    assert args.index and args.workers == 4 and args.extractor == "gitlog" and args.jobs == 2
+
+    args = run.parse_args(shlex.split("--index --source local --batch-commits 100"))
+    assert args.batch_commits == 100 and args.batch_files == 20000 and args.writer == "orm"
+
+    args = run.parse_args(shlex.split("--index --source local --writer bulk --queue-size 100 --materialize"))
+    assert args.writer == "bulk" and args.queue_size == 100 and args.materialize
+
+    args = run.parse_args(shlex.split("--backfill --metrics loc --since 2023-01-01 --filter '*/repo1*'"))
+    assert args.backfill and args.metrics == "loc" and args.since.year == 2023 and args.until is None
+
+    args = run.parse_args(shlex.split("--index --source local --export-csv a.csv --export-part-size 100"))
+    assert args.export_part_size == 100 and args.export_compression is None
+
+    args = run.parse_args(shlex.split("--index --source local --export-parquet out --export-partition month"))
+    assert os.path.isabs(args.export_parquet) and args.export_partition == "month"
+
+    args = run.parse_args(shlex.split("--index --source local --export-csv a.csv --export-delta --upload"))
+    assert args.export_delta and args.upload
+
+    args = run.parse_args(shlex.split("--index --source local --db-mode wal"))
+    assert args.db_mode == "wal" and args.snapshot_interval == 0
+
+    args = run.parse_args(shlex.split("--index --source local --snapshot-interval 10"))
+    assert args.snapshot_interval == 10
+
+    args = run.parse_args(shlex.split(f"--reclassify --exclude-rules {__file__}"))
+    assert args.reclassify and args.exclude_rules == __file__
+
     args = run.parse_args(shlex.split("--mirror --source gitlab --output local_path/repos --overwrite"))
     assert args.mirror and args.source == "gitlab" and args.output and args.overwrite and not args.dry_run
 
@@ -24,6 +54,14 @@ def test_cmdline_options():
     with pytest.raises(SystemExit):
         run.parse_args(shlex.split("--index --mirror"))
 
+    # --backfill and --index are mutually exclusive
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --backfill --source local"))
+
+    # exclude rules file must exist
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--reclassify --exclude-rules no_such_rules.txt"))
+
     # neither --mirror nor --index is not valid
     with pytest.raises(SystemExit):
         run.parse_args(shlex.split("--output somepath/tmp"))
@@ -36,11 +74,35 @@ def test_cmdline_options():
     with pytest.raises(SystemExit):
         run.parse_args(shlex.split("--mirror --source local"))
 
+    # at least 1 worker is needed
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --source local --workers 0"))
+
+    # batches cannot be empty
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --source local --batch-files 0"))
+
+    # BigQuery cannot load zstd compressed CSV
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --source local --export-csv a.csv --export-compression zstd --upload"))
+
     # unrecognized option --database
     with pytest.raises(SystemExit):
         run.parse_args(shlex.split("--index --source gitlab --database test.db --dry-run"))
 
 
+def test_cmdline_missing_package(mocker):
+    # optional packages are checked before indexing
+    mocker.patch("importlib.util.find_spec", return_value=None)
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --source local --export-parquet out"))
+    with pytest.raises(SystemExit):
+        run.parse_args(shlex.split("--index --source local --export-csv a.csv --export-compression zstd"))
+
+    args = run.parse_args(shlex.split("--index --source local --export-csv a.csv"))
+    assert args.export_csv
+
+
 @pytest.mark.skipif(os.environ.get("GITHUB_TOKEN") is not None, reason="does not work in Github action, no ssh key")
 def test_run_mirror(tmp_path, github_test_repo, capfd):
     args = run.parse_args(
@@ -3,6 +3,8 @@ import os
 import pytest
 
 from utils import (
+    ExcludeRules,
+    classify_path,
     clone_to_browse_url,
     display_url,
     enumerate_github_repos,
@@ -79,6 +81,38 @@ def test_ignore_patterns():
     assert not should_exclude_from_stats("vscode/settings.json")
 
 
+def test_exclude_rules_from_file(tmp_path, monkeypatch):
+    rules_file = tmp_path / "exclude_rules.txt"
+    rules_file.write_text("# generated code\n^gen/\n\n.*\\.min\\.js$\n")
+    rules = ExcludeRules.from_file(str(rules_file))
+    assert rules.patterns == ["^gen/", ".*\\.min\\.js$"]
+    assert rules.version != ExcludeRules.default().version
+    assert rules.version == ExcludeRules(["^gen/", ".*\\.min\\.js$"]).version
+
+    monkeypatch.setenv("EXCLUDE_RULES_FILE", str(rules_file))
+    assert should_exclude_from_stats("gen/api.py") and should_exclude_from_stats("static/app.min.js")
+    assert not should_exclude_from_stats("go.sum")
+
+    monkeypatch.delenv("EXCLUDE_RULES_FILE")
+    assert should_exclude_from_stats("go.sum") and not should_exclude_from_stats("gen/api.py")
+
+
+def test_classify_path():
+    assert classify_path("someapp/package-lock.json") == (True, "json")
+    assert classify_path("src/Main.java") == (False, "java")
+    assert classify_path(".gitignore") == (False, "hiden")
+    assert classify_path("Makefile") == (False, "generic")
+
+    # verdicts are cached up to the cache size
+    rules = ExcludeRules([r".*\.lock$"], cache_size=2)
+    for path in ["yarn.lock", "yarn.lock", "a.py", "b.py", "yarn.lock"]:
+        assert rules.classify(path)[0] == path.endswith(".lock")
+    info = rules.classify.cache_info()
+    assert info.hits == 1 and info.misses == 4 and info.currsize == 2
+
+    assert not ExcludeRules([]).classify("yarn.lock")[0]
+
+
 def test_match_any():
     assert match_any("/Users/lee/tmp/shared/bbx/company/bbx-cookiecutter-springboot3.git", "*/bbx/*/bbx*")
     assert not match_any("/Users/lee/tmp/shared/bbx/cookiecutter-springboot3.git", "*/bbx/bbx*")
@@ -1,11 +1,13 @@
 import fnmatch
+import hashlib
 import os
 import re
 import socket
 import sys
 import warnings
 from datetime import datetime
-from typing import Iterator, Optional, Set
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import gitlab
@@ -15,19 +17,80 @@ from github import Auth, BadCredentialsException, Github
 from pydriller.git import Git
 
 # files matches any of the regex will not be counted
-# towards commit stats
+# towards commit stats, unless replaced by the file given in EXCLUDE_RULES_FILE
 _IGNORE_PATTERNS_ = [
-    re.compile(
-        "^(vendor|Pods|target|YoutuOCWrapper|vos-app-protection|vos-processor|\\.idea|\\.vscode)/."  # noqa: E501
-    ),
-    re.compile("^[a-zA-Z0-9_]*?/Pods/"),
-    re.compile("^.*(xcodeproj|xcworkspace)/."),
-    re.compile(r".*\.(jar|pbxproj|lock|bk|bak|backup|class|swp|sum|pdf|png)$"),
-    re.compile(r"^.*/?package-lock\.json$"),
-    re.compile(r"^.*/?(\.next|node_modules|\.devcontainer)(/|$).*"),
+    "^(vendor|Pods|target|YoutuOCWrapper|vos-app-protection|vos-processor|\\.idea|\\.vscode)/.",
+    "^[a-zA-Z0-9_]*?/Pods/",
+    "^.*(xcodeproj|xcworkspace)/.",
+    r".*\.(jar|pbxproj|lock|bk|bak|backup|class|swp|sum|pdf|png)$",
+    r"^.*/?package-lock\.json$",
+    r"^.*/?(\.next|node_modules|\.devcontainer)(/|$).*",
 ]
 
 
+# number of distinct paths whose classification is kept by ExcludeRules.classify()
+CLASSIFY_CACHE_SIZE = 65536
+
+
+def file_type(file_path: str) -> str:
+    main, ext = os.path.splitext(file_path)
+    if main.startswith("."):
+        return "hiden"
+    elif ext != "":
+        return ext[1:].lower()
+    else:
+        return "generic"
+
+
+class ExcludeRules:
+    """
+    regex patterns of files that are not counted towards commit stats.
+    the version changes whenever the patterns change, so that indexed files can be reclassified
+    """
+
+    def __init__(self, patterns: Iterable[str], cache_size: int = CLASSIFY_CACHE_SIZE):
+        self.patterns = list(patterns)
+        self.version = hashlib.sha1("\n".join(self.patterns).encode()).hexdigest()[:12]
+        # one pass over the path instead of one per pattern, matches if any of the patterns matches
+        self.regex = re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns)) if self.patterns else None
+        # the same paths recur in most commits of a repository
+        self.classify = lru_cache(maxsize=cache_size)(self._classify_)
+
+    @classmethod
+    def default(cls) -> "ExcludeRules":
+        return cls(_IGNORE_PATTERNS_)
+
+    @classmethod
+    def from_file(cls, path: str) -> "ExcludeRules":
+        """one regex per line, empty lines and lines start with # are ignored"""
+        with open(os.path.expanduser(path)) as f:
+            return cls(line.strip() for line in f if line.strip() and not line.lstrip().startswith("#"))
+
+    def match(self, path: str) -> bool:
+        return self.regex is not None and self.regex.match(path) is not None
+
+    def _classify_(self, path: str) -> Tuple[bool, str]:
+        """returns whether the file is excluded from stats and its file type"""
+        return self.match(path), file_type(path)
+
+
+_exclude_rules_: Optional[ExcludeRules] = None
+_exclude_rules_file_: Optional[str] = None
+
+
+def exclude_rules() -> ExcludeRules:
+    """
+    the rules in the file given by environment variable EXCLUDE_RULES_FILE, or the default rules.
+    environment variable is used so that worker processes use the same rules
+    """
+    global _exclude_rules_, _exclude_rules_file_
+    rules_file = os.environ.get("EXCLUDE_RULES_FILE") or None
+    if _exclude_rules_ is None or rules_file != _exclude_rules_file_:
+        _exclude_rules_ = ExcludeRules.from_file(rules_file) if rules_file else ExcludeRules.default()
+        _exclude_rules_file_ = rules_file
+    return _exclude_rules_
+
+
 def timestamp() -> str:
     return datetime.now().isoformat()[:19]
 
@@ -71,15 +134,20 @@ def clone_to_browse_url(clone_url: str) -> str:
     return re.sub(r"\.git$", "", http_url)
 
 
+def classify_path(path: str) -> Tuple[bool, str]:
+    """
+    return whether the path should be ignored for calculating commit stats,
+    and the file type of the path
+    """
+    return exclude_rules().classify(path)
+
+
 def should_exclude_from_stats(path: str) -> bool:
     """
     return true if the path should be ignore
     for calculating commit stats
     """
-    for regex in _IGNORE_PATTERNS_:
-        if regex.match(path):
-            return True
-    return False
+    return exclude_rules().classify(path)[0]
 
 
 def enumerate_local_repos(base_dir: str) -> Iterator[str]: